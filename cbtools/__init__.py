@@ -2,23 +2,55 @@ import logging
 import os
 from logging.handlers import RotatingFileHandler
 
-from cbtools.models import SQLAlchemyLogHandler
+
+class DeferredHandler(logging.Handler):
+    # Builds the real handler on the first record it receives, so importing
+    # cbtools neither loads SQLAlchemy nor touches the database or the disk
+    def __init__(self, factory):
+        logging.Handler.__init__(self)
+        self.factory = factory
+        self.handler = None
+
+    def emit(self, record):
+        if self.handler is None:
+            self.acquire()
+            try:
+                if self.handler is None:
+                    self.handler = self.factory()
+            finally:
+                self.release()
+        self.handler.handle(record)
+
+    def close(self):
+        if self.handler is not None:
+            self.handler.close()
+        logging.Handler.close(self)
+
+
+def database_handler():
+    from cbtools.models import SQLAlchemyLogHandler
+    return SQLAlchemyLogHandler()
+
+
+def file_handler():
+    log_directory = os.path.realpath(__file__)
+    log_directory = os.path.abspath(os.path.join(log_directory, '..', '..', 'logs'))
+    if not os.path.exists(log_directory):
+        os.makedirs(log_directory)
+    log_file = os.path.join(log_directory, 'database_log.csv')
+    handler = RotatingFileHandler(log_file, 'a', 10 * 1024 * 1024, 100)
+    handler.setFormatter(logging.Formatter('%(asctime)s, %(levelname)s, %(message)s'))
+    return handler
 
 
 db_logger = logging.getLogger('database_log')
 file_logger = logging.getLogger('database_csv')
 
-db_handler = SQLAlchemyLogHandler()
+db_handler = DeferredHandler(database_handler)
 db_handler.setLevel(logging.INFO)
 db_logger.addHandler(db_handler)
 db_logger.setLevel(logging.INFO)
 
-log_directory = os.path.realpath(__file__)
-log_directory = os.path.abspath(os.path.join(log_directory, '..', '..', 'logs'))
-if not os.path.exists(log_directory):
-    os.makedirs(log_directory)
-log_file = os.path.join(log_directory, 'database_log.csv')
-file_handler = RotatingFileHandler(log_file, 'a', 10 * 1024 * 1024, 100)
-file_handler.setFormatter(logging.Formatter('%(asctime)s, %(levelname)s, %(message)s'))
-file_handler.setLevel(logging.INFO)
-file_logger.addHandler(file_handler)
+csv_handler = DeferredHandler(file_handler)
+csv_handler.setLevel(logging.INFO)
+file_logger.addHandler(csv_handler)
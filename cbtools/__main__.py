@@ -0,0 +1,34 @@
+import argparse
+import runpy
+import sys
+
+
+# Each subcommand is the command line of one module, which is only imported
+# once its subcommand is chosen, so the database, the API clients and their
+# dependencies are only loaded by the commands that use them
+commands = [('init-db', 'cbtools.models', 'Create the schema, tables, missing columns and indexes'),
+            ('sync', 'cbtools.main', 'Fetch the wallet and exchange history and load it'),
+            ('report', 'cbtools.reports', 'Write the fills report, or export tables to CSV'),
+            ('export', 'cbtools.columnar', 'Export tables to Parquet, partitioned by day'),
+            ('trade', 'cbtools.trading', 'Lay down a ladder of BTC-USD buy orders'),
+            ('ledger', 'cbtools.ledger', 'Replay the exchange ledgers and report balance gaps')]
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    modules = {name: module for name, module, help_text in commands}
+    if not argv or argv[0] not in modules:
+        parser = argparse.ArgumentParser(prog='cbtools',
+                                         description='Pass --help after a command for its own options')
+        subparsers = parser.add_subparsers(dest='command', metavar='command')
+        subparsers.required = True
+        for name, module, help_text in commands:
+            subparsers.add_parser(name, help=help_text)
+        parser.parse_args(argv)
+    # The command's own parser sees the rest of the command line unchanged
+    sys.argv = ['cbtools ' + argv[0]] + argv[1:]
+    runpy.run_module(modules[argv[0]], run_name='__main__')
+
+
+if __name__ == '__main__':
+    main()
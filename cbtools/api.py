@@ -0,0 +1,198 @@
+import argparse
+import functools
+import threading
+import time
+from collections import namedtuple, OrderedDict
+from decimal import Decimal
+
+from sqlalchemy import select
+
+from cbtools.models import get_engine, Accounts, ExchangeAccounts, ExchangeOrders, Holds
+
+
+CACHE_SIZE = 1024
+CACHE_TTL = 5.0
+
+OPEN_STATUSES = ('open', 'pending', 'active')
+
+Balance = namedtuple('Balance', ['account_id', 'source', 'currency', 'balance', 'available', 'hold'])
+Available = namedtuple('Available', ['account_id', 'currency', 'balance', 'holds', 'hold_count', 'available'])
+OpenOrder = namedtuple('OpenOrder', ['id', 'account_id', 'product_id', 'side', 'type', 'price', 'size',
+                                     'filled_size', 'status', 'created_at'])
+Position = namedtuple('Position', ['currency', 'wallet', 'exchange', 'total'])
+
+
+class QueryCache(object):
+    # A bounded LRU of query results that also expire after ttl seconds. Each
+    # result remembers the tables it was read from and the account it is
+    # about, None for every account, so a write invalidates only what it
+    # can have changed. Only writes made in this process invalidate it,
+    # those of other processes are seen once the results expire
+    def __init__(self, maxsize=CACHE_SIZE, ttl=CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, value, tables, account_id=None):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value, frozenset(tables), account_id)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, table=None, account_ids=None):
+        # Without a table everything goes, without accounts every result
+        # read from the table does
+        with self.lock:
+            for key, (expires_at, value, tables, account_id) in list(self.entries.items()):
+                if table is not None and table not in tables:
+                    continue
+                if account_ids is not None and account_id is not None and account_id not in account_ids:
+                    continue
+                del self.entries[key]
+
+
+cache = QueryCache()
+
+
+def cached(tables, by_account=False):
+    # Results are cached by function and arguments. The results of a function
+    # whose first argument is an account id are only invalidated by writes
+    # to that account
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args):
+            key = (function.__name__,) + args
+            entry = cache.get(key)
+            if entry is not None:
+                return entry[1]
+            value = function(*args)
+            cache.put(key, value, tables, args[0] if by_account else None)
+            return value
+        return wrapper
+    return decorator
+
+
+def fetch(statement):
+    with get_engine().connect() as connection:
+        return connection.execute(statement).fetchall()
+
+
+@cached(('accounts', 'exchange_accounts'))
+def balances(currency=None):
+    wallet = Accounts.__table__
+    exchange = ExchangeAccounts.__table__
+    wallet_statement = select([wallet.c.id, wallet.c.currency, wallet.c.balance_amount])
+    exchange_statement = select([exchange.c.id, exchange.c.currency, exchange.c.balance, exchange.c.available,
+                                 exchange.c.hold])
+    if currency is not None:
+        wallet_statement = wallet_statement.where(wallet.c.currency == currency)
+        exchange_statement = exchange_statement.where(exchange.c.currency == currency)
+    results = [Balance(row.id, 'wallet', row.currency, row.balance_amount, row.balance_amount, Decimal(0))
+               for row in fetch(wallet_statement.order_by(wallet.c.currency, wallet.c.id))]
+    results += [Balance(row.id, 'exchange', row.currency, row.balance, row.available, row.hold)
+                for row in fetch(exchange_statement.order_by(exchange.c.currency, exchange.c.id))]
+    return tuple(results)
+
+
+@cached(('exchange_accounts', 'holds'), by_account=True)
+def available(account_id):
+    # The balance less the holds stored by the last sync, which can differ
+    # from the exchange's own available figure between syncs. The holds of
+    # an account are few, and summed here as decimals, which the embedded
+    # database would sum as doubles
+    exchange = ExchangeAccounts.__table__
+    holds = Holds.__table__
+    account = fetch(select([exchange.c.currency, exchange.c.balance]).where(exchange.c.id == account_id))
+    if not account:
+        return None
+    currency, balance = account[0]
+    amounts = [row.amount or Decimal(0) for row in fetch(select([holds.c.amount])
+                                                           .where(holds.c.account_id == account_id))]
+    amount = sum(amounts, Decimal(0))
+    balance = balance or Decimal(0)
+    return Available(account_id, currency, balance, amount, len(amounts), balance - amount)
+
+
+@cached(('exchange_orders',))
+def open_orders(product_id=None):
+    orders = ExchangeOrders.__table__
+    statement = (select([orders.c[field] for field in OpenOrder._fields])
+                 .where(orders.c.status.in_(OPEN_STATUSES)))
+    if product_id is not None:
+        statement = statement.where(orders.c.product_id == product_id)
+    # Sorted here, by decimal price, the same on either database; orders
+    # without a price go last, as Postgres sorts NULLs
+    return tuple(sorted((OpenOrder(*row) for row in fetch(statement)),
+                        key=lambda order: (order.product_id, order.side, order.price is None, order.price or 0)))
+
+
+@cached(('accounts', 'exchange_accounts'))
+def positions():
+    totals = OrderedDict()
+    for balance in balances():
+        wallet, exchange = totals.get(balance.currency, (Decimal(0), Decimal(0)))
+        if balance.source == 'wallet':
+            wallet += balance.balance or 0
+        else:
+            exchange += balance.balance or 0
+        totals[balance.currency] = (wallet, exchange)
+    return tuple(Position(currency, wallet, exchange, wallet + exchange)
+                 for currency, (wallet, exchange) in sorted(totals.items()))
+
+
+def invalidate(table=None, account_ids=None):
+    if account_ids is not None:
+        account_ids = set(account_ids)
+        if None in account_ids:
+            # Rows without an account can affect any of them
+            account_ids = None
+    cache.invalidate(table, account_ids)
+
+
+def invalidate_documents(documents):
+    # Called once documents are loaded: each table they went to is
+    # invalidated for the accounts they belong to
+    from cbtools.loader import get_model
+    accounts = {}
+    for document in documents:
+        table = get_model(document['resource'])[0].__tablename__
+        if table in ('accounts', 'exchange_accounts'):
+            account_id = document.get('id')
+        else:
+            account_id = document.get('account_id')
+        accounts.setdefault(table, set()).add(account_id)
+    for table, account_ids in accounts.items():
+        invalidate(table, account_ids)
+
+
+if __name__ == '__main__':
+    ARGS = argparse.ArgumentParser()
+    ARGS.add_argument('--repeat', type=int, default=1000, help='Cached reads to time after the first one')
+    args = ARGS.parse_args()
+
+    for name, read in (('balances', balances), ('positions', positions), ('open_orders', open_orders)):
+        start = time.perf_counter()
+        results = read()
+        cold = time.perf_counter() - start
+        start = time.perf_counter()
+        for repeat in range(args.repeat):
+            read()
+        warm = (time.perf_counter() - start) / max(args.repeat, 1)
+        print('{0}: {1} rows, {2:.2f}ms from the database, {3:.4f}ms cached'.format(name, len(results),
+                                                                                    cold * 1000, warm * 1000))
+        for result in results:
+            print('  ' + ', '.join('{0}={1}'.format(key, value) for key, value in result._asdict().items()))
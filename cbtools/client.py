@@ -0,0 +1,82 @@
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from cbtools.metrics import registry, exchange_end_point
+from cbtools.ratelimit import (TokenBucket, EXCHANGE_PRIVATE_BURST, EXCHANGE_PRIVATE_RATE, EXCHANGE_PUBLIC_RATE,
+                               backoff_delay)
+from cbtools.utilities import CoinbaseExchangeAuthentication
+
+
+EXCHANGE_API_URL = 'https://api.gdax.com/'
+
+# Market data endpoints, which GDAX limits separately from, and more tightly
+# than, the private ones
+public_end_points = ('products', 'currencies', 'time')
+
+
+def pooled_session(pool_size=10):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+class ExchangeClient(object):
+    # One keep-alive connection pool, signing key and pair of rate limiters,
+    # private and public, shared by every call to the exchange API. A session
+    # passed in is used as is, so several clients can share its connection pool
+    def __init__(self, api_key, secret_key, passphrase, url=EXCHANGE_API_URL, pool_size=10, retries=5,
+                 limiter=None, session=None, public_limiter=None):
+        self.url = url
+        self.auth = CoinbaseExchangeAuthentication(api_key, secret_key, passphrase)
+        self.limiter = limiter or TokenBucket(EXCHANGE_PRIVATE_RATE, EXCHANGE_PRIVATE_BURST)
+        self.public_limiter = public_limiter or TokenBucket(EXCHANGE_PUBLIC_RATE)
+        self.retries = retries
+        if session is None:
+            session = pooled_session(pool_size)
+        self.session = session
+
+    def request(self, method, path, idempotent=False, **kwargs):
+        # A 429 means the request was turned away before being processed, so
+        # it is retried for any method; errors and 5xx only for idempotent ones.
+        # An idempotent request still turned away after the last retry raises
+        # HTTPError rather than passing the error body on as its result
+        end_point = exchange_end_point(path)
+        limiter = self.public_limiter if path.split('/')[0] in public_end_points else self.limiter
+        for attempt in range(self.retries + 1):
+            last_attempt = attempt == self.retries
+            limiter.acquire()
+            start = time.time()
+            try:
+                response = self.session.request(method, self.url + path, auth=self.auth, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if not idempotent or last_attempt:
+                    raise
+                registry.increment('cbtools_http_retries_total', end_point=end_point, reason='connection')
+                time.sleep(backoff_delay(attempt))
+                continue
+            registry.observe('cbtools_http_request_seconds', time.time() - start, method=method,
+                             end_point=end_point, status=response.status_code)
+            if not last_attempt and (response.status_code == 429 or
+                                     (idempotent and response.status_code >= 500)):
+                registry.increment('cbtools_http_retries_total', end_point=end_point,
+                                   reason=str(response.status_code))
+                limiter.throttle()
+                time.sleep(backoff_delay(attempt))
+                continue
+            if idempotent and (response.status_code == 429 or response.status_code >= 500):
+                response.raise_for_status()
+            limiter.recover()
+            return response
+
+    def get(self, path, params=None):
+        return self.request('GET', path, idempotent=True, params=params)
+
+    def post(self, path, json=None):
+        return self.request('POST', path, json=json)
+
+    def delete(self, path, params=None):
+        return self.request('DELETE', path, idempotent=True, params=params)
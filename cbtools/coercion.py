@@ -0,0 +1,123 @@
+import json
+from datetime import datetime, timezone
+from decimal import Decimal
+
+from dateutil.parser import isoparse
+from sqlalchemy import Boolean, DateTime, Integer, Numeric
+
+from cbtools import db_logger
+
+
+utc_suffixes = frozenset(['', 'Z', '+00:00', '+0000', '+00'])
+
+
+def parse_timestamp(value):
+    # The APIs send UTC timestamps like 2017-06-01T12:00:00Z or
+    # 2017-06-01T12:00:00.123456Z, which are sliced apart directly; anything
+    # else goes through dateutil
+    if value.__class__ is not str:
+        return value
+    if len(value) >= 19 and value[10] in 'T ':
+        try:
+            microsecond = 0
+            rest = value[19:]
+            if rest[:1] == '.':
+                end = 1
+                while end < len(rest) and rest[end].isdigit():
+                    end += 1
+                microsecond = int((rest[1:end] + '000000')[:6])
+                rest = rest[end:]
+            if rest in utc_suffixes:
+                return datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]), int(value[11:13]),
+                                int(value[14:16]), int(value[17:19]), microsecond, timezone.utc)
+        except ValueError:
+            pass
+    parsed = isoparse(value)
+    if parsed.tzinfo is None:
+        return parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc)
+
+
+def to_decimal(value):
+    if value.__class__ is Decimal:
+        return value
+    return Decimal(value if value.__class__ is str else str(value))
+
+
+def to_int(value):
+    if value.__class__ is int:
+        return value
+    return int(value)
+
+
+def to_bool(value):
+    if value.__class__ is bool:
+        return value
+    if isinstance(value, str):
+        return value.lower() == 'true'
+    return bool(value)
+
+
+def to_text(value):
+    if value.__class__ is str:
+        return value
+    elif isinstance(value, (dict, list)):
+        return json.dumps(value, sort_keys=True)
+    elif isinstance(value, bool):
+        # As Postgres would have cast it
+        return 'true' if value else 'false'
+    return str(value)
+
+
+def converter(column):
+    if isinstance(column.type, DateTime):
+        return parse_timestamp
+    elif isinstance(column.type, Numeric):
+        return to_decimal
+    elif isinstance(column.type, Boolean):
+        return to_bool
+    elif isinstance(column.type, Integer):
+        return to_int
+    else:
+        return to_text
+
+
+class CoercionPlan(object):
+    # The columns of one model, in table order, with the converter of each
+    # read off its SQLAlchemy type, so a denested document becomes a typed
+    # row in one pass over its keys
+    def __init__(self, Model):
+        self.Model = Model
+        self.columns = list(Model.__table__.columns)
+        self.keys = [column.key for column in self.columns]
+        self.positions = {key: position for position, key in enumerate(self.keys)}
+        self.converters = [converter(column) for column in self.columns]
+        self.missing_keys = set()
+
+    def row(self, document):
+        values = [None] * len(self.keys)
+        positions = self.positions
+        converters = self.converters
+        for key, value in document.items():
+            position = positions.get(key)
+            if position is None:
+                if key not in self.missing_keys:
+                    self.missing_keys.add(key)
+                    db_logger.error('{0} is missing from {1} table'.format(key, self.Model.__tablename__))
+                continue
+            if value is not None:
+                values[position] = converters[position](value)
+        return tuple(values)
+
+    def values(self, document):
+        return dict(zip(self.keys, self.row(document)))
+
+
+plans = {}
+
+
+def get_plan(Model):
+    plan = plans.get(Model)
+    if plan is None:
+        plan = plans[Model] = CoercionPlan(Model)
+    return plan
@@ -0,0 +1,216 @@
+import argparse
+import decimal
+import json
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime, time as day_start, timezone
+
+from sqlalchemy import select, or_, Boolean, DateTime, Integer, Numeric
+
+from cbtools.models import get_engine, Base
+from cbtools.reports import stream, CHUNK_SIZE
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+# Numeric columns are unconstrained in Postgres, so every one is exported
+# with room for 20 integer and 18 fractional digits
+NUMERIC_PRECISION = 38
+NUMERIC_SCALE = 18
+NUMERIC_QUANTUM = decimal.Decimal(1).scaleb(-NUMERIC_SCALE)
+NUMERIC_CONTEXT = decimal.Context(prec=NUMERIC_PRECISION)
+
+NULL_PARTITION = '__HIVE_DEFAULT_PARTITION__'
+STATE_FILE = '_export_state.json'
+PART_FILE = 'part-0.parquet'
+
+exportable_tables = OrderedDict((table.name, table) for table in Base.metadata.sorted_tables)
+
+
+def arrow_type(column):
+    if isinstance(column.type, Numeric):
+        return pyarrow.decimal128(NUMERIC_PRECISION, NUMERIC_SCALE)
+    elif isinstance(column.type, DateTime):
+        return pyarrow.timestamp('us', tz='UTC' if column.type.timezone else None)
+    elif isinstance(column.type, Boolean):
+        return pyarrow.bool_()
+    elif isinstance(column.type, Integer):
+        return pyarrow.int64()
+    else:
+        return pyarrow.string()
+
+
+def arrow_value(column, value):
+    if value is None:
+        return None
+    elif isinstance(column.type, Numeric):
+        return decimal.Decimal(value).quantize(NUMERIC_QUANTUM, context=NUMERIC_CONTEXT)
+    elif isinstance(column.type, (DateTime, Boolean, Integer)):
+        return value
+    return value if isinstance(value, str) else str(value)
+
+
+def partition_columns(table):
+    # Rows are split by the day they were created and then by product, or
+    # by account for the tables without one
+    if 'created_at' not in table.c:
+        return None, None
+    for key in ('product_id', 'account_id'):
+        if key in table.c:
+            return table.c.created_at, table.c[key]
+    return table.c.created_at, None
+
+
+def created_day(value):
+    if value is None:
+        return NULL_PARTITION
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc)
+    return value.date().isoformat()
+
+
+def file_columns(table):
+    # The partition key is in the path, as in a Hive layout, so it is left
+    # out of the files
+    date_column, key_column = partition_columns(table)
+    return [column for column in table.columns if key_column is None or column.key != key_column.key]
+
+
+def arrow_table(columns, schema, rows):
+    return pyarrow.Table.from_arrays(
+        [pyarrow.array([arrow_value(column, row[column.key]) for row in rows], type=field.type)
+         for column, field in zip(columns, schema)], schema=schema)
+
+
+def write_file(path, table):
+    # Written next to its final name and moved in place, so a reader never
+    # sees a partial file
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    pyarrow.parquet.write_table(table, path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+
+def export_rows(table, chunks, directory):
+    # Chunks come ordered by created_at, so the partitions of one day are
+    # complete, and written out, as soon as the next day's rows start
+    columns = file_columns(table)
+    schema = pyarrow.schema([pyarrow.field(column.key, arrow_type(column)) for column in columns])
+    date_column, key_column = partition_columns(table)
+    table_directory = os.path.join(directory, table.name)
+    rows = 0
+    partitions = 0
+    last_day = None
+
+    if date_column is None:
+        # Tables without created_at are small and rewritten whole
+        path = os.path.join(table_directory, PART_FILE)
+        if not os.path.exists(table_directory):
+            os.makedirs(table_directory)
+        with pyarrow.parquet.ParquetWriter(path + '.tmp', schema) as writer:
+            for chunk in chunks:
+                writer.write_table(arrow_table(columns, schema, chunk))
+                rows += len(chunk)
+        os.replace(path + '.tmp', path)
+        return rows, 1, None
+
+    pending = OrderedDict()
+    current_day = None
+
+    def flush():
+        for key, partition_rows in pending.items():
+            parts = ['created_date=' + current_day]
+            if key_column is not None:
+                parts.append('{0}={1}'.format(key_column.key, NULL_PARTITION if key is None else key))
+            write_file(os.path.join(table_directory, *parts + [PART_FILE]),
+                       arrow_table(columns, schema, partition_rows))
+        pending.clear()
+
+    for chunk in chunks:
+        for row in chunk:
+            day = created_day(row[date_column.key])
+            if day != current_day:
+                flush()
+                current_day = day
+                if day != NULL_PARTITION:
+                    last_day = day
+            key = row[key_column.key] if key_column is not None else None
+            if key not in pending:
+                partitions += 1
+                pending[key] = []
+            pending[key].append(row)
+            rows += 1
+    flush()
+    return rows, partitions, last_day
+
+
+def export_table(table, directory, since=None, chunk_size=CHUNK_SIZE):
+    # Days before the last exported one are left alone; that day itself is
+    # exported again, as it may have been incomplete the last time
+    statement = select([table])
+    date_column, key_column = partition_columns(table)
+    if date_column is not None:
+        if since is not None:
+            start = datetime.combine(datetime.strptime(since, '%Y-%m-%d').date(), day_start(tzinfo=timezone.utc))
+            statement = statement.where(or_(date_column >= start, date_column.is_(None)))
+        statement = statement.order_by(date_column.asc().nullslast())
+    return export_rows(table, stream(statement, chunk_size), directory)
+
+
+def load_state(directory):
+    path = os.path.join(directory, STATE_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as state_file:
+        return json.load(state_file)
+
+
+def save_state(directory, state):
+    path = os.path.join(directory, STATE_FILE)
+    with open(path + '.tmp', 'w') as state_file:
+        json.dump(state, state_file, indent=2, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def export(table_names, directory, full=False, chunk_size=CHUNK_SIZE):
+    if pyarrow is None:
+        raise Exception('Parquet exports require the pyarrow package')
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    state = {} if full else load_state(directory)
+    engine = get_engine()
+    for table_name in table_names:
+        table = exportable_tables[table_name]
+        if not engine.dialect.has_table(engine, table.name, schema=table.schema):
+            continue
+        start = time.time()
+        rows, partitions, last_day = export_table(table, directory, state.get(table_name), chunk_size)
+        if last_day is not None:
+            state[table_name] = last_day
+        save_state(directory, state)
+        yield table_name, rows, partitions, time.time() - start
+
+
+if __name__ == '__main__':
+    ARGS = argparse.ArgumentParser()
+    ARGS.add_argument('tables', nargs='*', default=[],
+                      help='Tables to export, all of them if none are given')
+    ARGS.add_argument('--output', dest='output', default='parquet',
+                      help='Directory of the exported tables, one subdirectory per table')
+    ARGS.add_argument('--full', action='store_true', dest='full', default=False,
+                      help='Export every partition again, not only those since the last export')
+    ARGS.add_argument('--chunk-size', type=int, dest='chunk_size', default=CHUNK_SIZE,
+                      help='Rows fetched from the server side cursor at a time')
+    args = ARGS.parse_args()
+    for table_name in args.tables:
+        if table_name not in exportable_tables:
+            ARGS.error('{0} is not a cbtools table'.format(table_name))
+
+    for table_name, rows, partitions, elapsed in export(args.tables or list(exportable_tables), args.output,
+                                                        args.full, args.chunk_size):
+        print('{0}: {1} rows in {2} partitions in {3:.2f}s'.format(table_name, rows, partitions, elapsed))
@@ -0,0 +1,19 @@
+from cbtools.models import session, SyncCursors
+
+
+# Every wallet endpoint and these exchange endpoints list records newest
+# first, so a run can stop once it reaches the newest record ingested by the
+# previous run. Exchange holds and orders change state long after they are
+# listed and are always walked in full.
+exchange_cursor_keys = {'ledger': lambda document: str(document['id']),
+                        'fills': lambda document: '{0}:{1}'.format(document['product_id'], document['trade_id'])}
+
+
+def load_cursors():
+    return {(cursor.account_id, cursor.end_point): cursor.cursor for cursor in session.query(SyncCursors)}
+
+
+def save_cursors(cursors):
+    for (account_id, end_point), cursor in cursors.items():
+        session.merge(SyncCursors(account_id=account_id, end_point=end_point, cursor=cursor))
+    session.commit()
@@ -0,0 +1,261 @@
+import argparse
+import json
+import logging
+import time
+from decimal import Decimal
+
+import websocket
+from sqlalchemy.exc import IntegrityError, ProgrammingError
+
+from cbtools import db_logger
+from cbtools.api import invalidate, OPEN_STATUSES
+from cbtools.loader import upsert
+from cbtools.metrics import registry
+from cbtools.models import session, ExchangeOrders, Fills
+
+
+FEED_URL = 'wss://ws-feed.gdax.com'
+FLUSH_INTERVAL = 0.25
+
+logger = logging.getLogger(__name__)
+
+# Order states as the REST orders endpoint reports them
+order_statuses = {'received': 'pending',
+                  'open': 'open',
+                  'done': 'done'}
+
+
+class FeedIngester(object):
+    # Turns the authenticated full/user channel messages for one profile into
+    # exchange_orders and fills rows, merged in memory and written every
+    # flush_interval seconds as one upsert per table
+    def __init__(self, client, product_ids, channels=('user', 'full'), url=FEED_URL,
+                 flush_interval=FLUSH_INTERVAL, dry_run=False, record=None):
+        self.client = client
+        self.product_ids = product_ids
+        self.channels = list(channels)
+        self.url = url
+        self.flush_interval = flush_interval
+        self.dry_run = dry_run
+        # A dry run touches no database, its own log records included
+        self.logger = logger if dry_run else db_logger
+        self.record = record
+        self.sequences = {}
+        self.own_orders = set()
+        self.orders = {}
+        self.fills = {}
+        self.accounts = {}
+        self.last_flush = time.time()
+        self.connection = None
+        self.messages = 0
+
+    def subscribe_message(self):
+        timestamp = str(time.time())
+        auth = self.client.auth
+        return {'type': 'subscribe', 'product_ids': self.product_ids, 'channels': self.channels,
+                'signature': auth.sign(timestamp, 'GET', '/users/self/verify').decode('utf-8'),
+                'key': auth.api_key, 'passphrase': auth.passphrase, 'timestamp': timestamp}
+
+    def account_id(self, product_id):
+        # Rows are filed under the account of the quote currency, which is
+        # the one the fill settles in
+        return self.accounts.get(product_id.split('-')[-1])
+
+    def add_order(self, order_id, **values):
+        order = self.orders.get(order_id)
+        if order is None:
+            order = self.orders[order_id] = {'id': order_id}
+        for key, value in values.items():
+            if value is not None:
+                order[key] = value
+
+    def handle(self, message):
+        message_type = message.get('type')
+        registry.increment('cbtools_feed_messages_total', type=message_type)
+        if message_type == 'error':
+            raise Exception('Feed error: {0} {1}'.format(message.get('message'), message.get('reason', '')))
+        product_id = message.get('product_id')
+        sequence = message.get('sequence')
+        if product_id is None or sequence is None:
+            return
+        last_sequence = self.sequences.get(product_id)
+        if last_sequence is not None:
+            if sequence <= last_sequence:
+                # Already seen, on the other channel or before a resync
+                return
+            if 'full' in self.channels and sequence > last_sequence + 1:
+                registry.increment('cbtools_feed_gaps_total', product_id=product_id)
+                self.logger.error('Feed gap on {0} from {1} to {2}'.format(product_id, last_sequence, sequence))
+                self.resync(product_id)
+        self.sequences[product_id] = sequence
+
+        own = message.get('profile_id') is not None or message.get('order_id') in self.own_orders
+        if message_type in order_statuses and own:
+            order_id = message['order_id']
+            self.own_orders.add(order_id)
+            self.add_order(order_id, product_id=product_id, account_id=self.account_id(product_id),
+                           status=order_statuses[message_type], side=message.get('side'),
+                           price=message.get('price'))
+            if message_type == 'received':
+                self.add_order(order_id, created_at=message['time'], type=message.get('order_type'),
+                               size=message.get('size'), funds=message.get('funds'))
+            elif message_type == 'done':
+                self.add_order(order_id, done_at=message['time'], done_reason=message.get('reason'))
+                self.own_orders.discard(order_id)
+        elif message_type == 'match':
+            self.add_match(message)
+
+    def add_match(self, message):
+        # Authenticated match messages name the profile of whichever side of
+        # the trade is ours
+        taker = message.get('taker_order_id') in self.own_orders or 'taker_profile_id' in message
+        maker = message.get('maker_order_id') in self.own_orders or 'maker_profile_id' in message
+        if not (taker or maker or message.get('profile_id') is not None):
+            return
+        if taker:
+            order_id = message['taker_order_id']
+            side = 'buy' if message['side'] == 'sell' else 'sell'
+            liquidity = 'T'
+        else:
+            order_id = message['maker_order_id']
+            side = message['side']
+            liquidity = 'M'
+        fee = None
+        fee_rate = message.get('taker_fee_rate' if taker else 'maker_fee_rate')
+        if fee_rate is not None:
+            fee = str(Decimal(message['size']) * Decimal(message['price']) * Decimal(fee_rate))
+        account_id = self.account_id(message['product_id'])
+        self.fills[(message['product_id'], message['trade_id'], account_id)] = {
+            'trade_id': message['trade_id'], 'created_at': message['time'], 'account_id': account_id,
+            'order_id': order_id, 'product_id': message['product_id'], 'price': message['price'],
+            'size': message['size'], 'side': side, 'liquidity': liquidity, 'fee': fee,
+            'profile_id': message.get('profile_id'), 'user_id': message.get('user_id'), 'resource': 'fill'}
+
+    def resync(self, product_id):
+        # Messages were lost, so the orders still open and the latest fills
+        # for the product are read back from REST and merged in
+        with registry.timer('cbtools_feed_resync_seconds', product_id=product_id):
+            orders = self.client.get('orders', params={'status': ['open', 'pending'],
+                                                       'product_id': product_id}).json()
+            for order in orders:
+                self.own_orders.add(order['id'])
+                self.add_order(order['id'], **{key: value for key, value in order.items()
+                                               if key in ExchangeOrders.__table__.columns})
+                self.add_order(order['id'], account_id=self.account_id(product_id))
+            # Orders that filled or were canceled during the gap are no
+            # longer listed as open, so they are read back one by one
+            listed = set(order['id'] for order in orders)
+            for order_id in sorted(self.open_order_ids(product_id) - listed):
+                response = self.client.get('orders/' + order_id)
+                if response.status_code == 404:
+                    # The exchange forgets orders canceled before any fill
+                    self.add_order(order_id, status='done', done_reason='canceled')
+                else:
+                    self.add_order(order_id, **{key: value for key, value in response.json().items()
+                                                if key in ExchangeOrders.__table__.columns})
+                self.own_orders.discard(order_id)
+            fills = self.client.get('fills', params={'product_id': product_id}).json()
+            for fill in fills:
+                account_id = self.account_id(product_id)
+                row = {key: value for key, value in fill.items() if key in Fills.__table__.columns}
+                row.update(account_id=account_id, resource='fill')
+                self.fills[(product_id, fill['trade_id'], account_id)] = row
+
+    def open_order_ids(self, product_id):
+        # The product's orders still open in the buffer, and in the table
+        # unless this is a dry run or a buffered message has closed them
+        order_ids = set(order_id for order_id, order in self.orders.items()
+                        if order.get('product_id') == product_id and order.get('status') in OPEN_STATUSES)
+        if not self.dry_run:
+            order_ids.update(order_id for order_id, in session.query(ExchangeOrders.id)
+                             .filter(ExchangeOrders.product_id == product_id)
+                             .filter(ExchangeOrders.status.in_(OPEN_STATUSES))
+                             if self.orders.get(order_id, {}).get('status', 'open') in OPEN_STATUSES)
+        return order_ids
+
+    def flush(self):
+        orders = list(self.orders.values())
+        fills = list(self.fills.values())
+        self.last_flush = time.time()
+        if not (orders or fills):
+            return
+        if self.dry_run:
+            self.orders = {}
+            self.fills = {}
+            registry.increment('cbtools_feed_rows_total', len(orders), table='exchange_orders')
+            registry.increment('cbtools_feed_rows_total', len(fills), table='fills')
+            return
+        try:
+            with registry.timer('cbtools_feed_flush_seconds'):
+                if orders:
+                    upsert(ExchangeOrders, orders, ['id'])
+                if fills:
+                    upsert(Fills, fills, ['trade_id', 'created_at', 'account_id'])
+                session.commit()
+        except (IntegrityError, ProgrammingError) as error:
+            # The rows stay buffered, merged with the messages that follow,
+            # and are written again by the next flush, e.g. once the sync
+            # has stored the exchange accounts they refer to
+            session.rollback()
+            registry.increment('cbtools_feed_flush_failures_total')
+            self.logger.error('Feed flush {0}, {1} orders and {2} fills kept for the next flush'.format(
+                type(error).__name__, len(orders), len(fills)))
+            return
+        self.orders = {}
+        self.fills = {}
+        registry.increment('cbtools_feed_rows_total', len(orders), table='exchange_orders')
+        registry.increment('cbtools_feed_rows_total', len(fills), table='fills')
+        if orders:
+            invalidate('exchange_orders', [order.get('account_id') for order in orders])
+
+    def load_accounts(self):
+        for account in self.client.get('accounts').json():
+            self.accounts[account['currency']] = account['id']
+
+    def run(self, max_messages=None):
+        self.load_accounts()
+        self.connection = websocket.create_connection(self.url, timeout=self.flush_interval)
+        self.connection.send(json.dumps(self.subscribe_message()))
+        try:
+            while max_messages is None or self.messages < max_messages:
+                try:
+                    raw_message = self.connection.recv()
+                except websocket.WebSocketTimeoutException:
+                    raw_message = None
+                except websocket.WebSocketConnectionClosedException:
+                    break
+                if raw_message:
+                    self.messages += 1
+                    if self.record:
+                        self.record.write(raw_message + '\n')
+                    self.handle(json.loads(raw_message))
+                if time.time() - self.last_flush >= self.flush_interval:
+                    self.flush()
+        finally:
+            self.flush()
+            self.connection.close()
+
+
+if __name__ == '__main__':
+    ARGS = argparse.ArgumentParser()
+    ARGS.add_argument('product_ids', nargs='+', help='Products to follow, e.g. BTC-USD')
+    ARGS.add_argument('--channels', nargs='+', default=['user', 'full'],
+                      help='Channels to subscribe to, sequence gaps are only detected on full')
+    ARGS.add_argument('--flush-ms', type=int, dest='flush_ms', default=int(FLUSH_INTERVAL * 1000),
+                      help='Milliseconds between batched writes')
+    ARGS.add_argument('--url', dest='url', default=FEED_URL)
+    ARGS.add_argument('--record', dest='record', default=None,
+                      help='Append every raw message to this file, for replaying with tests/fake_feed.py')
+    args = ARGS.parse_args()
+
+    from config import GDAX_API_KEY, GDAX_API_SECRET, GDAX_API_PASSPHRASE
+    from cbtools.client import ExchangeClient
+
+    exchange_client = ExchangeClient(GDAX_API_KEY, GDAX_API_SECRET, GDAX_API_PASSPHRASE)
+    record_file = open(args.record, 'a') if args.record else None
+    try:
+        FeedIngester(exchange_client, args.product_ids, args.channels, args.url, args.flush_ms / 1000.0,
+                     record=record_file).run()
+    finally:
+        if record_file:
+            record_file.close()
@@ -0,0 +1,160 @@
+from coinbase.wallet.model import Money
+
+
+SKIP = 0
+SCALAR = 1
+NESTED = 2
+LIMITS = 3
+MONEY = 4
+
+scalar_types = (str, bool, int, type(None))
+exact_scalar_types = frozenset(scalar_types)
+fee_scalar_types = (str, bool, type(None))
+fee_resources = ['buy', 'sell', 'deposit', 'withdrawal']
+
+
+class FlatteningPlan(object):
+    # The flattening decisions for one resource type, keyed on the key and
+    # value type of each field, made the first time they are seen and then
+    # reused for every following document of that resource
+    def __init__(self, resource):
+        self.resource = resource
+        self.kinds = {}
+        self.names = {}
+
+    def kind(self, key, value_type):
+        if key == 'json_doc':
+            kind = SKIP
+        elif issubclass(value_type, dict):
+            kind = NESTED
+        elif issubclass(value_type, scalar_types):
+            kind = SCALAR
+        else:
+            raise Exception('Unexpected {0} value for {1} in {2}'.format(value_type, key, self.resource))
+        self.kinds[(key, value_type)] = kind
+        return kind
+
+    def name(self, key, nested_key, nested_type):
+        if 'json_doc' in nested_key:
+            name = SKIP
+        elif issubclass(nested_type, list) and key == 'limits':
+            name = LIMITS
+        elif issubclass(nested_type, scalar_types):
+            if nested_key == 'amount':
+                name = key
+            else:
+                name = key + '_' + nested_key
+        elif issubclass(nested_type, Money):
+            name = MONEY
+        else:
+            raise Exception('Unexpected {0} value for {1}.{2} in {3}'.format(nested_type, key, nested_key,
+                                                                          self.resource))
+        return name
+
+
+plans = {}
+
+
+def get_plan(resource):
+    plan = plans.get(resource)
+    if plan is None:
+        plan = plans[resource] = FlatteningPlan(resource)
+    return plan
+
+
+def flatten_limits(json_document, limit_type, limits):
+    for limit in limits:
+        new_limit = {}
+        for limit_key, limit_value in limit.items():
+            if limit_key == 'json_doc':
+                continue
+            elif isinstance(limit_value, dict):
+                for nested_limit_key, nested_limit_value in limit_value.items():
+                    if nested_limit_key == 'json_doc':
+                        continue
+                    elif nested_limit_key == 'amount':
+                        new_limit[limit_key] = nested_limit_value
+                    else:
+                        new_limit[limit_key + '_' + nested_limit_key] = nested_limit_value
+            else:
+                new_limit[limit_key] = limit_value
+            new_limit['resource'] = 'limit'
+            new_limit['type'] = limit_type
+            new_limit['payment_method_id'] = json_document['id']
+        yield new_limit
+
+
+def flatten_fees(json_document, fees):
+    for fee in fees:
+        new_fee = {}
+        for fee_key, fee_value in fee.items():
+            if isinstance(fee_value, dict):
+                for nested_fee_key, nested_fee_value in fee_value.items():
+                    if nested_fee_key == 'amount':
+                        new_fee[fee_key] = nested_fee_value
+                    else:
+                        new_fee[fee_key + '_' + nested_fee_key] = nested_fee_value
+            elif isinstance(fee_value, fee_scalar_types):
+                new_fee[fee_key] = fee_value
+            else:
+                raise Exception('Unexpected {0} value for fee {1}'.format(type(fee_value), fee_key))
+        new_fee['resource'] = 'fee'
+        new_fee['source_id'] = json_document['id']
+        yield new_fee
+
+
+def flatten(json_document, account_id=None, resource=None):
+    if 'data' in json_document:
+        json_document = json_document['data']
+    if not isinstance(json_document, list):
+        json_documents = [json_document]
+    else:
+        json_documents = json_document
+    for json_document in json_documents:
+        plan = get_plan(json_document.get('resource'))
+        kinds = plan.kinds
+        names = plan.names
+        new_json_document = {}
+        for key, value in json_document.items():
+            value_type = value.__class__
+            if value_type in exact_scalar_types and key != 'json_doc':
+                new_json_document[key] = value
+                continue
+            kind = kinds.get((key, value_type))
+            if kind is None:
+                if issubclass(value_type, list) and key != 'json_doc':
+                    if json_document['resource'] not in fee_resources:
+                        raise Exception('Unexpected list value for {0} in {1}'.format(key, plan.resource))
+                    yield from flatten_fees(json_document, value)
+                    continue
+                kind = plan.kind(key, value_type)
+            if kind == SCALAR:
+                new_json_document[key] = value
+            elif kind == NESTED:
+                scalar_names = names.get(key)
+                if scalar_names is None:
+                    scalar_names = names[key] = {}
+                for nested_key, nested_value in value.items():
+                    nested_type = nested_value.__class__
+                    if nested_type in exact_scalar_types:
+                        name = scalar_names.get(nested_key)
+                        if name is None:
+                            name = scalar_names[nested_key] = plan.name(key, nested_key, nested_type)
+                    else:
+                        name = plan.name(key, nested_key, nested_type)
+                    if name.__class__ is str:
+                        new_json_document[name] = nested_value
+                    elif name == LIMITS:
+                        yield from flatten_limits(json_document, nested_key, nested_value)
+                    elif name == MONEY:
+                        for subnested_key, subnested_value in nested_value.items():
+                            new_json_document['_'.join([key, nested_key, subnested_key])] = subnested_value
+        if resource:
+            new_json_document['resource'] = resource
+        if account_id:
+            new_json_document['account_id'] = account_id
+        yield new_json_document
+
+
+def flatten_page(json_document, account_id=None, resource=None):
+    return list(flatten(json_document, account_id=account_id, resource=resource))
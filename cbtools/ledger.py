@@ -0,0 +1,133 @@
+import argparse
+from collections import namedtuple
+
+import numpy as np
+from sqlalchemy import func, tuple_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from cbtools.models import session, Entries, ExchangeAccounts, LedgerCheckpoints, LedgerGaps
+from cbtools.pnl import to_units, from_units
+
+
+# Ledger amounts and balances are replayed as integers of 1e-16 units, the
+# precision the exchange reports them in. int64 holds about 922 whole coins
+# of those, so the replay of an account whose balance or turnover goes past
+# that works on Python integers instead, exact but several times slower
+BALANCE_SCALE = 16
+
+AccountLedger = namedtuple('AccountLedger', ['account_id', 'currency', 'entries', 'gaps', 'missing', 'balance',
+                                             'account_balance', 'account_difference', 'replayed'])
+
+
+def to_balance_units(values):
+    return [to_units(value or 0, BALANCE_SCALE) for value in values]
+
+
+def find_gaps(opening_balance, amounts, balances):
+    # The stored balances minus the opening balance plus the running sum of
+    # the amounts only changes where entries are missing, or wrong, and by
+    # the amount that is missing there. Every running sum and difference is
+    # bounded by the opening balance, the amounts and the largest balance
+    bound = (abs(opening_balance) + sum(abs(amount) for amount in amounts) +
+             max([abs(balance) for balance in balances] or [0]))
+    dtype = np.int64 if bound < 2 ** 63 else object
+    amounts = np.array(amounts, dtype=dtype)
+    balances = np.array(balances, dtype=dtype)
+    computed = opening_balance + np.cumsum(amounts)
+    divergence = balances - computed
+    changes = np.diff(np.concatenate([np.zeros(1, dtype=divergence.dtype), divergence]))
+    return np.flatnonzero(changes), computed, changes
+
+
+def load_entries(account_id, checkpoint):
+    query = (session.query(Entries.id, Entries.created_at, Entries.amount, Entries.balance)
+             .filter(Entries.account_id == account_id)
+             .order_by(Entries.created_at, Entries.id))
+    if checkpoint is not None and checkpoint.last_created_at is not None:
+        query = query.filter(tuple_(Entries.created_at, Entries.id) >
+                             tuple_(checkpoint.last_created_at, checkpoint.last_id))
+    return query.all()
+
+
+def verified_entries(account_id, checkpoint):
+    return (session.query(func.count(Entries.id))
+            .filter(Entries.account_id == account_id)
+            .filter(tuple_(Entries.created_at, Entries.id) <=
+                    tuple_(checkpoint.last_created_at, checkpoint.last_id))
+            .scalar())
+
+
+def verify_account(account, rebuild=False):
+    checkpoint = session.query(LedgerCheckpoints).get(account.id)
+    replayed = rebuild
+    if (checkpoint is not None and not rebuild and checkpoint.last_created_at is not None
+            and verified_entries(account.id, checkpoint) != checkpoint.entries):
+        # Entries older than the checkpoint arrived after it was made, a
+        # backfilled window or a late sync, so the ledger is replayed from
+        # the start, which also drops the gaps they may have filled
+        replayed = True
+    if checkpoint is None or replayed:
+        session.query(LedgerGaps).filter(LedgerGaps.account_id == account.id).delete()
+        checkpoint = session.merge(LedgerCheckpoints(account_id=account.id, last_created_at=None, last_id=None,
+                                                     balance=0, entries=0))
+    entries = load_entries(account.id, checkpoint)
+    # Each run continues from the last stored balance it verified, so a gap
+    # is reported once, by the run that first sees the entries around it
+    opening_balance = to_units(checkpoint.balance or 0, BALANCE_SCALE)
+    gaps = []
+    if entries:
+        balances = to_balance_units(entry.balance for entry in entries)
+        indexes, computed, changes = find_gaps(opening_balance, to_balance_units(entry.amount for entry in entries),
+                                               balances)
+        for index in indexes:
+            entry = entries[index]
+            # The balance the previous stored balance and this entry's amount
+            # add up to
+            gaps.append({'account_id': account.id, 'entry_id': entry.id, 'created_at': entry.created_at,
+                         'computed_balance': from_units(int(balances[index]) - int(changes[index]), BALANCE_SCALE),
+                         'stored_balance': from_units(int(balances[index]), BALANCE_SCALE),
+                         'difference': from_units(int(changes[index]), BALANCE_SCALE)})
+        if gaps:
+            session.execute(pg_insert(LedgerGaps.__table__).values(gaps)
+                            .on_conflict_do_nothing(constraint='ledger_gaps_constraint'))
+        checkpoint.last_created_at = entries[-1].created_at
+        checkpoint.last_id = entries[-1].id
+        checkpoint.balance = entries[-1].balance or 0
+        checkpoint.entries = (checkpoint.entries or 0) + len(entries)
+
+    # The last stored balance of the ledger should be the account's balance
+    # as fetched in the same sync
+    checkpoint.account_balance = account.balance
+    checkpoint.account_difference = None
+    if account.balance is not None:
+        checkpoint.account_difference = account.balance - checkpoint.balance
+    return AccountLedger(account.id, account.currency, len(entries), gaps,
+                         sum(gap['difference'] for gap in gaps), checkpoint.balance, account.balance,
+                         checkpoint.account_difference, replayed)
+
+
+def run(account_ids=None, rebuild=False):
+    query = session.query(ExchangeAccounts).order_by(ExchangeAccounts.currency, ExchangeAccounts.id)
+    if account_ids:
+        query = query.filter(ExchangeAccounts.id.in_(account_ids))
+    results = [verify_account(account, rebuild) for account in query.all()]
+    session.commit()
+    return results
+
+
+if __name__ == '__main__':
+    ARGS = argparse.ArgumentParser()
+    ARGS.add_argument('--account', action='append', dest='account_ids', default=[],
+                      help='Exchange account id to verify, can be repeated, all accounts by default')
+    ARGS.add_argument('--rebuild', action='store_true', default=False,
+                      help='Discard the checkpoints and gaps found so far and replay every entry')
+    args = ARGS.parse_args()
+
+    for result in run(args.account_ids, args.rebuild):
+        print('{0} ({1}): {2} {3}entries, {4} gaps missing {5}, ledger balance {6}, account balance {7}{8}'
+              .format(result.account_id, result.currency, result.entries, '' if result.replayed else 'new ',
+                      len(result.gaps), result.missing, result.balance, result.account_balance,
+                      ', off by {0}'.format(result.account_difference) if result.account_difference else ''))
+        for gap in result.gaps:
+            print('  entry {0} at {1}: stored {2}, computed {3}'.format(
+                gap['entry_id'], gap['created_at'], gap['stored_balance'], gap['computed_balance']))
@@ -0,0 +1,404 @@
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from decimal import Decimal
+
+from sqlalchemy import (Boolean, Column, DateTime, Integer, MetaData, Numeric, String, Table, Text, and_, case, cast,
+                        exists, func, literal, true, union_all, select)
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import IntegrityError, ProgrammingError
+from sqlalchemy.orm.exc import FlushError
+
+from cbtools.coercion import get_plan
+from cbtools.metrics import registry
+from cbtools.models import session, ReconciliationExceptions
+from cbtools.storage import is_embedded
+from cbtools import models, db_logger
+
+
+resource_to_model = OrderedDict([('user', models.Users),
+                                ('account', models.Accounts),
+                                ('exchange_account', models.ExchangeAccounts),
+                                ('payment_method', models.PaymentMethods),
+                                ('address', models.Addresses),
+                                ('fill', [models.Fills, ('trade_id', 'created_at', 'account_id')]),
+                                ('hold', models.Holds),
+                                ('ledger', models.Entries),
+                                ('limit', [models.Limits, ('payment_method_id', 'type', 'period_in_days')]),
+                                ('order', models.Orders),
+                                ('exchange_order', models.ExchangeOrders),
+                                ('buy', models.Exchanges),
+                                ('deposit', models.Exchanges),
+                                ('sell', models.Exchanges),
+                                ('withdrawal', models.Exchanges),
+                                ('transaction', models.Transactions),
+                                ('fee', [models.Fees, ('source_id', 'fee_type')])])
+
+# Columns set by cbtools rather than read from the API, which are neither
+# hashed nor reconciled
+sync_columns = ('sync_profile', 'content_hash')
+
+# And the account a document was fetched under, which flatten adds to it
+context_columns = sync_columns + ('account_id',)
+
+# Tables of the current state the APIs report, balances and order statuses,
+# which a sync updates in place rather than reconciles against
+current_state_models = (models.Accounts, models.ExchangeAccounts, models.ExchangeOrders)
+
+
+def get_model(resource):
+    if isinstance(resource_to_model[resource], list):
+        return resource_to_model[resource][0], resource_to_model[resource][1]
+    else:
+        return resource_to_model[resource], None
+
+
+def build_record(Model, document):
+    return Model(**get_plan(Model).values(document))
+
+
+def version_text(value):
+    # How a typed value from an incoming document is written to the
+    # exceptions by both paths, timestamps in the APIs' own format
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return value.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+    return str(value)
+
+
+def reconcile(Model, query_keys, new_record):
+    # Both versions are typed, the new one by the model's coercion plan, so
+    # they compare directly; as in reconcile_batch, a typed column only
+    # raises an exception when the stored value is missing
+    query = session.query(Model)
+    for key in query_keys or ['id']:
+        query = query.filter(getattr(Model, key) == getattr(new_record, key))
+    old_record = query.one()
+    for column in Model.__table__.columns:
+        if column.key == 'id' or column.key in sync_columns:
+            continue
+        old_version = getattr(old_record, column.key)
+        new_version = getattr(new_record, column.key)
+        if old_version == new_version:
+            continue
+        elif not isinstance(column.type, String) and old_version is not None:
+            continue
+        old_version_type = str(type(old_version))
+        new_version_type = str(type(new_version))
+        if not isinstance(column.type, String):
+            new_version = version_text(new_version)
+        new_exception = ReconciliationExceptions()
+        new_exception.table_name = Model.__tablename__
+        new_exception.record_id = str(old_record.id)
+        new_exception.column_name = column.key
+        new_exception.old_version = old_version
+        new_exception.new_version = new_version
+        new_exception.old_version_type = old_version_type
+        new_exception.new_version_type = new_version_type
+        session.add(new_exception)
+        try:
+            session.commit()
+            registry.increment('cbtools_reconciliation_exceptions_total', table=Model.__tablename__)
+        except IntegrityError:
+            session.rollback()
+            db_logger.error('Commit New Reconciliation Exception IntegrityError')
+        except ProgrammingError:
+            session.rollback()
+            db_logger.error('Commit New Reconciliation Exception ProgrammingError')
+    if new_record.content_hash is not None and old_record.content_hash != new_record.content_hash:
+        # The stored hash follows the last document reconciled, so the same
+        # document is skipped on the next sync instead of reconciled again
+        old_record.content_hash = new_record.content_hash
+        try:
+            session.commit()
+        except ProgrammingError:
+            session.rollback()
+            db_logger.error('Commit {0} Content Hash ProgrammingError'.format(Model.__tablename__))
+
+
+def insert_record(Model, query_keys, new_record):
+    table = Model.__tablename__
+    try:
+        session.add(new_record)
+        with registry.timer('cbtools_db_commit_seconds', table=table):
+            session.commit()
+        registry.increment('cbtools_rows_inserted_total', table=table)
+    except (IntegrityError, FlushError):
+        session.rollback()
+        registry.increment('cbtools_conflicts_total', table=table)
+        reconcile(Model, query_keys, new_record)
+    except ProgrammingError:
+        session.rollback()
+        db_logger.error('Add {0} ProgrammingError'.format(Model.__tablename__))
+
+
+def insert(document):
+    Model, query_keys = get_model(document['resource'])
+    if Model in current_state_models:
+        load_current_state(Model, query_keys, [build_row(Model, query_keys, document)])
+        return
+    insert_record(Model, query_keys, build_record(Model, document))
+
+
+def build_row(Model, query_keys, document):
+    row = get_plan(Model).values(document)
+    if query_keys:
+        # Tables with a natural key leave their surrogate id to its sequence
+        del row['id']
+    return row
+
+
+def python_type_name(column):
+    # The name of the Python type the coercion plan gives a value of this
+    # column, so both paths record identical exceptions
+    if isinstance(column.type, DateTime):
+        return str(datetime)
+    elif isinstance(column.type, Numeric):
+        return str(Decimal)
+    elif isinstance(column.type, Boolean):
+        return str(bool)
+    elif isinstance(column.type, Integer):
+        return str(int)
+    else:
+        return str(str)
+
+
+def reconcile_batch(Model, query_keys, rows):
+    live = Model.__table__
+    # Typed columns come with their incoming values as text, formatted here
+    # as reconcile formats them
+    typed_keys = [column.key for column in live.columns if not isinstance(column.type, String)]
+    incoming = Table('incoming_' + Model.__tablename__, MetaData(),
+                     *([Column(column.key, column.type) for column in live.columns] +
+                       [Column(key + '_version_text', Text) for key in typed_keys]),
+                     prefixes=['TEMPORARY'], postgresql_on_commit='DROP')
+    rows = [dict(row, **{key + '_version_text': version_text(row.get(key)) for key in typed_keys}) for row in rows]
+    join_condition = and_(*[live.c[key] == incoming.c[key] for key in (query_keys or ['id'])])
+    none_type = str(type(None))
+    differences = []
+    for column in live.columns:
+        if column.key == 'id' or column.key in sync_columns:
+            continue
+        old_version = live.c[column.key]
+        new_version = incoming.c[column.key]
+        if isinstance(column.type, String):
+            is_exception = old_version.is_distinct_from(new_version)
+            new_version_text = new_version
+        else:
+            # Typed columns are only compared by value once both sides are
+            # set, which never produces an exception
+            is_exception = and_(old_version.is_(None), new_version.isnot(None))
+            new_version_text = incoming.c[column.key + '_version_text']
+        differences.append(
+            select([literal(Model.__tablename__).label('table_name'),
+                    cast(live.c.id, Text).label('record_id'),
+                    literal(column.key).label('column_name'),
+                    cast(old_version, Text).label('old_version'),
+                    new_version_text.label('new_version'),
+                    case([(old_version.is_(None), none_type)], else_=str(str)).label('old_version_type'),
+                    case([(new_version.is_(None), none_type)],
+                         else_=python_type_name(column)).label('new_version_type')])
+            .select_from(incoming.join(live, join_condition))
+            .where(is_exception))
+    differences = union_all(*differences).alias('differences')
+    exceptions = ReconciliationExceptions.__table__
+    statement = (pg_insert(exceptions)
+                 .from_select(['table_name', 'record_id', 'column_name', 'old_version', 'new_version',
+                               'old_version_type', 'new_version_type'],
+                             # SQLite would read ON CONFLICT right after the
+                             # FROM as the start of a join
+                             select([differences]).where(true()))
+                 .on_conflict_do_nothing(constraint='rec_exception_constraint'))
+    stale_hash = and_(join_condition, live.c.content_hash.is_distinct_from(incoming.c.content_hash))
+    embedded = is_embedded(session.get_bind())
+    if embedded:
+        # The same update without UPDATE ... FROM, which SQLite is not
+        # given here
+        refresh_hashes = (live.update()
+                          .values(content_hash=select([incoming.c.content_hash]).where(join_condition).as_scalar())
+                          .where(exists(select([incoming.c.content_hash]).where(stale_hash))))
+    else:
+        refresh_hashes = live.update().values(content_hash=incoming.c.content_hash).where(stale_hash)
+    try:
+        with registry.timer('cbtools_db_reconcile_seconds', table=Model.__tablename__):
+            if embedded:
+                # SQLite keeps temporary tables until the connection closes
+                incoming.drop(bind=session.connection(), checkfirst=True)
+            incoming.create(bind=session.connection())
+            session.execute(incoming.insert(), rows)
+            result = session.execute(statement)
+            session.execute(refresh_hashes)
+            session.commit()
+    except ProgrammingError:
+        session.rollback()
+        db_logger.error('Commit {0} Reconciliation Exceptions ProgrammingError'.format(Model.__tablename__))
+        return 0
+    registry.increment('cbtools_reconciliation_exceptions_total', result.rowcount, table=Model.__tablename__)
+    return result.rowcount
+
+
+def load_batch(Model, query_keys, rows):
+    statement = pg_insert(Model.__table__)
+    statement = statement.on_conflict_do_nothing(index_elements=list(query_keys or ['id']))
+    table = Model.__tablename__
+    try:
+        with registry.timer('cbtools_db_batch_seconds', table=table):
+            if is_embedded(session.get_bind()):
+                # In process, one prepared statement run for every row costs
+                # no round trips, and has no limit on the number of values
+                result = session.execute(statement, rows)
+            else:
+                result = session.execute(statement.values(rows))
+        with registry.timer('cbtools_db_commit_seconds', table=table):
+            session.commit()
+    except IntegrityError:
+        # A batch can fail on something other than the conflict target,
+        # e.g. a foreign key, so fall back to loading it one row at a time
+        session.rollback()
+        for row in rows:
+            insert_record(Model, query_keys, build_record(Model, row))
+        return
+    except ProgrammingError:
+        session.rollback()
+        db_logger.error('Bulk add {0} ProgrammingError'.format(Model.__tablename__))
+        return
+    registry.increment('cbtools_rows_inserted_total', result.rowcount, table=table)
+    if result.rowcount < len(rows):
+        registry.increment('cbtools_conflicts_total', len(rows) - result.rowcount, table=table)
+        reconcile_batch(Model, query_keys, rows)
+
+
+def upsert(Model, rows, conflict):
+    # A column the incoming row has no value for keeps the stored one, so
+    # partial rows, like those built from single feed messages or order
+    # acknowledgements, fill in a record over time
+    table = Model.__table__
+    keys = sorted(set().union(*rows))
+    statement = pg_insert(table).values([{key: row.get(key) for key in keys} for row in rows])
+    statement = statement.on_conflict_do_update(
+        index_elements=conflict,
+        set_=dict({key: func.coalesce(statement.excluded[key], table.c[key]) for key in keys if key not in conflict},
+                  # The row no longer matches the document its hash was of
+                  **({'content_hash': None} if 'content_hash' in table.c and 'content_hash' not in keys else {})))
+    session.execute(statement)
+
+
+def load_current_state(Model, query_keys, rows):
+    table = Model.__tablename__
+    try:
+        with registry.timer('cbtools_db_batch_seconds', table=table):
+            upsert(Model, rows, list(query_keys or ['id']))
+        with registry.timer('cbtools_db_commit_seconds', table=table):
+            session.commit()
+    except (IntegrityError, ProgrammingError):
+        session.rollback()
+        db_logger.error('Upsert {0} Error'.format(table), exc_info=True)
+        return
+    registry.increment('cbtools_rows_upserted_total', len(rows), table=table)
+
+
+def replace_holds(documents):
+    # The holds of every exchange account synced are fetched whole, so a
+    # stored hold the exchange no longer reports has been released. Returns
+    # the accounts whose holds were replaced
+    current = {document['id']: set() for document in documents if document['resource'] == 'exchange_account'}
+    for document in documents:
+        if document['resource'] == 'hold' and document.get('account_id') in current:
+            current[document['account_id']].add(document['id'])
+    Holds = models.Holds
+    for account_id, hold_ids in current.items():
+        query = session.query(Holds).filter(Holds.account_id == account_id)
+        if hold_ids:
+            query = query.filter(~Holds.id.in_(hold_ids))
+        released = query.delete(synchronize_session=False)
+        registry.increment('cbtools_holds_released_total', released)
+    session.commit()
+    return list(current)
+
+
+def content_hash(document):
+    # The flattened document with its keys in a fixed order, so the same
+    # record hashes the same on every sync; only the fields read from the
+    # API count, not the account the document was fetched under
+    normalized = {key: value for key, value in document.items() if key not in context_columns}
+    return hashlib.md5(json.dumps(normalized, sort_keys=True, separators=(',', ':'),
+                                  default=str).encode('utf-8')).hexdigest()
+
+
+def document_key(Model, key_columns, document):
+    # The key columns typed as they are stored, so they compare to the ones
+    # read back from the table
+    plan = get_plan(Model)
+    return tuple(None if document.get(key) is None else plan.converters[plan.positions[key]](document[key])
+                 for key in key_columns)
+
+
+def skip_unchanged(documents, chunk_size=1000):
+    # A document whose record is stored under the same key with the same
+    # hash is unchanged since it was last loaded or reconciled, and needs
+    # neither an insert nor a reconciliation. The stored hashes are looked
+    # up by the first key column, which every database can match with IN,
+    # and compared per full key
+    groups = OrderedDict()
+    for document in documents:
+        document['content_hash'] = content_hash(document)
+        Model, query_keys = get_model(document['resource'])
+        key_columns = list(query_keys or ['id'])
+        groups.setdefault(Model, (key_columns, []))[1].append(document)
+
+    unchanged = set()
+    for Model, (key_columns, group) in groups.items():
+        keys = [document_key(Model, key_columns, document) for document in group]
+        columns = [Model.__table__.c[key] for key in key_columns]
+        stored = {}
+        try:
+            first_values = sorted(set(key[0] for key in keys if key[0] is not None))
+            for offset in range(0, len(first_values), chunk_size):
+                query = select(columns + [Model.__table__.c.content_hash]).where(
+                    columns[0].in_(first_values[offset:offset + chunk_size]))
+                for row in session.execute(query):
+                    stored[tuple(row[:-1])] = row[-1]
+        except ProgrammingError:
+            session.rollback()
+            db_logger.error('Content hash lookup {0} ProgrammingError'.format(Model.__tablename__))
+        group_unchanged = [id(document) for key, document in zip(keys, group)
+                           if stored.get(key) == document['content_hash']]
+        unchanged.update(group_unchanged)
+        registry.increment('cbtools_documents_unchanged_total', len(group_unchanged), table=Model.__tablename__)
+        registry.increment('cbtools_documents_changed_total', len(group) - len(group_unchanged),
+                           table=Model.__tablename__)
+    return [document for document in documents if id(document) not in unchanged]
+
+
+def bulk_insert(documents, batch_size=1000):
+    groups = OrderedDict()
+    for resource in resource_to_model:
+        Model, query_keys = get_model(resource)
+        groups.setdefault(Model, (query_keys, []))
+    for document in documents:
+        Model, query_keys = get_model(document['resource'])
+        groups[Model][1].append(document)
+
+    total_rows = 0
+    total_start = time.time()
+    for Model, (query_keys, group) in groups.items():
+        if not group:
+            continue
+        start = time.time()
+        for offset in range(0, len(group), batch_size):
+            rows = [build_row(Model, query_keys, document)
+                    for document in group[offset:offset + batch_size]]
+            if Model in current_state_models:
+                load_current_state(Model, query_keys, rows)
+            else:
+                load_batch(Model, query_keys, rows)
+        elapsed = time.time() - start
+        total_rows += len(group)
+        print('{0}: {1} rows in {2:.2f}s ({3:.0f} rows/sec)'.format(Model.__tablename__, len(group), elapsed,
+                                                                   len(group) / max(elapsed, 1e-6)))
+    elapsed = time.time() - total_start
+    print('Total: {0} rows in {1:.2f}s ({2:.0f} rows/sec)'.format(total_rows, elapsed,
+                                                                  total_rows / max(elapsed, 1e-6)))
@@ -1,36 +1,211 @@
 import argparse
 import os
-
-import json
+import time
 from collections import OrderedDict
-from datetime import datetime
-from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 
 from coinbase.wallet.client import Client
-from dateutil.tz import tzlocal
-import requests
-from sqlalchemy import inspect
-from sqlalchemy.exc import IntegrityError, ProgrammingError
-from sqlalchemy.orm.exc import FlushError
 
-from cbtools.models import session, ReconciliationExceptions
+from cbtools.api import invalidate, invalidate_documents
+from cbtools.coercion import parse_timestamp
+from cbtools.cursors import exchange_cursor_keys, load_cursors, save_cursors
+from cbtools.loader import resource_to_model, insert, bulk_insert, replace_holds, skip_unchanged
+from cbtools.ratelimit import TokenBucket, WALLET_RATE, wallet_call
+from cbtools.flatten import flatten_page
+from cbtools.metrics import registry, exchange_end_point, profile
+from cbtools.spool import Spool
 from cbtools.utilities import denest_json
-from cbtools import models, db_logger
 
 
-def get_wallet_data(wallet_client, refresh):
-    denested_json_file = tmp_directory + 'denested_wallet_jsons.json'
-    if not os.path.exists(denested_json_file) or refresh:
-        denested_jsons = []
-        current_user = wallet_client.get_current_user()
-        denested_jsons += denest_json(current_user)
+tmp_directory = 'tmp/'
+
+# A backfill splits the history of these endpoints into windows of
+# created_at, and fills and orders also by product, each fetched as a shard
+# of its own
+backfill_end_points = ('ledger', 'orders', 'fills')
+backfill_by_product = ('orders', 'fills')
+# GDAX opened in January 2015
+BACKFILL_SINCE = '2015-01-01T00:00:00Z'
+
+
+def get_wallet_pages(wallet_client, limiter, end_point, account_id, cursor=None):
+    response = wallet_call(limiter, getattr(wallet_client, end_point), account_id)
+    while True:
+        page = response['data']
+        ids = [document['id'] for document in page]
+        if cursor in ids:
+            yield page[:ids.index(cursor)]
+            return
+        yield page
+        if not response.pagination['next_uri']:
+            return
+        starting_after = response.pagination['next_uri'].split('=')[-1]
+        response = wallet_call(limiter, getattr(wallet_client, end_point), account_id, starting_after=starting_after)
+
+
+def get_exchange_pages(client, end_point_path, params, cursor_key=None, cursor=None):
+    response = client.get(end_point_path, params=params)
+    while True:
+        page = response.json()
+        if cursor_key:
+            keys = [cursor_key(document) for document in page]
+            if cursor in keys:
+                yield page[:keys.index(cursor)]
+                return
+        yield page
+        if 'CB-AFTER' not in response.headers:
+            return
+        params['after'] = response.headers['CB-AFTER']
+        response = client.get(end_point_path, params=params)
+
+
+def spool_page(writer, end_point, page, account_id, resource=None, other_account_ids=()):
+    registry.increment('cbtools_pages_total', end_point=end_point)
+    registry.increment('cbtools_rows_fetched_total', len(page), end_point=end_point)
+    with registry.timer('cbtools_denest_seconds', end_point=end_point):
+        documents = flatten_page(page, account_id=account_id, resource=resource)
+        # A page fetched once for several accounts is filed under each
+        documents += [dict(document, account_id=other_account_id)
+                      for other_account_id in other_account_ids for document in documents]
+    with registry.timer('cbtools_spool_write_seconds', end_point=end_point):
+        writer.append(documents)
+
+
+def get_wallet_end_point(wallet_client, limiter, spool, end_point, account_id, cursor):
+    writer = spool.open_segment('{0}-{1}'.format(account_id, end_point))
+    new_cursor = None
+    for page in get_wallet_pages(wallet_client, limiter, end_point, account_id, cursor):
+        if page and new_cursor is None:
+            new_cursor = page[0]['id']
+        spool_page(writer, end_point, page, account_id)
+    writer.close(account_id=account_id, end_point=end_point, cursor=new_cursor)
+
+
+def exchange_request(end_point, account_id):
+    if end_point.endswith('s'):
+        resource = end_point[:-1]
+    else:
+        resource = end_point
+    params = {}
+    if end_point == 'orders':
+        # params['status'] = 'all'
+        params['status'] = ['open', 'pending', 'done']
+        end_point_path = 'orders'
+        resource = 'exchange_order'
+    elif end_point == 'fills':
+        end_point_path = 'fills'
+    else:
+        end_point_path = 'accounts/' + account_id + '/' + end_point
+    return end_point_path, params, resource
+
+
+def get_exchange_end_point(client, spool, end_point, account_id, cursor):
+    end_point_path, params, resource = exchange_request(end_point, account_id)
+    writer = spool.open_segment('{0}-{1}'.format(account_id, end_point))
+    new_cursor = None
+    for page in get_exchange_pages(client, end_point_path, params, exchange_cursor_keys.get(end_point), cursor):
+        if page and end_point in exchange_cursor_keys and new_cursor is None:
+            new_cursor = exchange_cursor_keys[end_point](page[0])
+        spool_page(writer, exchange_end_point(end_point_path), page, account_id, resource)
+    writer.close(account_id=account_id, end_point=end_point, cursor=new_cursor)
+
+
+def format_timestamp(moment):
+    return moment.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+def backfill_windows(since, until, windows):
+    step = (until - since) / windows
+    edges = [since + step * window for window in range(windows)] + [until]
+    return list(zip(edges[:-1], edges[1:]))
+
+
+def plan_windows(plan):
+    return backfill_windows(parse_timestamp(plan['since']), parse_timestamp(plan['until']), plan['windows'])
+
+
+def shard_name(account_id, end_point, product_id, window):
+    return '{0}-{1}-{2}-{3}'.format(account_id or 'profile', end_point, product_id or 'all', window)
+
+
+def get_exchange_shard(client, spool, name, end_point, account_ids, product_id, start, end):
+    # Ledger shards are fetched for one account; orders and fills, which
+    # the exchange lists for the whole profile, once for every account
+    # being backfilled
+    account_id = account_ids[0]
+    end_point_path, params, resource = exchange_request(end_point, account_id)
+    params['start_date'] = format_timestamp(start)
+    params['end_date'] = format_timestamp(end)
+    if product_id is not None:
+        params['product_id'] = product_id
+    writer = spool.open_segment(name)
+    newest = None
+    for page in get_exchange_pages(client, end_point_path, params):
+        # Both dates are inclusive, so a row created on the edge between two
+        # windows comes back in both and is only kept by the later one
+        in_window = [document for document in page if start <= parse_timestamp(document['created_at']) < end]
+        if in_window and newest is None:
+            newest = in_window[0]
+        spool_page(writer, exchange_end_point(end_point_path), in_window, account_id, resource, account_ids[1:])
+        if page and parse_timestamp(page[-1]['created_at']) < start:
+            # Pages are newest first, the rest is older than the window
+            break
+    metadata = {}
+    if newest is not None:
+        metadata['newest_at'] = newest['created_at']
+        if end_point in exchange_cursor_keys:
+            metadata['newest_cursor'] = exchange_cursor_keys[end_point](newest)
+    writer.close(account_id=account_id, end_point=end_point, **metadata)
+
+
+def finish_backfill(spool, account_id, end_point, shards):
+    # The endpoint's own segment is written once every shard is, empty but
+    # with the cursor of the newest row, so the next sync only fetches what
+    # is newer
+    entries = [spool.entry(name) for name in shards]
+    entries = [entry for entry in entries if entry.get('newest_at')]
+    cursor = None
+    if entries:
+        cursor = max(entries, key=lambda entry: parse_timestamp(entry['newest_at'])).get('newest_cursor')
+    spool.write_segment('{0}-{1}'.format(account_id, end_point), [], account_id=account_id, end_point=end_point,
+                        cursor=cursor)
+
+
+def run_tasks(tasks, workers):
+    # Pages of one endpoint are fetched in sequence by a single task, tasks
+    # for different accounts and endpoints run side by side
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(*task) for task in tasks]
+        for future in futures:
+            future.result()
+
+
+def read_spool(spool, cursors):
+    for entry in spool.entries():
+        if entry.get('cursor') is not None:
+            cursors[(entry['account_id'], entry['end_point'])] = entry['cursor']
+    return spool.read()
+
+
+def get_wallet_data(wallet_client, limiter, refresh, cursors, workers=1, directory=None):
+    spool = Spool(os.path.join(directory or tmp_directory, 'wallet'))
+    if refresh and spool.is_complete():
+        spool.reset()
+    if not spool.is_complete():
+        if not spool.has_segment('user'):
+            current_user = wallet_call(limiter, wallet_client.get_current_user)
+            spool.write_segment('user', denest_json(current_user))
 
-        wallet_accounts = wallet_client.get_accounts()
-        denested_jsons += denest_json(wallet_accounts)
+        wallet_accounts = wallet_call(limiter, wallet_client.get_accounts)
+        if not spool.has_segment('accounts'):
+            spool.write_segment('accounts', denest_json(wallet_accounts))
 
-        payment_methods = wallet_client.get_payment_methods()
-        denested_jsons += denest_json(payment_methods)
+        if not spool.has_segment('payment_methods'):
+            payment_methods = wallet_call(limiter, wallet_client.get_payment_methods)
+            spool.write_segment('payment_methods', denest_json(payment_methods))
 
+        tasks = []
         for wallet_account in wallet_accounts['data']:
             for end_point, function in [('get_buys', 'update_exchange'),
                                         ('get_sells', 'update_exchange'),
@@ -38,159 +213,127 @@ def get_wallet_data(wallet_client, refresh):
                                         ('get_withdrawals', 'update_exchange'),
                                         ('get_addresses', 'update_address'),
                                         ('get_transactions', 'update_transaction')]:
-                response = getattr(wallet_client, end_point)(wallet_account['id'])
-                denested_jsons += denest_json(response, account_id=wallet_account['id'])
-                while response.pagination['next_uri']:
-                    starting_after = response.pagination['next_uri'].split('=')[-1]
-                    response = getattr(wallet_client, end_point)(wallet_account['id'], starting_after=starting_after)
-                    denested_jsons += denest_json(response, account_id=wallet_account['id'])
-        with open(denested_json_file, 'w') as json_file:
-            json.dump(denested_jsons, json_file, indent=4, sort_keys=True)
-    else:
-        with open(denested_json_file, 'r') as json_file:
-            denested_jsons = json.load(json_file)
-    return denested_jsons
+                if spool.has_segment('{0}-{1}'.format(wallet_account['id'], end_point)):
+                    continue
+                tasks.append((get_wallet_end_point, wallet_client, limiter, spool, end_point,
+                              wallet_account['id'], cursors.get((wallet_account['id'], end_point))))
+        run_tasks(tasks, workers)
+        spool.mark_complete()
+    return read_spool(spool, cursors)
 
 
-def get_exchange_data(auth, url, refresh):
-    denested_json_file = tmp_directory + 'denested_exchange_jsons.json'
-    if not os.path.exists(denested_json_file) or refresh:
-        denested_jsons = []
-        exchange_accounts = requests.get(url + 'accounts', auth=auth).json()
-        denested_jsons += denest_json(exchange_accounts, resource='exchange_account')
+def get_exchange_data(client, refresh, cursors, workers=1, directory=None, backfill=0, backfill_since=None,
+                      backfill_until=None):
+    spool = Spool(os.path.join(directory or tmp_directory, 'exchange'))
+    if refresh and spool.is_complete():
+        spool.reset()
+    if not spool.is_complete():
+        exchange_accounts = client.get('accounts').json()
+        if not spool.has_segment('accounts'):
+            spool.write_segment('accounts', denest_json(exchange_accounts, resource='exchange_account'))
+        if backfill and not spool.has_segment('backfill'):
+            # The windows are kept with the spool, so a resumed backfill
+            # skips the shards it already has
+            until = backfill_until or format_timestamp(datetime.now(timezone.utc))
+            spool.write_segment('backfill', [], since=backfill_since or BACKFILL_SINCE, until=until,
+                                windows=backfill)
+        plan = spool.entry('backfill')
+        tasks = []
+        backfills = []
+        # The accounts whose orders and fills are backfilled, by endpoint
+        by_product = OrderedDict()
         for exchange_account in exchange_accounts:
             for end_point, function in [('ledger', 'update_entry'),
                                         ('holds', 'update_hold'),
                                         ('orders', 'update_exchange_order'),
                                         ('fills', 'update_fill')]:
-                if end_point.endswith('s'):
-                    resource = end_point[:-1]
-                else:
-                    resource = end_point
-                params = {}
-                if end_point == 'orders':
-                    # params['status'] = 'all'
-                    params['status'] = ['open', 'pending', 'done']
-                    end_point_url = url + 'orders'
-                    resource = 'exchange_order'
-                elif end_point == 'fills':
-                    end_point_url = url + 'fills'
-                else:
-                    end_point_url = url + 'accounts/' + exchange_account['id'] + '/' + end_point
-                response = requests.get(end_point_url, auth=auth, params=params)
-                denested_jsons += denest_json(response.json(), account_id=exchange_account['id'], resource=resource)
-                while 'CB-AFTER' in response.headers:
-                    starting_after = response.headers['CB-AFTER']
-                    params['after'] = starting_after
-                    response = requests.get(end_point_url, params=params, auth=auth)
-                    denested_jsons += denest_json(response.json(), account_id=exchange_account['id'], resource=resource)
-                with open(denested_json_file, 'w') as json_file:
-                    json.dump(denested_jsons, json_file, indent=4, sort_keys=True)
-    else:
-        with open(denested_json_file, 'r') as json_file:
-            denested_jsons = json.load(json_file)
-    return denested_jsons
-
-
-resource_to_model = OrderedDict([('user', models.Users),
-                                ('account', models.Accounts),
-                                ('exchange_account', models.ExchangeAccounts),
-                                ('payment_method', models.PaymentMethods),
-                                ('address', models.Addresses),
-                                ('fill', [models.Fills, ('trade_id', 'created_at', 'account_id')]),
-                                ('hold', models.Holds),
-                                ('ledger', models.Entries),
-                                ('limit', [models.Limits, ('payment_method_id', 'type', 'period_in_days')]),
-                                ('order', models.Orders),
-                                ('exchange_order', models.ExchangeOrders),
-                                ('buy', models.Exchanges),
-                                ('deposit', models.Exchanges),
-                                ('sell', models.Exchanges),
-                                ('withdrawal', models.Exchanges),
-                                ('transaction', models.Transactions),
-                                ('fee', [models.Fees, ('source_id', 'fee_type')])])
-
-
-def insert(document):
-    if isinstance(resource_to_model[document['resource']], list):
-        Model = resource_to_model[document['resource']][0]
-        query_keys = resource_to_model[document['resource']][1]
-    else:
-        Model = resource_to_model[document['resource']]
-        query_keys = None
-    new_record = Model()
-    for key in document:
-        if hasattr(new_record, key):
-            if isinstance(document[key], dict):
-                setattr(new_record, key, json.loads(str(document[key])))
-            else:
-                setattr(new_record, key, document[key])
-        else:
-            db_logger.error('{0} is missing from {1} table'.format(key, Model.__tablename__))
-            continue
-    try:
-        session.add(new_record)
-        session.commit()
-    except (IntegrityError, FlushError):
-        session.rollback()
-        if not query_keys:
-            old_record = session.query(Model).filter(Model.id == new_record.id).one()
-        elif len(query_keys) == 2:
-            old_record = (session.query(Model)
-                          .filter(getattr(Model, query_keys[0]) == getattr(new_record, query_keys[0]))
-                          .filter(getattr(Model, query_keys[1]) == getattr(new_record, query_keys[1])).one())
-        elif len(query_keys) == 3:
-            old_record = (session.query(Model)
-                          .filter(getattr(Model, query_keys[0]) == getattr(new_record, query_keys[0]))
-                          .filter(getattr(Model, query_keys[1]) == getattr(new_record, query_keys[1]))
-                          .filter(getattr(Model, query_keys[2]) == getattr(new_record, query_keys[2])).one())
-        for column in inspect(Model).attrs:
-            if column.key == 'id':
-                continue
-            old_version = getattr(old_record, column.key)
-            new_version = getattr(new_record, column.key)
-            if old_version == new_version:
-                continue
-            elif isinstance(old_version, datetime):
-                try:
-                    new_version_datetime = datetime.strptime(new_version, '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=tzlocal())
-                except ValueError:
-                    new_version_datetime = (datetime.strptime(new_version, '%Y-%m-%dT%H:%M:%S.%fZ')
-                                            .replace(tzinfo=tzlocal()))
-                if new_version_datetime == old_version:
+                if spool.has_segment('{0}-{1}'.format(exchange_account['id'], end_point)):
                     continue
-            elif isinstance(old_version, Decimal):
-                new_version_decimal = Decimal(new_version)
-                if new_version_decimal == old_version:
+                cursor = cursors.get((exchange_account['id'], end_point))
+                if plan is None or end_point not in backfill_end_points or cursor is not None:
+                    tasks.append((get_exchange_end_point, client, spool, end_point, exchange_account['id'], cursor))
                     continue
-            elif isinstance(old_version, int):
-                print(old_version)
-                print(new_version)
-                print(type(old_version))
-                new_version_int = int(new_version)
-                if new_version_int == old_version:
+                # Only endpoints without a cursor, whose whole history is
+                # fetched, are backfilled
+                if end_point in backfill_by_product:
+                    by_product.setdefault(end_point, []).append(exchange_account['id'])
                     continue
-            elif str(old_version) != str(new_version):
-                new_exception = ReconciliationExceptions()
-                new_exception.table_name = Model.__tablename__
-                new_exception.record_id = old_record.id
-                new_exception.column_name = column.key
-                new_exception.old_version = old_version
-                new_exception.new_version = new_version
-                new_exception.old_version_type = type(old_version)
-                new_exception.new_version_type = type(new_version)
-                session.add(new_exception)
-                try:
-                    session.commit()
-                except IntegrityError:
-                    session.rollback()
-                    db_logger.error('Commit New Reconciliation Exception IntegrityError')
-                except ProgrammingError:
-                    session.rollback()
-                    db_logger.error('Commit New Reconciliation Exception ProgrammingError')
-    except ProgrammingError:
-        session.rollback()
-        db_logger.error('Add {0} ProgrammingError'.format(Model.__tablename__))
+                shards = []
+                for window, (start, end) in enumerate(plan_windows(plan)):
+                    name = shard_name(exchange_account['id'], end_point, None, window)
+                    shards.append(name)
+                    if not spool.has_segment(name):
+                        tasks.append((get_exchange_shard, client, spool, name, end_point, [exchange_account['id']],
+                                      None, start, end))
+                backfills.append((exchange_account['id'], end_point, shards))
+        if by_product:
+            # Orders and fills are not scoped to the account, so each product
+            # shard is fetched once for the profile and its rows filed under
+            # every account, as a full sync files them
+            product_ids = [product['id'] for product in client.get('products').json()]
+        for end_point, account_ids in by_product.items():
+            shards = []
+            for product_id in product_ids:
+                for window, (start, end) in enumerate(plan_windows(plan)):
+                    name = shard_name(None, end_point, product_id, window)
+                    shards.append(name)
+                    if not spool.has_segment(name):
+                        tasks.append((get_exchange_shard, client, spool, name, end_point, account_ids, product_id,
+                                      start, end))
+            backfills += [(account_id, end_point, shards) for account_id in account_ids]
+        run_tasks(tasks, workers)
+        for account_id, end_point, shards in backfills:
+            finish_backfill(spool, account_id, end_point, shards)
+        spool.mark_complete()
+    return read_spool(spool, cursors)
+
+
+def sync(wallet_client=None, wallet_limiter=None, exchange_client=None, refresh=False, full=False, bulk=False,
+         batch_size=1000, workers=1, directory=None, sync_profile=None, backfill=0, backfill_since=None):
+    json_docs = []
+    cursors = {} if full else load_cursors()
+    if wallet_client is not None:
+        with registry.timer('cbtools_stage_seconds', stage='wallet'):
+            json_docs += get_wallet_data(wallet_client, wallet_limiter, refresh, cursors, workers, directory)
+    if exchange_client is not None:
+        with registry.timer('cbtools_stage_seconds', stage='exchange'):
+            json_docs += get_exchange_data(exchange_client, refresh, cursors, workers, directory, backfill,
+                                           backfill_since)
+
+    stats = {}
+    for doc in json_docs:
+        if sync_profile is not None:
+            # Rows of every profile share the same tables, tagged with the
+            # profile they were synced for
+            doc['sync_profile'] = sync_profile
+        if doc['resource'] in stats:
+            stats[doc['resource']] += 1
+        else:
+            stats[doc['resource']] = 1
+    for resource, count in stats.items():
+        registry.increment('cbtools_documents_total', count, resource=resource)
+
+    fetched_docs = json_docs
+    with registry.timer('cbtools_stage_seconds', stage='compare'):
+        json_docs = skip_unchanged(json_docs)
+
+    with registry.timer('cbtools_stage_seconds', stage='load'):
+        if bulk:
+            bulk_insert(json_docs, batch_size=batch_size)
+        else:
+            order_of_documents = [key for key in resource_to_model]
+
+            json_docs = sorted(json_docs, key=lambda i: order_of_documents.index(i['resource']))
+
+            for doc in json_docs:
+                insert(doc)
+        # Unchanged holds are skipped above, the snapshot is all of them
+        replaced = replace_holds(fetched_docs)
+
+    save_cursors(cursors)
+    invalidate_documents(json_docs)
+    invalidate('holds', replaced)
+    return stats
 
 
 if __name__ == '__main__':
@@ -200,36 +343,58 @@ if __name__ == '__main__':
     ARGS.add_argument('--e', action='store_true', dest='exchange',
                       default=True, help='Load Coinbase Exchange Data into the database')
     ARGS.add_argument('--r', action='store_true', dest='refresh', default=False, help='Refresh the data')
+    ARGS.add_argument('--bulk', action='store_true', dest='bulk', default=False,
+                      help='Load the data with batched INSERT ... ON CONFLICT statements')
+    ARGS.add_argument('--batch-size', type=int, dest='batch_size', default=1000,
+                      help='Number of rows per batch when loading with --bulk')
+    ARGS.add_argument('--workers', type=int, dest='workers', default=1,
+                      help='Number of accounts and endpoints to fetch concurrently')
+    ARGS.add_argument('--pool-size', type=int, dest='pool_size', default=10,
+                      help='Number of keep-alive connections to the exchange API')
+    ARGS.add_argument('--full', action='store_true', dest='full', default=False,
+                      help='Ignore the saved pagination cursors and refresh the full history')
+    ARGS.add_argument('--backfill', type=int, dest='backfill', default=0,
+                      help='Fetch the ledger, fills and orders without a saved cursor as this many windows of '
+                           'history, per product for fills and orders, in parallel shards')
+    ARGS.add_argument('--backfill-since', dest='backfill_since', default=BACKFILL_SINCE,
+                      help='Start of the first backfill window, rows created before it are not fetched')
+    ARGS.add_argument('--wallet-url', dest='wallet_url', default=None,
+                      help='Root of the wallet API to sync from instead of Coinbase, e.g. tests/fake_server.py')
+    ARGS.add_argument('--exchange-url', dest='exchange_url', default=None,
+                      help='Root of the exchange API to sync from instead of GDAX')
+    ARGS.add_argument('--metrics-file', dest='metrics_file', default=None,
+                      help='Write the run\'s metrics to this file at the end of the sync, - for stdout')
+    ARGS.add_argument('--metrics-format', dest='metrics_format', choices=['prometheus', 'json'],
+                      default='prometheus', help='Prometheus textfile or JSON summary')
+    ARGS.add_argument('--profile', dest='profile', choices=['cprofile', 'pyinstrument'], default=None,
+                      help='Profile the sync')
+    ARGS.add_argument('--profile-file', dest='profile_file', default=None,
+                      help='Save the profile to this file instead of printing it')
     args = ARGS.parse_args()
-    tmp_directory = 'tmp/'
     if not os.path.exists(tmp_directory):
         os.mkdir(tmp_directory)
-    json_docs = []
-    if args.wallet:
-        from config import COINBASE_KEY, COINBASE_SECRET
+    start = time.time()
+    with profile(args.profile, args.profile_file):
+        coinbase_wallet_client = wallet_limiter = exchange_client = None
+        if args.wallet:
+            from config import COINBASE_KEY, COINBASE_SECRET
 
-        coinbase_wallet_client = Client(COINBASE_KEY, COINBASE_SECRET)
-        json_docs += get_wallet_data(coinbase_wallet_client, args.refresh)
-    if args.exchange:
-        from config import (GDAX_API_KEY, GDAX_API_SECRET, GDAX_API_PASSPHRASE)
-        from cbtools.utilities import CoinbaseExchangeAuthentication
+            coinbase_wallet_client = Client(COINBASE_KEY, COINBASE_SECRET,
+                                            **({'base_api_uri': args.wallet_url} if args.wallet_url else {}))
+            wallet_limiter = TokenBucket(WALLET_RATE)
+        if args.exchange:
+            from config import (GDAX_API_KEY, GDAX_API_SECRET, GDAX_API_PASSPHRASE)
+            from cbtools.client import ExchangeClient
 
-        exchange_api_url = 'https://api.gdax.com/'
-        exchange_auth = CoinbaseExchangeAuthentication(GDAX_API_KEY, GDAX_API_SECRET,
-                                                       GDAX_API_PASSPHRASE)
-
-        json_docs += get_exchange_data(exchange_auth, exchange_api_url, args.refresh)
-
-    stats = {}
-    for doc in json_docs:
-        if doc['resource'] in stats:
-            stats[doc['resource']] += 1
-        else:
-            stats[doc['resource']] = 1
-
-    order_of_documents = [key for key in resource_to_model]
-
-    json_docs = sorted(json_docs, key=lambda i: order_of_documents.index(i['resource']))
-
-    for doc in json_docs:
-        insert(doc)
+            exchange_client = ExchangeClient(GDAX_API_KEY, GDAX_API_SECRET, GDAX_API_PASSPHRASE,
+                                             pool_size=args.pool_size,
+                                             **({'url': args.exchange_url} if args.exchange_url else {}))
+        sync(coinbase_wallet_client, wallet_limiter, exchange_client, args.refresh, args.full, args.bulk,
+             args.batch_size, args.workers, backfill=args.backfill, backfill_since=args.backfill_since)
+        changed = registry.total('cbtools_documents_changed_total')
+        fetched = changed + registry.total('cbtools_documents_unchanged_total')
+        print('Changed: {0} of {1} documents ({2:.1f}%), {3} unchanged skipped'.format(
+            changed, fetched, 100.0 * changed / max(fetched, 1), fetched - changed))
+    registry.observe('cbtools_stage_seconds', time.time() - start, stage='total')
+    if args.metrics_file:
+        registry.write(args.metrics_file, args.metrics_format)
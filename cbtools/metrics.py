@@ -0,0 +1,179 @@
+import bisect
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram(object):
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self):
+        total = 0
+        for count in self.counts:
+            total += count
+            yield total
+
+
+class Registry(object):
+    # Counters and histograms keyed on a metric name and its labels, shared
+    # by every thread of a sync and written out once at the end of the run
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = OrderedDict()
+        self.histograms = OrderedDict()
+
+    def increment(self, name, value=1, **labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def total(self, name):
+        # A counter summed over all of its labels
+        with self.lock:
+            return sum(value for (key, labels), value in self.counters.items() if key == name)
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def to_prometheus(self):
+        lines = []
+        with self.lock:
+            names = set()
+            for (name, labels), value in sorted(self.counters.items()):
+                if name not in names:
+                    names.add(name)
+                    lines.append('# TYPE {0} counter'.format(name))
+                lines.append('{0}{1} {2}'.format(name, format_labels(labels), value))
+            for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+                if name not in names:
+                    names.add(name)
+                    lines.append('# TYPE {0} histogram'.format(name))
+                bounds = [str(bucket) for bucket in histogram.buckets] + ['+Inf']
+                for bound, count in zip(bounds, histogram.cumulative_counts()):
+                    lines.append('{0}_bucket{1} {2}'.format(name, format_labels(labels + (('le', bound),)), count))
+                lines.append('{0}_sum{1} {2}'.format(name, format_labels(labels), histogram.sum))
+                lines.append('{0}_count{1} {2}'.format(name, format_labels(labels), histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    def to_json(self):
+        summary = OrderedDict([('counters', []), ('histograms', [])])
+        with self.lock:
+            for (name, labels), value in self.counters.items():
+                summary['counters'].append(OrderedDict([('name', name), ('labels', dict(labels)),
+                                                        ('value', value)]))
+            for (name, labels), histogram in self.histograms.items():
+                summary['histograms'].append(OrderedDict([('name', name), ('labels', dict(labels)),
+                                                          ('count', histogram.count), ('sum', histogram.sum),
+                                                          ('mean', histogram.sum / histogram.count)]))
+        return json.dumps(summary, indent=4) + '\n'
+
+    def write(self, path, metrics_format='prometheus'):
+        if metrics_format == 'json':
+            output = self.to_json()
+        else:
+            output = self.to_prometheus()
+        if path == '-':
+            print(output, end='')
+            return
+        # Written next to the target and renamed over it, so a textfile
+        # collector never reads a half written file
+        temporary_path = path + '.tmp'
+        with open(temporary_path, 'w') as metrics_file:
+            metrics_file.write(output)
+        os.replace(temporary_path, path)
+
+
+def label_key(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for key, value in labels) + '}'
+
+
+def exchange_end_point(path):
+    # accounts/<id>/ledger is one endpoint whichever account it is fetched
+    # for, and the same goes for products/<id>/ticker and orders/<id>
+    parts = path.split('/')
+    if len(parts) == 3:
+        return parts[0] + '/' + parts[2]
+    elif len(parts) == 2:
+        return parts[0] + '/id'
+    return path
+
+
+@contextmanager
+def profile(profiler, output=None):
+    if profiler is None:
+        yield
+    elif profiler == 'cprofile':
+        import cProfile
+        import pstats
+
+        cprofiler = cProfile.Profile()
+        cprofiler.enable()
+        try:
+            yield
+        finally:
+            cprofiler.disable()
+            if output:
+                cprofiler.dump_stats(output)
+            else:
+                pstats.Stats(cprofiler).sort_stats('cumulative').print_stats(30)
+    elif profiler == 'pyinstrument':
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            raise Exception('--profile pyinstrument requires the pyinstrument package')
+        pyprofiler = Profiler()
+        pyprofiler.start()
+        try:
+            yield
+        finally:
+            pyprofiler.stop()
+            if output:
+                with open(output, 'w') as profile_file:
+                    profile_file.write(pyprofiler.output_html())
+            else:
+                print(pyprofiler.output_text())
+    else:
+        raise Exception('Unknown profiler {0}'.format(profiler))
+
+
+registry = Registry()
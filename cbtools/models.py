@@ -1,17 +1,38 @@
 import argparse
 import logging
+import os
+import queue
+import threading
+import time
 import traceback
+from datetime import datetime, timedelta, timezone
 
-from sqlalchemy import create_engine, func, UniqueConstraint, Boolean
+from sqlalchemy import event, func, inspect, text, DDL, Index, UniqueConstraint, Boolean
 from sqlalchemy import Column, DateTime, Integer, Numeric, String, ForeignKey
 from sqlalchemy.orm import scoped_session, sessionmaker, synonym
 from sqlalchemy.ext.declarative import declarative_base
 
-from config import URI
+engines = {}
 
-engine = create_engine(URI)
-session = scoped_session(
-    sessionmaker(autocommit=False, autoflush=False, bind=engine))
+
+def get_engine():
+    # Created on first use, so importing the models needs neither the
+    # database settings nor a database
+    if 'default' not in engines:
+        from config import URI
+        from cbtools.storage import make_engine
+        engines['default'] = make_engine(URI)
+    return engines['default']
+
+
+def __getattr__(name):
+    if name == 'engine':
+        return get_engine()
+    raise AttributeError('module {0!r} has no attribute {1!r}'.format(__name__, name))
+
+
+session_factory = sessionmaker(autocommit=False, autoflush=False)
+session = scoped_session(lambda: session_factory(bind=get_engine()))
 Base = declarative_base()
 Base.query = session.query_property()
 
@@ -33,11 +54,14 @@ class Accounts(Base):
     resource_path = Column(String)
     type = Column(String)
     updated_at = Column(DateTime(timezone=True))
+    sync_profile = Column(String)
+    content_hash = Column(String, index=True)
 
 
 class Addresses(Base):
     __tablename__ = 'addresses'
-    __table_args__ = {"schema": "cbtools"}
+    __table_args__ = (Index('ix_addresses_account_id', 'account_id'),
+                      {"schema": "cbtools"})
 
     account_id = Column(String, ForeignKey('cbtools.accounts.id'))
     address = Column(String)
@@ -50,11 +74,14 @@ class Addresses(Base):
     resource_path = Column(String)
     updated_at = Column(DateTime(timezone=True))
     uri_scheme = Column(String)
+    sync_profile = Column(String)
+    content_hash = Column(String, index=True)
 
 
 class Exchanges(Base):
     __tablename__ = 'exchanges'
-    __table_args__ = {"schema": "cbtools"}
+    __table_args__ = (Index('ix_exchanges_account_id_created_at', 'account_id', 'created_at'),
+                      {"schema": "cbtools"})
 
     account_id = Column(String, ForeignKey('cbtools.accounts.id'))
     amount = Column(Numeric)
@@ -80,6 +107,8 @@ class Exchanges(Base):
     transaction_resource = Column(String)
     transaction_resource_path = Column(String)
     updated_at = Column(DateTime(timezone=True))
+    sync_profile = Column(String)
+    content_hash = Column(String, index=True)
 
 
 class Fees(Base):
@@ -93,6 +122,8 @@ class Fees(Base):
     fee_type = Column(String)
     amount = Column(Numeric)
     currency = Column(String)
+    sync_profile = Column(String)
+    content_hash = Column(String, index=True)
 
 
 class Limits(Base):
@@ -111,6 +142,8 @@ class Limits(Base):
     total = Column(Numeric)
     total_currency = Column(String)
     type = Column(String)
+    sync_profile = Column(String)
+    content_hash = Column(String, index=True)
 
 
 # class Mispayments(Base):
@@ -119,7 +152,8 @@ class Limits(Base):
 
 class Orders(Base):
     __tablename__ = 'orders'
-    __table_args__ = {"schema": "cbtools"}
+    __table_args__ = (Index('ix_orders_transaction_id', 'transaction_id'),
+                      {"schema": "cbtools"})
 
     id = Column(String, primary_key=True)
     code = Column(String)
@@ -141,6 +175,8 @@ class Orders(Base):
     paid_at = Column(DateTime(timezone=True))
     refund_address = Column(String)
     transaction_id = Column(String, ForeignKey('cbtools.transactions.id'))
+    sync_profile = Column(String)
+    content_hash = Column(String, index=True)
 
 
 class PaymentMethods(Base):
@@ -169,6 +205,8 @@ class PaymentMethods(Base):
     type = Column(String)
     updated_at = Column(DateTime(timezone=True))
     verified = Column(Boolean)
+    sync_profile = Column(String)
+    content_hash = Column(String, index=True)
 
 
 # class Refunds(Base):
@@ -177,7 +215,9 @@ class PaymentMethods(Base):
 
 class Transactions(Base):
     __tablename__ = 'transactions'
-    __table_args__ = {"schema": "cbtools"}
+    __table_args__ = (Index('ix_transactions_account_id_created_at', 'account_id', 'created_at'),
+                      Index('ix_transactions_buy_id', 'buy_id'),
+                      {"schema": "cbtools"})
 
     account_id = Column(String, ForeignKey('cbtools.accounts.id'))
     address_id = Column(String, ForeignKey('cbtools.addresses.id'))
@@ -224,6 +264,8 @@ class Transactions(Base):
     to_resource_path = Column(String)
     type = Column(String)
     updated_at = Column(DateTime(timezone=True))
+    sync_profile = Column(String)
+    content_hash = Column(String, index=True)
 
 
 class Users(Base):
@@ -250,6 +292,8 @@ class Users(Base):
     tiers_total = Column(Integer)
     time_zone = Column(String)
     username = Column(String)
+    sync_profile = Column(String)
+    content_hash = Column(String, index=True)
 
     # TODO add show authorization information
 
@@ -265,12 +309,17 @@ class ExchangeAccounts(Base):
     id = Column(String, primary_key=True)
     profile_id = Column(String)
     resource = Column(String)
+    sync_profile = Column(String)
+    content_hash = Column(String, index=True)
 
 
 class Fills(Base):
     __tablename__ = 'fills'
     __table_args__ = (UniqueConstraint('trade_id', 'created_at', 'account_id',
                                        name='fills_constraint'),
+                      Index('ix_fills_order_id', 'order_id'),
+                      Index('ix_fills_account_id_created_at', 'account_id', 'created_at'),
+                      Index('ix_fills_product_id_created_at', 'product_id', 'created_at'),
                       {'schema': 'cbtools'})
     id = Column(Integer, primary_key=True)
     account_id = Column(String)
@@ -288,11 +337,69 @@ class Fills(Base):
     trade_id = Column(Integer)
     usd_volume = Column(Numeric)
     user_id = Column(String)
+    sync_profile = Column(String)
+    content_hash = Column(String, index=True)
+
+
+class FillsByOrder(Base):
+    __tablename__ = 'fills_by_order'
+    __table_args__ = {'schema': 'cbtools'}
+
+    order_id = Column(String, primary_key=True)
+    product_id = Column(String)
+    side = Column(String)
+    fill_count = Column(Integer)
+    size = Column(Numeric)
+    notional = Column(Numeric)
+    fee = Column(Numeric)
+    usd_volume = Column(Numeric)
+
+
+# fills_by_order is kept up to date by a statement level trigger on fills,
+# which only sees the rows an INSERT actually added. SQLite has no such
+# triggers, and there the reports read the fills instead. The trigger needs
+# fills to exist when it is created, and to still exist when it is dropped
+FillsByOrder.__table__.add_is_dependent_on(Fills.__table__)
+event.listen(FillsByOrder.__table__, 'after_create', DDL("""
+CREATE OR REPLACE FUNCTION cbtools.fills_by_order_insert() RETURNS TRIGGER AS $$
+BEGIN
+    INSERT INTO cbtools.fills_by_order (order_id, product_id, side, fill_count, size, notional, fee, usd_volume)
+    SELECT order_id, min(product_id), min(side), count(*), coalesce(sum(size), 0),
+           coalesce(sum(size * price), 0), coalesce(sum(fee), 0), coalesce(sum(usd_volume), 0)
+    FROM new_fills
+    WHERE order_id IS NOT NULL
+    GROUP BY order_id
+    ON CONFLICT (order_id) DO UPDATE
+    SET fill_count = fills_by_order.fill_count + excluded.fill_count,
+        size = fills_by_order.size + excluded.size,
+        notional = fills_by_order.notional + excluded.notional,
+        fee = fills_by_order.fee + excluded.fee,
+        usd_volume = fills_by_order.usd_volume + excluded.usd_volume;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER fills_by_order_insert AFTER INSERT ON cbtools.fills
+REFERENCING NEW TABLE AS new_fills
+FOR EACH STATEMENT EXECUTE PROCEDURE cbtools.fills_by_order_insert();
+
+INSERT INTO cbtools.fills_by_order (order_id, product_id, side, fill_count, size, notional, fee, usd_volume)
+SELECT order_id, min(product_id), min(side), count(*), coalesce(sum(size), 0),
+       coalesce(sum(size * price), 0), coalesce(sum(fee), 0), coalesce(sum(usd_volume), 0)
+FROM cbtools.fills
+WHERE order_id IS NOT NULL
+GROUP BY order_id;
+""").execute_if(dialect='postgresql'))
+event.listen(FillsByOrder.__table__, 'before_drop', DDL("""
+DROP TRIGGER IF EXISTS fills_by_order_insert ON cbtools.fills;
+DROP FUNCTION IF EXISTS cbtools.fills_by_order_insert();
+""").execute_if(dialect='postgresql'))
 
 
 class Holds(Base):
     __tablename__ = 'holds'
-    __table_args__ = {'schema': 'cbtools'}
+    __table_args__ = (Index('ix_holds_account_id', 'account_id'),
+                      {'schema': 'cbtools'})
 
     account_id = Column(String, ForeignKey('cbtools.exchange_accounts.id'))
     amount = Column(Numeric)
@@ -301,28 +408,40 @@ class Holds(Base):
     ref = Column(String)
     resource = Column(String)
     type = Column(String)
+    sync_profile = Column(String)
+    content_hash = Column(String, index=True)
 
 
 class Entries(Base):
     __tablename__ = 'entries'
-    __table_args__ = {'schema': 'cbtools'}
+    __table_args__ = (Index('ix_entries_account_id_created_at', 'account_id', 'created_at'),
+                      Index('ix_entries_order_id', 'order_id'),
+                      {'schema': 'cbtools'})
 
     account_id = Column(String, ForeignKey('cbtools.exchange_accounts.id'))
     amount = Column(Numeric)
     balance = Column(Numeric)
     created_at = Column(DateTime(timezone=True))
     entry_type = Column(String)
-    id = Column(Numeric, primary_key=True)
+    # Ledger ids are whole numbers, the replay orders entries by them
+    id = Column(Numeric(scale=0), primary_key=True)
     order_id = Column(String)
     product_id = Column(String)
     trade_id = Column(Integer)
     transfer_id = Column(String)
     transfer_type = Column(String)
+    sync_profile = Column(String)
+    content_hash = Column(String, index=True)
 
 
 class ExchangeOrders(Base):
     __tablename__ = 'exchange_orders'
-    __table_args__ = {'schema': 'cbtools'}
+    __table_args__ = (Index('ix_exchange_orders_account_id_created_at', 'account_id', 'created_at'),
+                      Index('ix_exchange_orders_product_id_created_at', 'product_id', 'created_at'),
+                      Index('ix_exchange_orders_open', 'product_id',
+                            postgresql_where=text("status IN ('open', 'pending', 'active')"),
+                            sqlite_where=text("status IN ('open', 'pending', 'active')")),
+                      {'schema': 'cbtools'})
 
     account_id = Column(String, ForeignKey('cbtools.exchange_accounts.id'))
     created_at = Column(DateTime(timezone=True))
@@ -344,6 +463,8 @@ class ExchangeOrders(Base):
     stp = Column(String)
     time_in_force = Column(String)
     type = Column(String)
+    sync_profile = Column(String)
+    content_hash = Column(String, index=True)
 
 
 class ReconciliationExceptions(Base):
@@ -367,6 +488,59 @@ class ReconciliationExceptions(Base):
     resolved_timestamp = Column(DateTime(timezone=True))
 
 
+class PnlCheckpoints(Base):
+    __tablename__ = 'pnl_checkpoints'
+    __table_args__ = {'schema': 'cbtools'}
+
+    product_id = Column(String, primary_key=True)
+    method = Column(String, primary_key=True)
+    last_created_at = Column(DateTime(timezone=True))
+    last_trade_id = Column(Integer)
+    fills = Column(Integer)
+    lots = Column(String)
+    realized = Column(Numeric)
+    updated_at = Column(DateTime(timezone=True), default=func.now(), onupdate=func.now())
+
+
+class LedgerCheckpoints(Base):
+    __tablename__ = 'ledger_checkpoints'
+    __table_args__ = {'schema': 'cbtools'}
+
+    account_id = Column(String, primary_key=True)
+    last_created_at = Column(DateTime(timezone=True))
+    last_id = Column(Numeric(scale=0))
+    balance = Column(Numeric)
+    entries = Column(Integer)
+    account_balance = Column(Numeric)
+    account_difference = Column(Numeric)
+    updated_at = Column(DateTime(timezone=True), default=func.now(), onupdate=func.now())
+
+
+class LedgerGaps(Base):
+    __tablename__ = 'ledger_gaps'
+    __table_args__ = (UniqueConstraint('account_id', 'entry_id', name='ledger_gaps_constraint'),
+                      {'schema': 'cbtools'})
+
+    id = Column(Integer, primary_key=True)
+    account_id = Column(String)
+    entry_id = Column(Numeric(scale=0))
+    created_at = Column(DateTime(timezone=True))
+    computed_balance = Column(Numeric)
+    stored_balance = Column(Numeric)
+    difference = Column(Numeric)
+    detected_at = Column(DateTime(timezone=True), default=func.now())
+
+
+class SyncCursors(Base):
+    __tablename__ = 'sync_cursors'
+    __table_args__ = {'schema': 'cbtools'}
+
+    account_id = Column(String, primary_key=True)
+    end_point = Column(String, primary_key=True)
+    cursor = Column(String)
+    updated_at = Column(DateTime(timezone=True), default=func.now(), onupdate=func.now())
+
+
 class Log(Base):
     __tablename__ = 'logs'
     __table_args__ = {'schema': 'cbtools'}
@@ -394,29 +568,218 @@ class Log(Base):
 
 
 class SQLAlchemyLogHandler(logging.Handler):
+    # Records are queued by emit() and written in batches by a background
+    # thread on its own connection, so logging never commits the session
+    # the loader is using
+    def __init__(self, batch_size=500, flush_interval=1.0):
+        logging.Handler.__init__(self)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.reset()
+        if hasattr(os, 'register_at_fork'):
+            # A forked child inherits the parent's handler but not its
+            # writer thread, whose queue and lock it must not share
+            os.register_at_fork(after_in_child=self.reset)
+
+    def reset(self):
+        self.queue = queue.Queue()
+        self.thread = None
+        self.thread_lock = threading.Lock()
+
     def emit(self, record):
-        log = Log()
-        log.logger = record.__dict__['name']
-        log.level = record.__dict__['levelname']
+        if self.thread is None:
+            self.start()
         exc = record.__dict__['exc_info']
         if exc:
-            log.trace = traceback.format_exc(exc)
+            trace = ''.join(traceback.format_exception(*exc))
         else:
-            log.trace = None
-        log.msg = record.__dict__['msg']
+            trace = None
+        self.queue.put({'logger': record.__dict__['name'],
+                        'level': record.__dict__['levelname'],
+                        'trace': trace,
+                        'msg': str(record.__dict__['msg']),
+                        'created_at': datetime.fromtimestamp(record.created, timezone.utc)})
+
+    def start(self):
+        with self.thread_lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='SQLAlchemyLogHandler')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            rows = []
+            deadline = time.time() + self.flush_interval
+            while len(rows) < self.batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    row = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if row is None:
+                    stopping = True
+                    break
+                rows.append(row)
+            if rows:
+                self.write(rows)
+
+    def write(self, rows):
+        try:
+            with get_engine().begin() as connection:
+                connection.execute(Log.__table__.insert(), rows)
+        except Exception:
+            traceback.print_exc()
+
+    def close(self):
+        with self.thread_lock:
+            if self.thread is not None:
+                self.queue.put(None)
+                self.thread.join()
+                self.thread = None
+        logging.Handler.close(self)
+
+
+def create_partitioned_logs():
+    relkind = session.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('cbtools.logs')").scalar()
+    if relkind == 'r':
+        raise Exception('cbtools.logs already exists and is not partitioned, drop or rename it first')
+    session.execute("""CREATE TABLE IF NOT EXISTS cbtools.logs (
+                           id SERIAL,
+                           logger VARCHAR,
+                           level VARCHAR,
+                           trace VARCHAR,
+                           msg VARCHAR,
+                           request_remote_address VARCHAR,
+                           user_agent VARCHAR,
+                           platform VARCHAR,
+                           browser VARCHAR,
+                           version VARCHAR,
+                           language VARCHAR,
+                           created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(),
+                           PRIMARY KEY (id, created_at)
+                       ) PARTITION BY RANGE (created_at);""")
+    session.execute("CREATE TABLE IF NOT EXISTS cbtools.logs_default PARTITION OF cbtools.logs DEFAULT;")
+    session.commit()
 
-        session.add(log)
-        session.commit()
+
+def log_partitions():
+    return [partition for partition, in session.execute("""SELECT child.relname
+                                                         FROM pg_inherits
+                                                         JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+                                                         WHERE pg_inherits.inhparent = 'cbtools.logs'::regclass;""")]
+
+
+def maintain_log_partitions(retention_days, days_ahead=7):
+    today = datetime.now(timezone.utc).date()
+    existing = log_partitions()
+    for offset in range(days_ahead + 1):
+        day = today + timedelta(days=offset)
+        partition = 'logs_{0:%Y%m%d}'.format(day)
+        if partition in existing:
+            continue
+        # Records of the day already in the default partition, logged
+        # before its partition existed, would make creating it fail, so the
+        # partition is created on its own, they are moved into it, and it
+        # is then attached
+        start, end = '{0:%Y-%m-%d} 00:00+00'.format(day), '{0:%Y-%m-%d} 00:00+00'.format(day + timedelta(days=1))
+        session.execute('CREATE TABLE cbtools.{0} (LIKE cbtools.logs INCLUDING DEFAULTS);'.format(partition))
+        session.execute("""WITH moved AS (DELETE FROM cbtools.logs_default
+                                            WHERE created_at >= '{1}' AND created_at < '{2}'
+                                            RETURNING *)
+                           INSERT INTO cbtools.{0} SELECT * FROM moved;""".format(partition, start, end))
+        session.execute("""ALTER TABLE cbtools.logs ATTACH PARTITION cbtools.{0}
+                           FOR VALUES FROM ('{1}') TO ('{2}');""".format(partition, start, end))
+    oldest_day = today - timedelta(days=retention_days)
+    for partition in log_partitions():
+        try:
+            day = datetime.strptime(partition, 'logs_%Y%m%d').date()
+        except ValueError:
+            continue
+        if day < oldest_day:
+            session.execute('DROP TABLE cbtools.{0};'.format(partition))
+    session.commit()
+
+
+# fills and entries arrive in created_at order, so a BRIN index covers time
+# range scans at a fraction of the size of a B-tree. They are only created
+# with --brin, so they are kept out of their tables' indexes, which
+# create_all creates
+brin_indexes = [Index('ix_fills_created_at_brin', Fills.created_at, postgresql_using='brin'),
+                Index('ix_entries_created_at_brin', Entries.created_at, postgresql_using='brin')]
+for brin_index in brin_indexes:
+    brin_index.table.indexes.discard(brin_index)
+
+
+def create_brin_indexes():
+    engine = get_engine()
+    inspector = inspect(engine)
+    for index in brin_indexes:
+        table = index.table
+        if index.name not in [existing['name'] for existing in inspector.get_indexes(table.name, schema=table.schema)]:
+            index.create(bind=engine)
+
+
+def create_missing_columns():
+    # create_all does not alter tables that already exist, so columns added
+    # to a model since, like sync_profile and content_hash, are added here
+    engine = get_engine()
+    inspector = inspect(engine)
+    preparer = engine.dialect.identifier_preparer
+    for table in Base.metadata.sorted_tables:
+        if not engine.dialect.has_table(engine, table.name, schema=table.schema):
+            continue
+        existing_columns = [column['name'] for column in inspector.get_columns(table.name, schema=table.schema)]
+        for column in table.columns:
+            if column.name not in existing_columns:
+                session.execute('ALTER TABLE {0} ADD COLUMN {1} {2};'.format(
+                    preparer.format_table(table), preparer.format_column(column),
+                    column.type.compile(dialect=engine.dialect)))
+    session.commit()
+
+
+def create_missing_indexes():
+    # create_all only creates the indexes of the tables it creates
+    engine = get_engine()
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing_indexes = [index['name'] for index in inspector.get_indexes(table.name, schema=table.schema)]
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                index.create(bind=engine)
 
 
 if __name__ == '__main__':
     ARGS = argparse.ArgumentParser()
     ARGS.add_argument('--d', action='store_true', dest='drop_tables',
                       default=False, help='Drop tables')
+    ARGS.add_argument('--brin', action='store_true', dest='brin', default=False,
+                      help='Add BRIN indexes on created_at to the fills and entries tables')
+    ARGS.add_argument('--partition-logs', action='store_true', dest='partition_logs', default=False,
+                      help='Partition cbtools.logs by day and drop partitions past the retention period')
+    ARGS.add_argument('--log-retention-days', type=int, dest='log_retention_days', default=30,
+                      help='Days of logs to keep when the logs table is partitioned')
     args = ARGS.parse_args()
 
-    session.execute("CREATE SCHEMA IF NOT EXISTS cbtools;")
-    session.commit()
+    engine = get_engine()
+    if engine.dialect.name == 'postgresql':
+        # An embedded database is attached as the schema instead
+        session.execute("CREATE SCHEMA IF NOT EXISTS cbtools;")
+        session.commit()
+    elif args.partition_logs:
+        ARGS.error('--partition-logs needs Postgres')
+    elif args.brin:
+        ARGS.error('--brin needs Postgres')
     if args.drop_tables:
         Base.metadata.drop_all(bind=engine)
+    if args.partition_logs:
+        create_partitioned_logs()
+        maintain_log_partitions(args.log_retention_days)
     Base.metadata.create_all(bind=engine)
+    create_missing_columns()
+    create_missing_indexes()
+    if args.brin:
+        create_brin_indexes()
@@ -0,0 +1,115 @@
+import uuid
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+import requests
+from sqlalchemy.exc import IntegrityError, ProgrammingError
+
+from cbtools import db_logger
+from cbtools.api import invalidate
+from cbtools.loader import upsert
+from cbtools.metrics import registry
+from cbtools.models import session, ExchangeOrders
+from cbtools.ratelimit import EXCHANGE_PRIVATE_BURST
+
+
+PRICE_INCREMENT = Decimal('0.01')
+
+OrderResult = namedtuple('OrderResult', ['order', 'accepted', 'order_id', 'status', 'reason', 'response'])
+
+
+def ladder(product_id, side, start_price, step, size, count, post_only=True):
+    # Every order of the ladder is built up front, each with its own
+    # client_oid, so submitting them is only a matter of sending requests
+    orders = []
+    price = Decimal(start_price)
+    step = Decimal(step)
+    for order_number in range(count):
+        orders.append({'client_oid': str(uuid.uuid4()),
+                       'size': str(size),
+                       'price': str(price.quantize(PRICE_INCREMENT)),
+                       'side': side,
+                       'product_id': product_id,
+                       'post_only': post_only})
+        price = price - step if side == 'buy' else price + step
+    return orders
+
+
+def submit_order(client, order):
+    try:
+        response = client.post('orders', json=order)
+    except (requests.ConnectionError, requests.Timeout) as error:
+        # The order may or may not have reached the exchange, the next sync
+        # of its orders tells, and the rest of the ladder is still submitted
+        registry.increment('cbtools_orders_total', result='unknown', product_id=order['product_id'])
+        return OrderResult(order, False, None, 'unknown', str(error), {})
+    try:
+        body = response.json()
+    except ValueError:
+        body = {}
+    if response.status_code == 200 and body.get('status') != 'rejected':
+        registry.increment('cbtools_orders_total', result='accepted', product_id=order['product_id'])
+        return OrderResult(order, True, body.get('id'), body.get('status'), None, body)
+    reason = body.get('reject_reason') or body.get('message') or 'HTTP {0}'.format(response.status_code)
+    registry.increment('cbtools_orders_total', result='rejected', product_id=order['product_id'])
+    return OrderResult(order, False, body.get('id'), body.get('status', 'rejected'), reason, body)
+
+
+def submit_orders(client, orders, workers=EXCHANGE_PRIVATE_BURST):
+    # The client's token bucket keeps the concurrent requests within the
+    # private endpoint rate limit, and 429s are retried by the client
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(lambda order: submit_order(client, order), orders))
+
+
+def cancel_order(client, order_id):
+    try:
+        response = client.delete('orders/' + order_id)
+    except requests.RequestException:
+        return order_id, False
+    return order_id, response.status_code == 200
+
+
+def cancel_orders(client, order_ids=None, product_id=None, workers=EXCHANGE_PRIVATE_BURST):
+    # Without order ids every open order, optionally of one product, is
+    # canceled with the exchange's single bulk cancel request
+    if order_ids is None:
+        params = {'product_id': product_id} if product_id else None
+        response = client.delete('orders', params=params)
+        canceled = response.json() if response.status_code == 200 else []
+        failed = []
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(lambda order_id: cancel_order(client, order_id), order_ids))
+        canceled = [order_id for order_id, success in results if success]
+        failed = [order_id for order_id, success in results if not success]
+    registry.increment('cbtools_orders_canceled_total', len(canceled))
+    return canceled, failed
+
+
+def record_orders(results, account_id=None, canceled=None):
+    # Acknowledged orders and cancellations are written with one statement
+    rows = []
+    columns = ExchangeOrders.__table__.columns
+    for result in results:
+        if result.order_id is None:
+            continue
+        row = {key: value for key, value in result.response.items() if key in columns}
+        row.update(id=result.order_id, account_id=account_id, resource='exchange_order')
+        if not result.accepted:
+            row.update(status='rejected', reject_reason=result.reason)
+        rows.append(row)
+    for order_id in canceled or []:
+        rows.append({'id': order_id, 'status': 'done', 'done_reason': 'canceled'})
+    if not rows:
+        return 0
+    try:
+        upsert(ExchangeOrders, rows, ['id'])
+        session.commit()
+    except (IntegrityError, ProgrammingError) as error:
+        session.rollback()
+        db_logger.error('Record orders {0}'.format(type(error).__name__))
+        return 0
+    invalidate('exchange_orders')
+    return len(rows)
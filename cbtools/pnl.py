@@ -0,0 +1,230 @@
+import argparse
+import json
+from collections import namedtuple
+from decimal import Decimal
+
+import numpy as np
+from sqlalchemy import func, tuple_
+
+from cbtools.models import session, Fills, PnlCheckpoints
+
+
+# Sizes and prices are matched as integers of 1e-8 units, costs and fees as
+# integers of 1e-16 quote units, so every total is exact
+SIZE_SCALE = 8
+PRICE_SCALE = 8
+COST_SCALE = SIZE_SCALE + PRICE_SCALE
+
+ProductPnl = namedtuple('ProductPnl', ['product_id', 'method', 'fills', 'realized', 'total_realized',
+                                       'unrealized', 'position', 'cost_basis', 'error', 'replayed'])
+
+
+def to_units(value, scale):
+    units = Decimal(value).scaleb(scale)
+    if units != units.to_integral_value():
+        raise ValueError('{0} has more than {1} decimal places'.format(value, scale))
+    return int(units)
+
+
+def from_units(units, scale):
+    return Decimal(units).scaleb(-scale)
+
+
+def fill_arrays(fills):
+    is_buy = np.array([fill.side == 'buy' for fill in fills], dtype=bool)
+    sizes = np.array([to_units(fill.size, SIZE_SCALE) for fill in fills], dtype=np.int64)
+    notionals = np.array([to_units(fill.size, SIZE_SCALE) * to_units(fill.price, PRICE_SCALE)
+                          for fill in fills], dtype=object)
+    fees = np.array([to_units(fill.fee or 0, COST_SCALE) for fill in fills], dtype=object)
+    trade_ids = np.array([fill.trade_id for fill in fills], dtype=np.int64)
+    return is_buy, sizes, notionals, fees, trade_ids
+
+
+def check_position(lots, is_buy, sizes):
+    position = sum(lot[1] for lot in lots) + np.cumsum(np.where(is_buy, sizes, -sizes))
+    if len(position) and position.min() < 0:
+        raise ValueError('Sells exceed the open lots, short positions are not supported')
+
+
+def match_fifo(lots, fills):
+    # With FIFO, the n-th unit sold is the n-th unit bought, so each sell's
+    # cost is the difference of the cumulative cost curve of the buys at the
+    # cumulative quantities sold before and after it
+    is_buy, sizes, notionals, fees, trade_ids = fill_arrays(fills)
+    check_position(lots, is_buy, sizes)
+    lot_ids = np.concatenate([np.array([lot[0] for lot in lots], dtype=np.int64), trade_ids[is_buy]])
+    lot_sizes = np.concatenate([np.array([lot[1] for lot in lots], dtype=np.int64), sizes[is_buy]])
+    lot_costs = np.concatenate([np.array([lot[2] for lot in lots], dtype=object),
+                                notionals[is_buy] + fees[is_buy]])
+    cumulative_sizes = np.concatenate([[0], np.cumsum(lot_sizes)])
+    cumulative_costs = np.concatenate([np.array([0], dtype=object), np.cumsum(lot_costs)])
+
+    def cost_of_first(quantities):
+        lot_index = np.searchsorted(cumulative_sizes, quantities, side='left') - 1
+        lot_index = np.maximum(lot_index, 0)
+        partial = (quantities - cumulative_sizes[lot_index]).astype(object)
+        return (cumulative_costs[lot_index] +
+                partial * lot_costs[np.minimum(lot_index, len(lot_costs) - 1)] //
+                lot_sizes[np.minimum(lot_index, len(lot_sizes) - 1)].astype(object))
+
+    sold = np.concatenate([[0], np.cumsum(sizes[~is_buy])])
+    if len(lot_sizes):
+        consumed_costs = cost_of_first(sold)
+    else:
+        consumed_costs = np.zeros(len(sold), dtype=object)
+    costs = np.diff(consumed_costs)
+    proceeds = notionals[~is_buy] - fees[~is_buy]
+    realized = int((proceeds - costs).sum()) if len(costs) else 0
+
+    # The lot the last sell stopped in is partly open, the ones after it are
+    # untouched
+    total_sold = int(sold[-1])
+    first_open = int(np.searchsorted(cumulative_sizes, total_sold, side='right')) - 1
+    new_lots = []
+    for lot_index in range(first_open, len(lot_sizes)):
+        open_size = int(cumulative_sizes[lot_index + 1]) - max(total_sold, int(cumulative_sizes[lot_index]))
+        if lot_index == first_open:
+            open_cost = int(cumulative_costs[lot_index + 1]) - int(consumed_costs[-1])
+        else:
+            open_cost = int(lot_costs[lot_index])
+        if open_size > 0:
+            new_lots.append([int(lot_ids[lot_index]), open_size, open_cost])
+    return realized, new_lots
+
+
+def match_sequential(lots, fills, method, selections=None):
+    is_buy, sizes, notionals, fees, trade_ids = fill_arrays(fills)
+    check_position(lots, is_buy, sizes)
+    lots = [list(lot) for lot in lots]
+    selections = selections or {}
+    realized = 0
+    for index in range(len(fills)):
+        if is_buy[index]:
+            lots.append([int(trade_ids[index]), int(sizes[index]), int(notionals[index] + fees[index])])
+            continue
+        remaining = int(sizes[index])
+        cost = 0
+        picks = []
+        for trade_id, size in selections.get(int(trade_ids[index]), []):
+            picks += [(lot, to_units(str(size), SIZE_SCALE)) for lot in lots if lot[0] == int(trade_id)]
+        picks += [(lot, None) for lot in (reversed(lots) if method == 'lifo' else lots)]
+        for lot, size in picks:
+            if remaining == 0:
+                break
+            take = min(remaining, lot[1], size if size is not None else lot[1])
+            if take <= 0:
+                continue
+            lot_cost = lot[2] if take == lot[1] else lot[2] * take // lot[1]
+            lot[1] -= take
+            lot[2] -= lot_cost
+            cost += lot_cost
+            remaining -= take
+        lots = [lot for lot in lots if lot[1] > 0]
+        realized += int(notionals[index] - fees[index]) - cost
+    return realized, lots
+
+
+def load_fills(product_id, checkpoint):
+    # The fills endpoint is fetched once per exchange account, so each fill
+    # can be stored more than once, and only its first copy is kept
+    query = (session.query(Fills.trade_id, Fills.created_at, Fills.side, Fills.size, Fills.price, Fills.fee)
+             .filter(Fills.product_id == product_id)
+             .order_by(Fills.created_at, Fills.trade_id))
+    if checkpoint is not None and checkpoint.last_created_at is not None:
+        query = query.filter(tuple_(Fills.created_at, Fills.trade_id) >
+                             tuple_(checkpoint.last_created_at, checkpoint.last_trade_id))
+    fills = []
+    seen = set()
+    for fill in query:
+        if fill.trade_id not in seen:
+            seen.add(fill.trade_id)
+            fills.append(fill)
+    return fills
+
+
+def matched_fills(product_id, checkpoint):
+    return (session.query(func.count(func.distinct(Fills.trade_id)))
+            .filter(Fills.product_id == product_id)
+            .filter(tuple_(Fills.created_at, Fills.trade_id) <=
+                    tuple_(checkpoint.last_created_at, checkpoint.last_trade_id))
+            .scalar())
+
+
+def run(method='fifo', marks=None, selections=None, rebuild=False):
+    marks = marks or {}
+    results = []
+    product_ids = [product_id for product_id, in session.query(Fills.product_id).distinct()]
+    for product_id in sorted(product_ids):
+        checkpoint = session.query(PnlCheckpoints).get((product_id, method))
+        replayed = rebuild
+        if (checkpoint is not None and not rebuild and checkpoint.last_created_at is not None
+                and matched_fills(product_id, checkpoint) != checkpoint.fills):
+            # Fills older than the checkpoint arrived after it was made, a
+            # backfilled window or a late sync, so the product is matched
+            # again from its first fill
+            replayed = True
+        if checkpoint is None or replayed:
+            checkpoint = session.merge(PnlCheckpoints(product_id=product_id, method=method, last_created_at=None,
+                                                      last_trade_id=None, fills=0, lots='[]', realized=0))
+        lots = json.loads(checkpoint.lots)
+        fills = load_fills(product_id, checkpoint)
+        try:
+            if method == 'fifo':
+                realized, lots = match_fifo(lots, fills)
+            else:
+                realized, lots = match_sequential(lots, fills, method, selections)
+        except ValueError as error:
+            # Sells of coins bought before the fills start, or transferred
+            # in, have no lots to match. The product's checkpoint is left
+            # where it was, so its fills are matched again by the next run,
+            # and the other products are still matched
+            results.append(ProductPnl(product_id, method, len(fills), None, Decimal(checkpoint.realized), None,
+                                      from_units(sum(lot[1] for lot in lots), SIZE_SCALE),
+                                      from_units(sum(lot[2] for lot in lots), COST_SCALE), str(error), replayed))
+            continue
+        total_realized = Decimal(checkpoint.realized) + from_units(realized, COST_SCALE)
+        if fills:
+            checkpoint.last_created_at = fills[-1].created_at
+            checkpoint.last_trade_id = fills[-1].trade_id
+            checkpoint.fills = (checkpoint.fills or 0) + len(fills)
+        checkpoint.lots = json.dumps(lots)
+        checkpoint.realized = total_realized
+        position = sum(lot[1] for lot in lots)
+        cost_basis = sum(lot[2] for lot in lots)
+        unrealized = None
+        if product_id in marks:
+            unrealized = from_units(position * to_units(marks[product_id], PRICE_SCALE) - cost_basis, COST_SCALE)
+        results.append(ProductPnl(product_id, method, len(fills), from_units(realized, COST_SCALE),
+                                  total_realized, unrealized, from_units(position, SIZE_SCALE),
+                                  from_units(cost_basis, COST_SCALE), None, replayed))
+    session.commit()
+    return results
+
+
+if __name__ == '__main__':
+    ARGS = argparse.ArgumentParser()
+    ARGS.add_argument('--method', choices=['fifo', 'lifo', 'specific'], default='fifo',
+                      help='How sells are matched to open lots')
+    ARGS.add_argument('--selections', dest='selections',
+                      help='JSON file mapping sell trade ids to [buy trade id, size] pairs for --method specific, '
+                           'anything not selected is matched FIFO')
+    ARGS.add_argument('--mark', action='append', dest='marks', default=[],
+                      help='PRODUCT=PRICE used for unrealized PnL, can be repeated')
+    ARGS.add_argument('--rebuild', action='store_true', default=False,
+                      help='Discard the checkpoints and replay every fill')
+    args = ARGS.parse_args()
+
+    selections = None
+    if args.selections:
+        with open(args.selections, 'r') as selections_file:
+            selections = {int(trade_id): pairs for trade_id, pairs in json.load(selections_file).items()}
+    marks = dict(mark.split('=') for mark in args.marks)
+    for result in run(args.method, marks, selections, args.rebuild):
+        if result.error:
+            print('{0} ({1}): {2} new fills not matched, {3}'.format(result.product_id, result.method,
+                                                                    result.fills, result.error))
+            continue
+        print('{0} ({1}): {2} {3}fills, realized {4} (total {5}), unrealized {6}, position {7} at cost {8}'
+              .format(result.product_id, result.method, result.fills, '' if result.replayed else 'new ',
+                      result.realized, result.total_realized, result.unrealized, result.position,
+                      result.cost_basis))
@@ -0,0 +1,109 @@
+import multiprocessing
+import random
+import threading
+import time
+
+from coinbase.wallet.error import InternalServerError, RateLimitExceededError, ServiceUnavailableError
+
+from cbtools.metrics import registry
+
+
+# Requests per second allowed by Coinbase for each API
+EXCHANGE_PUBLIC_RATE = 3
+EXCHANGE_PRIVATE_RATE = 5
+EXCHANGE_PRIVATE_BURST = 10
+WALLET_RATE = 10000 / 3600.0
+
+
+class TokenBucket(object):
+    def __init__(self, rate, capacity=None):
+        self.max_rate = rate
+        self.min_rate = rate / 16.0
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.timestamp = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+                self.timestamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def throttle(self):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = 0
+
+    def recover(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20.0)
+
+
+class SharedTokenBucket(object):
+    # A TokenBucket whose state lives in shared memory, so processes started
+    # with it, e.g. as an initializer argument of a process pool, draw on one
+    # budget
+    def __init__(self, rate, capacity=None):
+        self.max_rate = rate
+        self.min_rate = rate / 16.0
+        self.capacity = capacity or rate
+        self.lock = multiprocessing.Lock()
+        self.shared_rate = multiprocessing.RawValue('d', rate)
+        self.tokens = multiprocessing.RawValue('d', self.capacity)
+        self.timestamp = multiprocessing.RawValue('d', time.time())
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens.value = min(self.capacity,
+                                        self.tokens.value + (now - self.timestamp.value) * self.shared_rate.value)
+                self.timestamp.value = now
+                if self.tokens.value >= 1:
+                    self.tokens.value -= 1
+                    return
+                wait = (1 - self.tokens.value) / self.shared_rate.value
+            time.sleep(wait)
+
+    def throttle(self):
+        with self.lock:
+            self.shared_rate.value = max(self.min_rate, self.shared_rate.value / 2)
+            self.tokens.value = 0
+
+    def recover(self):
+        with self.lock:
+            self.shared_rate.value = min(self.max_rate, self.shared_rate.value + self.max_rate / 20.0)
+
+
+def backoff_delay(attempt, base_delay=0.5, max_delay=30):
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+def wallet_call(limiter, function, *args, retries=5, **kwargs):
+    end_point = function.__name__
+    for attempt in range(retries + 1):
+        limiter.acquire()
+        start = time.time()
+        try:
+            response = function(*args, **kwargs)
+        except (RateLimitExceededError, InternalServerError, ServiceUnavailableError) as error:
+            registry.observe('cbtools_http_request_seconds', time.time() - start, method='GET',
+                             end_point=end_point, status=error.status_code)
+            if attempt == retries:
+                raise
+            registry.increment('cbtools_http_retries_total', end_point=end_point, reason=str(error.status_code))
+            limiter.throttle()
+            time.sleep(backoff_delay(attempt))
+        else:
+            registry.observe('cbtools_http_request_seconds', time.time() - start, method='GET',
+                             end_point=end_point, status=response.response.status_code)
+            limiter.recover()
+            return response
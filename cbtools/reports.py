@@ -0,0 +1,136 @@
+import argparse
+import csv
+import gzip
+import os
+import time
+
+from sqlalchemy import func, select
+
+from cbtools.models import get_engine, Entries, Fills, FillsByOrder, Transactions
+
+
+CHUNK_SIZE = 10000
+
+exportable_models = {'entries': Entries,
+                     'fills': Fills,
+                     'transactions': Transactions}
+
+
+def stream(statement, chunk_size=CHUNK_SIZE):
+    # stream_results makes psycopg2 use a named server side cursor, so only
+    # one chunk of the result is held in memory at a time
+    with get_engine().connect() as connection:
+        result = connection.execution_options(stream_results=True).execute(statement)
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+
+
+def open_output(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'wt', newline='')
+    return open(path, 'w', newline='')
+
+
+def fills_by_order(chunk_size=CHUNK_SIZE):
+    engine = get_engine()
+    if engine.dialect.name == 'postgresql':
+        # The aggregate table is kept up to date by its trigger, without it
+        # the fills are summed by the server and only the sums streamed
+        if engine.dialect.has_table(engine, FillsByOrder.__tablename__, schema='cbtools'):
+            table = FillsByOrder.__table__
+            statement = (select([table.c.order_id, table.c.fee, table.c.size, table.c.usd_volume, table.c.notional])
+                         .order_by(table.c.order_id))
+        else:
+            table = Fills.__table__
+            statement = (select([table.c.order_id, func.sum(table.c.fee), func.sum(table.c.size),
+                                 func.sum(table.c.usd_volume), func.sum(table.c.size * table.c.price)])
+                         .group_by(table.c.order_id)
+                         .order_by(table.c.order_id))
+        for rows in stream(statement, chunk_size):
+            for row in rows:
+                yield tuple(row)
+        return
+
+    # The embedded database would sum the decimals it stores as text as
+    # doubles, so the fills are read in order_id order and summed one order
+    # at a time, and only the current order is kept around
+    table = Fills.__table__
+    statement = (select([table.c.order_id, table.c.fee, table.c.size, table.c.usd_volume, table.c.price])
+                 .order_by(table.c.order_id))
+    current = None
+    for rows in stream(statement, chunk_size):
+        for row in rows:
+            if current is None or row.order_id != current[0]:
+                if current is not None:
+                    yield tuple(current)
+                current = [row.order_id, None, None, None, None]
+            for index, value in ((1, row.fee), (2, row.size), (3, row.usd_volume)):
+                if value is not None:
+                    current[index] = value if current[index] is None else current[index] + value
+            if row.size is not None and row.price is not None:
+                notional = row.size * row.price
+                current[4] = notional if current[4] is None else current[4] + notional
+    if current is not None:
+        yield tuple(current)
+
+
+def fills_report(path='fills_report.csv', chunk_size=CHUNK_SIZE):
+    rows = 0
+    with open_output(path) as report_file:
+        writer = csv.writer(report_file)
+        writer.writerow(['order_id', 'fee', 'size', 'usd_volume', 'wa_price'])
+        for order_id, fee, size, usd_volume, notional in fills_by_order(chunk_size):
+            wa_price = notional / size if notional is not None and size else None
+            writer.writerow([order_id, fee, size, usd_volume, wa_price])
+            rows += 1
+    return rows
+
+
+def export_table(Model, path, chunk_size=CHUNK_SIZE):
+    table = Model.__table__
+    statement = select([table]).order_by(*table.primary_key.columns)
+    rows = 0
+    with open_output(path) as export_file:
+        writer = csv.writer(export_file)
+        writer.writerow([column.key for column in table.columns])
+        for chunk in stream(statement, chunk_size):
+            writer.writerows(chunk)
+            rows += len(chunk)
+    return rows
+
+
+if __name__ == '__main__':
+    ARGS = argparse.ArgumentParser()
+    ARGS.add_argument('report', choices=['fills', 'export'],
+                      help='fills writes the per order fills report, export writes whole tables')
+    ARGS.add_argument('tables', nargs='*', default=[],
+                      help='Tables to export ({0}), all of them if none are given'.format(
+                          ', '.join(sorted(exportable_models))))
+    ARGS.add_argument('--output', dest='output', default=None,
+                      help='File for the fills report, or directory for exports; .gz is compressed')
+    ARGS.add_argument('--gzip', action='store_true', dest='gzip', default=False,
+                      help='Compress the exported tables')
+    ARGS.add_argument('--chunk-size', type=int, dest='chunk_size', default=CHUNK_SIZE,
+                      help='Rows fetched from the server side cursor at a time')
+    args = ARGS.parse_args()
+    for table_name in args.tables:
+        if table_name not in exportable_models:
+            ARGS.error('{0} can not be exported'.format(table_name))
+
+    start = time.time()
+    if args.report == 'fills':
+        output = args.output or 'fills_report.csv'
+        rows = fills_report(output, args.chunk_size)
+        print('{0}: {1} orders in {2:.2f}s'.format(output, rows, time.time() - start))
+    else:
+        directory = args.output or 'exports'
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        for table_name in args.tables or sorted(exportable_models):
+            table_start = time.time()
+            path = os.path.join(directory, table_name + ('.csv.gz' if args.gzip else '.csv'))
+            rows = export_table(exportable_models[table_name], path, args.chunk_size)
+            print('{0}: {1} rows in {2:.2f}s'.format(path, rows, time.time() - table_start))
@@ -0,0 +1,125 @@
+import argparse
+import json
+import os
+import time
+import traceback
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from coinbase.wallet.client import Client
+
+from cbtools import db_logger
+from cbtools.client import ExchangeClient, pooled_session
+from cbtools.main import sync
+from cbtools.models import get_engine
+from cbtools.ratelimit import (SharedTokenBucket, EXCHANGE_PRIVATE_BURST, EXCHANGE_PRIVATE_RATE, EXCHANGE_PUBLIC_RATE,
+                               WALLET_RATE)
+
+
+ProfileResult = namedtuple('ProfileResult', ['name', 'stats', 'elapsed', 'error'])
+
+# Set in each worker process by init_worker
+worker = {}
+
+
+def load_profiles(path):
+    # A JSON list of credential sets, each with a unique name and the
+    # coinbase_key/coinbase_secret and/or gdax_api_key/gdax_api_secret/
+    # gdax_api_passphrase of one profile
+    with open(path, 'r') as profiles_file:
+        profiles = json.load(profiles_file)
+    names = [profile['name'] for profile in profiles]
+    if len(set(names)) != len(names):
+        raise Exception('Profile names in {0} are not unique'.format(path))
+    return profiles
+
+
+def init_worker(wallet_limiter, exchange_limiter, public_limiter, pool_size):
+    # Connections of the parent's engine can not be used from a forked
+    # process, and every profile this worker syncs shares its HTTP pool
+    get_engine().dispose()
+    worker['wallet_limiter'] = wallet_limiter
+    worker['exchange_limiter'] = exchange_limiter
+    worker['public_limiter'] = public_limiter
+    worker['session'] = pooled_session(pool_size)
+
+
+def sync_profile(profile, refresh=False, full=False, bulk=False, batch_size=1000, workers=1,
+                 directory='tmp/', backfill=0, backfill_since=None):
+    start = time.time()
+    wallet_client = exchange_client = None
+    if profile.get('coinbase_key'):
+        wallet_client = Client(profile['coinbase_key'], profile['coinbase_secret'],
+                               **({'base_api_uri': profile['wallet_url']} if 'wallet_url' in profile else {}))
+        # The wallet client signs each request itself, so its session can
+        # hand its connections to the worker's pool
+        for prefix in ('https://', 'http://'):
+            wallet_client.session.mount(prefix, worker['session'].get_adapter(prefix))
+    if profile.get('gdax_api_key'):
+        exchange_client = ExchangeClient(profile['gdax_api_key'], profile['gdax_api_secret'],
+                                         profile['gdax_api_passphrase'], limiter=worker['exchange_limiter'],
+                                         public_limiter=worker['public_limiter'], session=worker['session'],
+                                         **({'url': profile['exchange_url']} if 'exchange_url' in profile else {}))
+    try:
+        stats = sync(wallet_client, worker['wallet_limiter'], exchange_client, refresh, full, bulk, batch_size,
+                     workers, os.path.join(directory, profile['name']), profile['name'], backfill, backfill_since)
+    except Exception:
+        db_logger.error('Sync of profile {0} failed'.format(profile['name']), exc_info=True)
+        return ProfileResult(profile['name'], None, time.time() - start, traceback.format_exc())
+    return ProfileResult(profile['name'], stats, time.time() - start, None)
+
+
+def run(profiles, processes=None, wallet_rate=WALLET_RATE, exchange_rate=EXCHANGE_PRIVATE_RATE,
+        exchange_burst=EXCHANGE_PRIVATE_BURST, pool_size=10, **options):
+    # Profiles sync side by side, one per process, all drawing on the same
+    # per-IP request budget
+    wallet_limiter = SharedTokenBucket(wallet_rate)
+    exchange_limiter = SharedTokenBucket(exchange_rate, exchange_burst)
+    public_limiter = SharedTokenBucket(EXCHANGE_PUBLIC_RATE)
+    with ProcessPoolExecutor(max_workers=processes or len(profiles), initializer=init_worker,
+                             initargs=(wallet_limiter, exchange_limiter, public_limiter, pool_size)) as executor:
+        futures = [executor.submit(sync_profile, profile, **options) for profile in profiles]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+if __name__ == '__main__':
+    ARGS = argparse.ArgumentParser()
+    ARGS.add_argument('profiles', help='JSON file with the list of credential sets to sync')
+    ARGS.add_argument('--processes', type=int, dest='processes', default=None,
+                      help='Profiles synced at a time, all of them by default')
+    ARGS.add_argument('--wallet-rate', type=float, dest='wallet_rate', default=WALLET_RATE,
+                      help='Wallet API requests per second allowed from this IP, across all profiles')
+    ARGS.add_argument('--exchange-rate', type=float, dest='exchange_rate', default=EXCHANGE_PRIVATE_RATE,
+                      help='Exchange API requests per second allowed from this IP, across all profiles')
+    ARGS.add_argument('--pool-size', type=int, dest='pool_size', default=10,
+                      help='Keep-alive connections per worker process')
+    ARGS.add_argument('--workers', type=int, dest='workers', default=1,
+                      help='Accounts and endpoints of a profile fetched concurrently')
+    ARGS.add_argument('--r', action='store_true', dest='refresh', default=False, help='Refresh the data')
+    ARGS.add_argument('--full', action='store_true', dest='full', default=False,
+                      help='Ignore the saved pagination cursors and refresh the full history')
+    ARGS.add_argument('--bulk', action='store_true', dest='bulk', default=False,
+                      help='Load the data with batched INSERT ... ON CONFLICT statements')
+    ARGS.add_argument('--batch-size', type=int, dest='batch_size', default=1000,
+                      help='Number of rows per batch when loading with --bulk')
+    ARGS.add_argument('--backfill', type=int, dest='backfill', default=0,
+                      help='Fetch the ledger, fills and orders without a saved cursor as this many windows of '
+                           'history, per product for fills and orders, in parallel shards')
+    ARGS.add_argument('--backfill-since', dest='backfill_since', default=None,
+                      help='Start of the first backfill window, rows created before it are not fetched')
+    args = ARGS.parse_args()
+
+    profiles = load_profiles(args.profiles)
+    start = time.time()
+    failed = 0
+    for result in run(profiles, args.processes, args.wallet_rate, args.exchange_rate, pool_size=args.pool_size,
+                      refresh=args.refresh, full=args.full, bulk=args.bulk, batch_size=args.batch_size,
+                      workers=args.workers, backfill=args.backfill, backfill_since=args.backfill_since):
+        if result.error:
+            failed += 1
+            print('{0}: failed after {1:.2f}s\n{2}'.format(result.name, result.elapsed, result.error))
+        else:
+            print('{0}: {1} documents in {2:.2f}s'.format(result.name, sum(result.stats.values()),
+                                                         result.elapsed))
+    print('{0} profiles, {1} failed, in {2:.2f}s'.format(len(profiles), failed, time.time() - start))
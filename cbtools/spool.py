@@ -0,0 +1,99 @@
+import gzip
+import json
+import os
+import shutil
+import threading
+from collections import OrderedDict
+
+
+class SegmentWriter(object):
+    def __init__(self, spool, name):
+        self.spool = spool
+        self.name = name
+        self.path = spool.segment_path(name)
+        self.rows = 0
+        self.file = gzip.open(self.path + '.part', 'wt')
+
+    def append(self, documents):
+        for document in documents:
+            self.file.write(json.dumps(document, sort_keys=True))
+            self.file.write('\n')
+            self.rows += 1
+
+    def close(self, **metadata):
+        self.file.close()
+        os.rename(self.path + '.part', self.path)
+        self.spool.add_to_manifest(self.name, self.rows, metadata)
+
+
+class Spool(object):
+    # A directory of gzipped newline-delimited JSON segments, one per
+    # endpoint. A segment only counts once it is listed in the manifest, so a
+    # crashed run can be resumed by skipping the segments that were finished.
+    def __init__(self, directory):
+        self.directory = directory
+        self.manifest_file = os.path.join(directory, 'manifest.ndjson')
+        self.complete_file = os.path.join(directory, 'complete')
+        self.lock = threading.Lock()
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.manifest = self.read_manifest()
+
+    def read_manifest(self):
+        manifest = OrderedDict()
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file, 'r') as manifest_file:
+                for line in manifest_file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # The last line of a crashed run can be cut short
+                        break
+                    manifest[entry['segment']] = entry
+        return manifest
+
+    def add_to_manifest(self, name, rows, metadata):
+        entry = OrderedDict([('segment', name), ('rows', rows)])
+        entry.update(metadata)
+        with self.lock:
+            with open(self.manifest_file, 'a') as manifest_file:
+                manifest_file.write(json.dumps(entry) + '\n')
+            self.manifest[name] = entry
+
+    def segment_path(self, name):
+        return os.path.join(self.directory, name + '.ndjson.gz')
+
+    def has_segment(self, name):
+        return name in self.manifest
+
+    def entry(self, name):
+        return self.manifest.get(name)
+
+    def open_segment(self, name):
+        return SegmentWriter(self, name)
+
+    def write_segment(self, name, documents, **metadata):
+        writer = self.open_segment(name)
+        writer.append(documents)
+        writer.close(**metadata)
+
+    def is_complete(self):
+        return os.path.exists(self.complete_file)
+
+    def mark_complete(self):
+        with open(self.complete_file, 'w'):
+            pass
+
+    def reset(self):
+        shutil.rmtree(self.directory)
+        os.makedirs(self.directory)
+        self.manifest = OrderedDict()
+
+    def entries(self):
+        return list(self.manifest.values())
+
+    def read(self):
+        for name in list(self.manifest):
+            with gzip.open(self.segment_path(name), 'rt') as segment_file:
+                for line in segment_file:
+                    yield json.loads(line)
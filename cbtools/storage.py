@@ -0,0 +1,140 @@
+from datetime import timezone
+from decimal import Decimal
+
+from sqlalchemy import create_engine, event, DateTime, Numeric
+from sqlalchemy.dialects.postgresql.dml import OnConflictDoNothing, OnConflictDoUpdate
+from sqlalchemy.dialects.sqlite import DATETIME
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql import ClauseElement
+from sqlalchemy.sql.elements import BindParameter
+
+from cbtools.coercion import parse_timestamp
+
+
+# The tables live in Postgres by default. With CBTOOLS_DATABASE_URL set to
+# sqlite:///path/to/cbtools.db they live in an embedded SQLite file instead,
+# attached to every connection as the cbtools schema, so the models, their
+# schema qualified names and the Postgres INSERT ... ON CONFLICT statements
+# of the loaders run unchanged on either
+
+SCHEMA = 'cbtools'
+
+# WAL lets readers carry on while a sync writes, and with it NORMAL only
+# syncs the file at checkpoints rather than at every commit of a batch
+sqlite_pragmas = ['PRAGMA {0}.journal_mode = WAL'.format(SCHEMA),
+                  'PRAGMA {0}.synchronous = NORMAL'.format(SCHEMA),
+                  'PRAGMA {0}.cache_size = -65536'.format(SCHEMA),
+                  'PRAGMA temp_store = MEMORY',
+                  'PRAGMA foreign_keys = ON']
+
+
+class TextNumeric(Numeric):
+    # SQLite keeps numbers as 64-bit integers or doubles, which would round
+    # the 16 decimal places of the exchange's balances, so decimals are
+    # stored as text and read back exactly. Text neither sorts nor sums as
+    # a number in SQL, so whole number columns declared with scale=0, ids
+    # that are sorted and compared, are kept as integers instead
+    def bind_processor(self, dialect):
+        if self.scale == 0:
+            def process(value):
+                return None if value is None else int(value)
+        else:
+            def process(value):
+                return None if value is None else str(value)
+        return process
+
+    def result_processor(self, dialect, coltype):
+        def process(value):
+            # Sums and other arithmetic done by SQLite come back as numbers
+            return None if value is None else Decimal(str(value))
+        return process
+
+
+class UTCDateTime(DATETIME):
+    # Stored as UTC without an offset, and given back their time zone when
+    # read, as Postgres does for timestamp with time zone. Like Postgres it
+    # takes the API's ISO 8601 strings too, which the feed and the order
+    # acknowledgements upsert as they come
+    def bind_processor(self, dialect):
+        process = DATETIME.bind_processor(self, dialect)
+
+        def bind(value):
+            if isinstance(value, str):
+                value = parse_timestamp(value)
+            if value is not None and getattr(value, 'tzinfo', None) is not None:
+                value = value.astimezone(timezone.utc).replace(tzinfo=None)
+            return process(value)
+        return bind
+
+    def result_processor(self, dialect, coltype):
+        process = DATETIME.result_processor(self, dialect, coltype)
+
+        def result(value):
+            value = process(value)
+            if value is not None and self.timezone:
+                value = value.replace(tzinfo=timezone.utc)
+            return value
+        return result
+
+
+@compiles(Numeric, 'sqlite')
+def compile_numeric(element, compiler, **kw):
+    # TEXT affinity, NUMERIC would still turn long decimals into doubles
+    return 'INTEGER' if element.scale == 0 else 'TEXT'
+
+
+def conflict_target(compiler, clause):
+    # SQLite has no named constraints to conflict on, only their columns
+    elements = clause.inferred_target_elements
+    if clause.constraint_target is not None:
+        table = compiler.stack[-1]['selectable'].table
+        for constraint in list(table.constraints) + list(table.indexes):
+            if constraint.name == clause.constraint_target:
+                elements = list(getattr(constraint, 'columns', None) or constraint.expressions)
+    if not elements:
+        return ''
+    return '({0}) '.format(', '.join(compiler.preparer.quote(element) if isinstance(element, str)
+                                     else compiler.preparer.quote(element.name) for element in elements))
+
+
+@compiles(OnConflictDoNothing, 'sqlite')
+def compile_on_conflict_do_nothing(clause, compiler, **kw):
+    return 'ON CONFLICT {0}DO NOTHING'.format(conflict_target(compiler, clause))
+
+
+@compiles(OnConflictDoUpdate, 'sqlite')
+def compile_on_conflict_do_update(clause, compiler, **kw):
+    table = compiler.stack[-1]['selectable'].table
+    assignments = []
+    for key, value in clause.update_values_to_set:
+        column = table.c[key] if isinstance(key, str) else key
+        if not isinstance(value, ClauseElement):
+            value = BindParameter(None, value, type_=column.type)
+        assignments.append('{0} = {1}'.format(compiler.preparer.quote(column.name),
+                                              compiler.process(value.self_group(), use_schema=False)))
+    return 'ON CONFLICT {0}DO UPDATE SET {1}'.format(conflict_target(compiler, clause), ', '.join(assignments))
+
+
+def is_embedded(engine):
+    return engine.dialect.name == 'sqlite'
+
+
+def make_engine(uri):
+    url = make_url(uri)
+    if url.get_backend_name() != 'sqlite':
+        return create_engine(url)
+    path = url.database or ':memory:'
+    # The main database of each connection is an empty in-memory one, the
+    # tables are in the attached file
+    engine = create_engine('sqlite://', connect_args={'timeout': 30, 'check_same_thread': False})
+    engine.dialect.colspecs = dict(engine.dialect.colspecs)
+    engine.dialect.colspecs.update({Numeric: TextNumeric, DateTime: UTCDateTime})
+
+    @event.listens_for(engine, 'connect')
+    def attach(connection, record):
+        connection.execute('ATTACH DATABASE ? AS {0}'.format(SCHEMA), (path,))
+        for pragma in sqlite_pragmas:
+            connection.execute(pragma)
+
+    return engine
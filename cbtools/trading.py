@@ -1,34 +1,50 @@
+import argparse
+import time
 from pprint import pformat
 
-import requests
 from decimal import Decimal
 
-from cbtools.utilities import CoinbaseExchangeAuthentication
-from config import GDAX_API_KEY, GDAX_API_PASSPHRASE, GDAX_API_SECRET
+from cbtools.client import ExchangeClient
+from cbtools.orders import ladder, submit_orders, cancel_orders, record_orders
 
 if __name__ == '__main__':
-    exchange_api_url = 'https://api.gdax.com/'
-    exchange_auth = CoinbaseExchangeAuthentication(GDAX_API_KEY, GDAX_API_SECRET,
-                                                       GDAX_API_PASSPHRASE)
+    ARGS = argparse.ArgumentParser()
+    ARGS.add_argument('--cancel', action='store_true', dest='cancel', default=False,
+                      help='Cancel the open BTC-USD orders before laying down the ladder')
+    ARGS.add_argument('--step', dest='step', default='0.50', help='Price difference between the ladder\'s orders')
+    ARGS.add_argument('--size', dest='size', default='0.01', help='Size of each order')
+    args = ARGS.parse_args()
 
-    # requests.delete(exchange_api_url + 'orders', auth=exchange_auth)
-    exchange_accounts = requests.get(exchange_api_url + 'accounts', auth=exchange_auth).json()
+    from config import GDAX_API_KEY, GDAX_API_PASSPHRASE, GDAX_API_SECRET
+    exchange_client = ExchangeClient(GDAX_API_KEY, GDAX_API_SECRET, GDAX_API_PASSPHRASE)
+
+    if args.cancel:
+        canceled, failed = cancel_orders(exchange_client, product_id='BTC-USD')
+        record_orders([], canceled=canceled)
+        print('Canceled {0} orders'.format(len(canceled)))
+
+    exchange_accounts = exchange_client.get('accounts').json()
+    # One ticker for the whole run, so every ladder is priced off the same book
+    ticker = exchange_client.get('products/BTC-USD/ticker').json()
+    print(pformat(ticker))
+    best_bid = Decimal(ticker['bid'])
+    step = Decimal(args.step)
+    size = Decimal(args.size)
     for exchange_account in exchange_accounts:
         if exchange_account['currency'] != 'BTC':
             print(pformat(exchange_account))
-            ticker = requests.get(exchange_api_url + 'products/BTC-USD/ticker').json()
-            print(pformat(ticker))
-            best_bid = Decimal(ticker['bid'])
-            smallest_increment = Decimal('0.01') * best_bid
+            smallest_increment = size * best_bid
             balance_available = Decimal(exchange_account['available'])
             number_of_orders = int(balance_available/smallest_increment)
             print(number_of_orders)
-            our_bid = best_bid - Decimal('0.50')
-            for order_number in range(0, number_of_orders):
-                order = {'size': '0.01',
-                         'price': str(our_bid),
-                         'side': 'buy',
-                         'product_id': 'BTC-USD',
-                         'post_only': True}
-                requests.post(exchange_api_url + 'orders', json=order, auth=exchange_auth)
-                our_bid -= Decimal('0.50')
\ No newline at end of file
+            orders = ladder('BTC-USD', 'buy', best_bid - step, step, size, number_of_orders)
+            start = time.time()
+            results = submit_orders(exchange_client, orders)
+            accepted = [result for result in results if result.accepted]
+            unknown = [result for result in results if result.status == 'unknown']
+            print('{0} accepted, {1} rejected, {2} unknown in {3:.2f}s'.format(
+                len(accepted), len(results) - len(accepted) - len(unknown), len(unknown), time.time() - start))
+            for result in results:
+                if not result.accepted:
+                    print('{0} at {1}: {2}'.format(result.order['client_oid'], result.order['price'], result.reason))
+            record_orders(results, account_id=exchange_account['id'])
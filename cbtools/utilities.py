@@ -2,112 +2,34 @@ import time
 import hmac
 import hashlib
 import base64
-from pprint import pformat
 
-from coinbase.wallet.model import Money
-from requests.auth import AuthBase
+from cbtools.flatten import flatten_page
 
 
 def denest_json(json_document, account_id=None, resource=None):
-    if 'data' in json_document:
-        json_document = json_document['data']
-    if not isinstance(json_document, list):
-        json_documents = [json_document]
-    else:
-        json_documents = json_document
-    new_json_documents = []
-    for json_document in json_documents:
-        new_json_document = {}
-        for key, value in json_document.items():
-            if key == 'json_doc':
-                continue
-            elif isinstance(value, dict):
-                for nested_key, nested_value in value.items():
-                    if 'json_doc' in nested_key:
-                        continue
-                    elif isinstance(nested_value, list) and key == 'limits':
-                        for limit in nested_value:
-                            new_limit = {}
-                            for limit_key, limit_value in limit.items():
-                                if limit_key == 'json_doc':
-                                    continue
-                                elif isinstance(limit_value, dict):
-                                    for nested_limit_key, nested_limit_value in limit_value.items():
-                                        if nested_limit_key == 'json_doc':
-                                            continue
-                                        elif nested_limit_key == 'amount':
-                                            new_limit[limit_key] = nested_limit_value
-                                        else:
-                                            new_key = limit_key + '_' + nested_limit_key
-                                            new_limit[new_key] = nested_limit_value
-                                else:
-                                    new_limit[limit_key] = limit_value
-                                new_limit['resource'] = 'limit'
-                                new_limit['type'] = nested_key
-                                new_limit['payment_method_id'] = json_document['id']
-                            new_json_documents += [new_limit]
-                    elif isinstance(nested_value, str) or isinstance(nested_value, bool) or isinstance(nested_value, int) or nested_value is None:
-                        if nested_key == 'amount':
-                            new_json_document[key] = nested_value
-                        else:
-                            new_key = key + '_' + nested_key
-                            new_json_document[new_key] = nested_value
-                    elif isinstance(nested_value, Money):
-                        for subnested_key, subnested_value in nested_value.items():
-                            new_key = '_'.join([key, nested_key, subnested_key])
-                            new_json_document[new_key] = subnested_value
-                    else:
-                        print(type(nested_value))
-                        raise Exception()
-            elif isinstance(value, list) and json_document['resource'] in ['buy', 'sell', 'deposit', 'withdrawal']:
-                for fee in value:
-                    new_fee = {}
-                    for fee_key, fee_value in fee.items():
-                        if isinstance(fee_value, dict):
-                            for nested_fee_key, nested_fee_value in fee_value.items():
-                                if nested_fee_key == 'amount':
-                                    new_fee[fee_key] = nested_fee_value
-                                else:
-                                    new_key = fee_key + '_' + nested_fee_key
-                                    new_fee[new_key] = nested_fee_value
-                        elif isinstance(fee_value, str) or isinstance(fee_value, bool) or fee_value is None:
-                            new_fee[fee_key] = fee_value
-                        else:
-                            print(type(fee_value))
-                            raise Exception()
-                    new_fee['resource'] = 'fee'
-                    new_fee['source_id'] = json_document['id']
-                    new_json_documents += [new_fee]
-            elif isinstance(value, str) or isinstance(value, bool) or isinstance(value, int) or value is None:
-                new_json_document[key] = json_document[key]
-            else:
-                print(pformat(json_document))
-                print(type(value))
-                raise Exception()
-        if resource:
-            new_json_document['resource'] = resource
-        if account_id:
-            new_json_document['account_id'] = account_id
-        new_json_documents += [new_json_document]
-    if new_json_documents:
-        return new_json_documents
-    else:
-        return []
+    return flatten_page(json_document, account_id=account_id, resource=resource)
 
 
-class CoinbaseExchangeAuthentication(AuthBase):
+class CoinbaseExchangeAuthentication(object):
+    # requests takes any callable as auth, so there is no need to import it,
+    # and pay for it, just to subclass AuthBase
     def __init__(self, api_key, secret_key, passphrase):
         self.api_key = api_key
         self.secret_key = secret_key
+        self.hmac_key = base64.b64decode(secret_key)
         self.passphrase = passphrase
 
+    def sign(self, timestamp, method, path, body=''):
+        if isinstance(body, bytes):
+            body = body.decode('utf-8')
+        message = timestamp + method + path + body
+        message = message.encode('utf-8')
+        signature = hmac.new(self.hmac_key, message, hashlib.sha256)
+        return base64.b64encode(signature.digest())
+
     def __call__(self, request):
         timestamp = str(time.time())
-        message = timestamp + request.method + request.path_url + (request.body or '')
-        message = message.encode('utf-8')
-        hmac_key = base64.b64decode(self.secret_key)
-        signature = hmac.new(hmac_key, message, hashlib.sha256)
-        signature_b64 = base64.b64encode(signature.digest())
+        signature_b64 = self.sign(timestamp, request.method, request.path_url, request.body or '')
 
         request.headers.update({
             'CB-ACCESS-SIGN': signature_b64,
@@ -1,16 +1,28 @@
 import os
 
-from sqlalchemy.engine.url import URL
+# Settings are read from the environment when they are first imported, so a
+# command only needs the variables of the settings it uses
 
-COINBASE_KEY = os.environ['COINBASE_KEY']
-COINBASE_SECRET = os.environ['COINBASE_SECRET']
-GDAX_API_KEY = os.environ['GDAX_API_KEY']
-GDAX_API_SECRET = os.environ['GDAX_API_SECRET']
-GDAX_API_PASSPHRASE = os.environ['GDAX_API_PASSPHRASE']
+credential_names = ['COINBASE_KEY', 'COINBASE_SECRET', 'GDAX_API_KEY', 'GDAX_API_SECRET', 'GDAX_API_PASSPHRASE']
 
-URI = URL(drivername='postgresql+psycopg2',
-          username=os.environ['PGUSER'],
-          password=os.environ['PGPASSWORD'],
-          host=os.environ['PGHOST'],
-          port=os.environ['PGPORT'],
-          database=os.environ['CBTOOLS_PGDATABASE'])
+
+def database_uri():
+    # CBTOOLS_DATABASE_URL names another database instead, e.g.
+    # sqlite:///cbtools.db for an embedded one that needs no server
+    if os.environ.get('CBTOOLS_DATABASE_URL'):
+        return os.environ['CBTOOLS_DATABASE_URL']
+    from sqlalchemy.engine.url import URL
+    return URL(drivername='postgresql+psycopg2',
+               username=os.environ['PGUSER'],
+               password=os.environ['PGPASSWORD'],
+               host=os.environ['PGHOST'],
+               port=os.environ['PGPORT'],
+               database=os.environ['CBTOOLS_PGDATABASE'])
+
+
+def __getattr__(name):
+    if name in credential_names:
+        return os.environ[name]
+    elif name == 'URI':
+        return database_uri()
+    raise AttributeError('module {0!r} has no attribute {1!r}'.format(__name__, name))
@@ -0,0 +1,102 @@
+import argparse
+import json
+import statistics
+import sys
+
+sys.path.append('..')
+from cbtools.models import engine, Base, brin_indexes
+
+
+# Representative lookups and joins, each picking a real key from its table
+queries = [
+    ('fills of one order',
+     """SELECT * FROM cbtools.fills
+        WHERE order_id = (SELECT order_id FROM cbtools.fills ORDER BY id DESC LIMIT 1);"""),
+    ('fills of one product in the last 30 days',
+     """SELECT * FROM cbtools.fills
+        WHERE product_id = (SELECT product_id FROM cbtools.fills ORDER BY id DESC LIMIT 1)
+        AND created_at > now() - INTERVAL '30 days';"""),
+    ('fills of one day',
+     """SELECT count(*) FROM cbtools.fills
+        WHERE created_at >= (SELECT max(created_at) FROM cbtools.fills) - INTERVAL '1 day';"""),
+    ('latest ledger entries of one account',
+     """SELECT * FROM cbtools.entries
+        WHERE account_id = (SELECT account_id FROM cbtools.entries LIMIT 1)
+        ORDER BY created_at DESC LIMIT 100;"""),
+    ('ledger entries joined to their fills',
+     """SELECT entries.id, fills.price
+        FROM cbtools.entries
+        JOIN cbtools.fills ON fills.order_id = entries.order_id
+        WHERE entries.account_id = (SELECT account_id FROM cbtools.entries LIMIT 1)
+        AND entries.created_at > now() - INTERVAL '30 days';"""),
+    ('transactions of one account in a year',
+     """SELECT * FROM cbtools.transactions
+        WHERE account_id = (SELECT account_id FROM cbtools.transactions LIMIT 1)
+        AND created_at >= now() - INTERVAL '1 year';"""),
+    ('open orders of one product',
+     """SELECT * FROM cbtools.exchange_orders
+        WHERE product_id = 'BTC-USD' AND status IN ('open', 'pending', 'active');"""),
+]
+
+
+def explain(connection, query):
+    plan = connection.execute('EXPLAIN (ANALYZE, FORMAT JSON) ' + query).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]
+
+
+def scan_types(node):
+    types = set()
+    if 'Scan' in node['Node Type']:
+        types.add(node['Node Type'] + (' using ' + node['Index Name'] if 'Index Name' in node else ''))
+    for child in node.get('Plans', []):
+        types |= scan_types(child)
+    return types
+
+
+def run_queries(connection, runs):
+    results = []
+    for name, query in queries:
+        timings = []
+        for run in range(runs):
+            plan = explain(connection, query)
+            timings.append(plan['Execution Time'])
+        results.append((name, statistics.median(timings), scan_types(plan['Plan'])))
+    return results
+
+
+def drop_indexes(connection):
+    # The secondary indexes of the models and the --brin ones, dropped in
+    # the caller's transaction so rolling it back restores them
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            connection.execute('DROP INDEX IF EXISTS {0}.{1};'.format(table.schema, index.name))
+    for index in brin_indexes:
+        connection.execute('DROP INDEX IF EXISTS {0}.{1};'.format(index.table.schema, index.name))
+
+
+if __name__ == '__main__':
+    ARGS = argparse.ArgumentParser()
+    ARGS.add_argument('--runs', type=int, default=5, help='Runs of each query, the median is reported')
+    ARGS.add_argument('--compare', action='store_true', default=False,
+                      help='Also run the queries without the secondary indexes first, in a transaction that is '
+                           'rolled back; it locks the tables, so run it against a copy of the database')
+    args = ARGS.parse_args()
+
+    with engine.connect() as connection:
+        before = {}
+        if args.compare:
+            transaction = connection.begin()
+            drop_indexes(connection)
+            before = {name: (timing, scans) for name, timing, scans in run_queries(connection, args.runs)}
+            transaction.rollback()
+        for name, timing, scans in run_queries(connection, args.runs):
+            if name in before:
+                print('{0}: {1:.2f} ms, {2:.2f} ms without the indexes'.format(name, timing, before[name][0]))
+                for scan_type in sorted(before[name][1]):
+                    print('    without: ' + scan_type)
+            else:
+                print('{0}: {1:.2f} ms'.format(name, timing))
+            for scan_type in sorted(scans):
+                print('    ' + scan_type)
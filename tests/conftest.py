@@ -0,0 +1,38 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')))
+
+
+@pytest.fixture(params=['sqlite', 'postgresql'])
+def database(request, tmp_path, monkeypatch):
+    # A fresh database for each test, with the records of the database
+    # logger kept out of it. The tests run on an embedded database, and
+    # again on Postgres when CBTOOLS_TEST_DATABASE_URL names a scratch
+    # database, whose cbtools schema is dropped after each test
+    import cbtools
+    from cbtools import api, models
+    if request.param == 'sqlite':
+        url = 'sqlite:///' + str(tmp_path / 'cbtools.db')
+    else:
+        url = os.environ.get('CBTOOLS_TEST_DATABASE_URL')
+        if not url:
+            pytest.skip('CBTOOLS_TEST_DATABASE_URL is not set')
+    monkeypatch.setenv('CBTOOLS_DATABASE_URL', url)
+    monkeypatch.setattr(cbtools.db_logger, 'handlers', [])
+    models.session.remove()
+    models.engines.clear()
+    api.cache.invalidate()
+    engine = models.get_engine()
+    if request.param == 'postgresql':
+        engine.execute('DROP SCHEMA IF EXISTS cbtools CASCADE; CREATE SCHEMA cbtools;')
+    models.Base.metadata.create_all(bind=engine)
+    yield models.session
+    models.session.remove()
+    if request.param == 'postgresql':
+        engine.execute('DROP SCHEMA IF EXISTS cbtools CASCADE;')
+    engine.dispose()
+    models.engines.clear()
+    api.cache.invalidate()
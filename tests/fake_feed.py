@@ -0,0 +1,222 @@
+import argparse
+import base64
+import hashlib
+import json
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from fake_server import FakeCoinbase
+
+
+# A stand-in for the GDAX websocket feed that replays recorded messages, or a
+# synthetic session, to every client that subscribes, as fast as the client
+# reads them or at a multiple of the recorded pace
+
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+PROFILE_ID = str(uuid.UUID(int=1))
+USER_ID = 'user-1'
+START = datetime(2017, 6, 1)
+
+
+def synthetic_session(product_ids, orders, others_per_order=8):
+    # Own orders are received, opened, filled in one match against someone
+    # else's order and done, with other traffic on the full channel in between
+    sequences = {product_id: 0 for product_id in product_ids}
+    moment = START
+    trade_id = 0
+    for index in range(orders):
+        product_id = product_ids[index % len(product_ids)]
+        order_id = str(uuid.UUID(int=2 << 64 | index))
+        side = 'buy' if index % 2 else 'sell'
+        price = '{0:.2f}'.format(2500 + index % 100)
+        size = '{0:.8f}'.format(0.01 + index % 10 / 100.0)
+        messages = [{'type': 'received', 'order_id': order_id, 'order_type': 'limit', 'size': size,
+                     'price': price, 'side': side, 'client_oid': None, 'profile_id': PROFILE_ID,
+                     'user_id': USER_ID},
+                    {'type': 'open', 'order_id': order_id, 'price': price, 'remaining_size': size, 'side': side,
+                     'profile_id': PROFILE_ID, 'user_id': USER_ID}]
+        for other in range(others_per_order):
+            messages.append({'type': 'received', 'order_id': str(uuid.UUID(int=3 << 64 | index << 16 | other)),
+                             'order_type': 'limit', 'size': size, 'price': price, 'side': side})
+        trade_id += 1
+        messages += [{'type': 'match', 'trade_id': trade_id, 'maker_order_id': order_id,
+                      'taker_order_id': str(uuid.UUID(int=3 << 64 | index << 16)), 'side': side, 'size': size,
+                      'price': price, 'maker_profile_id': PROFILE_ID, 'maker_user_id': USER_ID,
+                      'profile_id': PROFILE_ID, 'user_id': USER_ID},
+                     {'type': 'done', 'order_id': order_id, 'price': price, 'remaining_size': '0.00000000',
+                      'side': side, 'reason': 'filled', 'profile_id': PROFILE_ID, 'user_id': USER_ID}]
+        for message in messages:
+            sequences[product_id] += 1
+            moment += timedelta(milliseconds=10)
+            message.update(product_id=product_id, sequence=sequences[product_id],
+                           time=moment.strftime('%Y-%m-%dT%H:%M:%S.%fZ'))
+            yield message
+
+
+def accept(connection):
+    request = b''
+    while b'\r\n\r\n' not in request:
+        data = connection.recv(4096)
+        if not data:
+            raise ConnectionError('Closed during the handshake')
+        request += data
+    headers = dict(line.split(': ', 1) for line in request.decode('latin-1').split('\r\n')[1:] if ': ' in line)
+    key = {name.lower(): value for name, value in headers.items()}['sec-websocket-key']
+    accept_key = base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode('ascii')).digest()).decode('ascii')
+    connection.sendall('HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                       'Sec-WebSocket-Accept: {0}\r\n\r\n'.format(accept_key).encode('ascii'))
+
+
+def receive_exactly(connection, length):
+    data = b''
+    while len(data) < length:
+        chunk = connection.recv(length - len(data))
+        if not chunk:
+            raise ConnectionError('Closed mid frame')
+        data += chunk
+    return data
+
+
+def receive_frame(connection):
+    first, second = receive_exactly(connection, 2)
+    length = second & 0x7f
+    if length == 126:
+        length = struct.unpack('!H', receive_exactly(connection, 2))[0]
+    elif length == 127:
+        length = struct.unpack('!Q', receive_exactly(connection, 8))[0]
+    mask = receive_exactly(connection, 4) if second & 0x80 else b'\x00' * 4
+    payload = receive_exactly(connection, length)
+    return first & 0x0f, bytes(byte ^ mask[index % 4] for index, byte in enumerate(payload))
+
+
+def frame(payload, opcode=0x1):
+    if len(payload) < 126:
+        header = struct.pack('!BB', 0x80 | opcode, len(payload))
+    elif len(payload) < 1 << 16:
+        header = struct.pack('!BBH', 0x80 | opcode, 126, len(payload))
+    else:
+        header = struct.pack('!BBQ', 0x80 | opcode, 127, len(payload))
+    return header + payload
+
+
+class FakeFeed(object):
+    def __init__(self, messages, speed=0.0, drop_every=0):
+        self.messages = messages
+        self.speed = speed
+        self.drop_every = drop_every
+        self.sent = 0
+        self.dropped = 0
+        self.subscriptions = []
+        self.server = None
+        self.thread = None
+
+    def serve(self, connection):
+        try:
+            accept(connection)
+            opcode, payload = receive_frame(connection)
+            self.subscriptions.append(json.loads(payload.decode('utf-8')))
+            connection.sendall(frame(json.dumps({'type': 'subscriptions',
+                                                 'channels': self.subscriptions[-1]['channels']}).encode('utf-8')))
+            previous = None
+            for index, message in enumerate(self.messages, 1):
+                if self.drop_every and index % self.drop_every == 0:
+                    self.dropped += 1
+                    continue
+                if self.speed and previous is not None:
+                    delay = (parse_time(message['time']) - parse_time(previous)).total_seconds() / self.speed
+                    if delay > 0:
+                        time.sleep(delay)
+                previous = message['time']
+                connection.sendall(frame(json.dumps(message).encode('utf-8')))
+                self.sent += 1
+            connection.sendall(frame(struct.pack('!H', 1000), opcode=0x8))
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            connection.close()
+
+    def run(self):
+        while True:
+            try:
+                connection, address = self.server.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.serve, args=(connection,), daemon=True).start()
+
+    def start(self, host='127.0.0.1', port=0):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((host, port))
+        self.server.listen(5)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return 'ws://{0}:{1}/'.format(*self.server.getsockname())
+
+    def stop(self):
+        self.server.close()
+
+
+def parse_time(value):
+    return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+def read_recording(path):
+    with open(path, 'r') as recording:
+        for line in recording:
+            if line.strip():
+                yield json.loads(line)
+
+
+if __name__ == '__main__':
+    ARGS = argparse.ArgumentParser()
+    ARGS.add_argument('--replay', dest='replay', default=None,
+                      help='NDJSON file recorded with cbtools/feed.py --record, a synthetic session otherwise')
+    ARGS.add_argument('--orders', type=int, default=10000, help='Own orders in the synthetic session')
+    ARGS.add_argument('--products', nargs='+', default=['BTC-USD', 'ETH-USD'])
+    ARGS.add_argument('--speed', type=float, default=0.0,
+                      help='Multiple of the recorded pace to replay at, as fast as possible by default')
+    ARGS.add_argument('--drop-every', type=int, dest='drop_every', default=0,
+                      help='Drop every Nth message to exercise the sequence gap resync')
+    ARGS.add_argument('--flush-ms', type=int, dest='flush_ms', default=250)
+    ARGS.add_argument('--load', action='store_true', default=False,
+                      help='Write to the configured database, which should be a scratch one')
+    args = ARGS.parse_args()
+
+    from cbtools.client import ExchangeClient
+    from cbtools.feed import FeedIngester
+    from cbtools.metrics import registry
+    from cbtools.ratelimit import TokenBucket
+
+    if args.replay:
+        messages = list(read_recording(args.replay))
+    else:
+        messages = list(synthetic_session(args.products, args.orders))
+    feed = FakeFeed(messages, args.speed, args.drop_every)
+    rest = FakeCoinbase(exchange_accounts=4, rows=100)
+    feed_url = feed.start()
+    rest_url = rest.start()
+    client = ExchangeClient('key', 'c2VjcmV0', 'passphrase', url=rest_url, limiter=TokenBucket(10 ** 6))
+    ingester = FeedIngester(client, args.products, url=feed_url, flush_interval=args.flush_ms / 1000.0,
+                            dry_run=not args.load)
+    start = time.time()
+    ingester.run()
+    elapsed = time.time() - start
+    feed.stop()
+    rest.stop()
+
+    print('{0} messages in {1:.2f}s ({2:.0f} messages/sec), {3} dropped'.format(
+        ingester.messages, elapsed, ingester.messages / max(elapsed, 1e-6), feed.dropped))
+    for (name, labels), value in sorted(registry.counters.items()):
+        if name in ('cbtools_feed_rows_total', 'cbtools_feed_gaps_total'):
+            print('{0} {1}: {2}'.format(name, dict(labels), value))
+    flushes = [histogram for (name, labels), histogram in registry.histograms.items()
+               if name == 'cbtools_feed_flush_seconds']
+    if flushes:
+        print('{0} flushes, {1:.4f}s mean'.format(flushes[0].count, flushes[0].sum / flushes[0].count))
@@ -0,0 +1,405 @@
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+
+# A stand-in for the Coinbase wallet API (/v2/...) and the GDAX REST API,
+# serving synthetic accounts whose rows are generated on demand from their
+# position, so accounts with millions of rows cost no memory
+
+START = datetime(2017, 6, 1)
+PRODUCTS = ['BTC-USD', 'ETH-USD', 'LTC-USD', 'ETH-BTC', 'LTC-BTC']
+WALLET_END_POINTS = ['buys', 'sells', 'deposits', 'withdrawals', 'addresses', 'transactions']
+EXCHANGE_END_POINTS = ['ledger', 'holds', 'orders', 'fills']
+WALLET_PAGE_SIZE = 25
+EXCHANGE_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 100
+
+USER = 1
+WALLET_ACCOUNT = 2
+PAYMENT_METHOD = 3
+EXCHANGE_ACCOUNT = 4
+WALLET_ROW = 5
+EXCHANGE_ROW = 6
+INDEX_BITS = 64
+
+
+def make_id(kind, account=0, end_point=0, index=0):
+    return str(uuid.UUID(int=kind << 120 | account << 96 | end_point << INDEX_BITS | index))
+
+
+def id_index(row_id):
+    return uuid.UUID(row_id).int & ((1 << INDEX_BITS) - 1)
+
+
+def timestamp(index, fractional=False):
+    moment = START - timedelta(seconds=60 * index)
+    if fractional:
+        return moment.strftime('%Y-%m-%dT%H:%M:%S.') + '{0:06d}Z'.format(index % 1000000)
+    return moment.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def moment(index):
+    # The exact created_at of the exchange row at this index
+    return START - timedelta(seconds=60 * index) + timedelta(microseconds=index % 1000000)
+
+
+def parse_date(value):
+    return datetime.strptime(value.rstrip('Z')[:26], '%Y-%m-%dT%H:%M:%S.%f' if '.' in value else '%Y-%m-%dT%H:%M:%S')
+
+
+def money(amount, currency):
+    return {'amount': '{0:.8f}'.format(amount), 'currency': currency}
+
+
+def page_size(params, default):
+    return min(int(params.get('limit', [default])[0]), MAX_PAGE_SIZE)
+
+
+def reference(resource, resource_id, resource_path):
+    return {'id': resource_id, 'resource': resource, 'resource_path': resource_path}
+
+
+class FakeCoinbase(object):
+    def __init__(self, wallet_accounts=2, exchange_accounts=2, rows=1000, latency=0.0, rate_limit=0.0,
+                 seed=0, first_account=0):
+        # Servers standing in for different profiles number their accounts
+        # from different first_accounts, so their ids do not collide
+        accounts = range(first_account, first_account + wallet_accounts)
+        self.wallet_accounts = [make_id(WALLET_ACCOUNT, account) for account in accounts]
+        accounts = range(first_account, first_account + exchange_accounts)
+        self.exchange_accounts = [make_id(EXCHANGE_ACCOUNT, account) for account in accounts]
+        self.first_account = first_account
+        self.rows = rows
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.request_times = []
+        self.rate_limited = 0
+        self.open_orders = {}
+        self.bid = Decimal('2499.99')
+        self.ask = Decimal('2500.00')
+        self.server = None
+        self.thread = None
+
+    # Wallet documents
+
+    def user(self):
+        user_id = make_id(USER)
+        return {'id': user_id, 'name': 'Satoshi Nakamoto', 'username': 'satoshi', 'profile_location': None,
+                'profile_bio': None, 'profile_url': None, 'avatar_url': 'https://example.com/avatar.png',
+                'resource': 'user', 'resource_path': '/v2/user', 'email': 'satoshi@example.com',
+                'time_zone': 'UTC', 'native_currency': 'USD', 'bitcoin_unit': 'BTC', 'state': 'CA',
+                'country': {'code': 'US', 'name': 'United States'},
+                'created_at': timestamp(10 ** 6)}
+
+    def wallet_account(self, account):
+        account_id = self.wallet_accounts[account]
+        currency = ['BTC', 'ETH', 'LTC', 'USD'][account % 4]
+        return {'id': account_id, 'name': '{0} Wallet'.format(currency), 'primary': account == 0,
+                'type': 'fiat' if currency == 'USD' else 'wallet', 'currency': currency,
+                'balance': money(account + 1.5, currency), 'native_balance': money(2500 * (account + 1.5), 'USD'),
+                'created_at': timestamp(10 ** 6), 'updated_at': timestamp(0), 'resource': 'account',
+                'resource_path': '/v2/accounts/' + account_id}
+
+    def payment_method(self):
+        payment_method_id = make_id(PAYMENT_METHOD)
+        limit = {'period_in_days': 7, 'total': money(3000, 'USD'), 'remaining': money(3000, 'USD')}
+        payment_method = {'id': payment_method_id, 'type': 'ach_bank_account', 'name': 'Bank *****1111',
+                          'currency': 'USD', 'primary_buy': True, 'primary_sell': True, 'allow_buy': True,
+                          'allow_sell': True, 'allow_deposit': True, 'allow_withdraw': True, 'instant_buy': False,
+                          'instant_sell': False, 'created_at': timestamp(10 ** 6), 'updated_at': timestamp(0),
+                          'resource': 'payment_method', 'resource_path': '/v2/payment-methods/' + payment_method_id,
+                          'verified': True,
+                          'limits': {'type': 'bank', 'name': 'Bank Account', 'buy': [limit], 'deposit': [limit]}}
+        if self.wallet_accounts:
+            # Without wallet accounts the bank has no fiat account to settle in
+            fiat_account_id = self.wallet_accounts[-1]
+            payment_method['fiat_account'] = reference('account', fiat_account_id, '/v2/accounts/' + fiat_account_id)
+        return payment_method
+
+    def wallet_row(self, account, end_point, index):
+        account_id = self.wallet_accounts[account]
+        row_id = make_id(WALLET_ROW, account, WALLET_END_POINTS.index(end_point), index)
+        currency = self.wallet_account(account)['currency']
+        amount = 0.01 + (index * 7919 % 100000) / 10000.0
+        path = '/v2/accounts/{0}/{1}/{2}'.format(account_id, end_point, row_id)
+        if end_point == 'addresses':
+            return {'id': row_id, 'address': '1{0:033x}'.format(index)[:34], 'name': None,
+                    'network': 'bitcoin', 'uri_scheme': 'bitcoin', 'callback_url': None,
+                    'created_at': timestamp(index), 'updated_at': timestamp(index),
+                    'resource': 'address', 'resource_path': path}
+        if end_point == 'transactions':
+            document = {'id': row_id, 'type': 'send', 'status': 'completed', 'amount': money(-amount, currency),
+                        'native_amount': money(-amount * 2500, 'USD'), 'description': None,
+                        'created_at': timestamp(index), 'updated_at': timestamp(index),
+                        'resource': 'transaction', 'resource_path': path, 'instant_exchange': False,
+                        'network': {'status': 'confirmed', 'hash': '{0:064x}'.format(index)},
+                        'to': {'resource': 'bitcoin_address', 'address': '1{0:033x}'.format(index)[:34]}}
+            if index % 4 == 0:
+                # Buys are loaded before transactions, so this reference is
+                # to a row of the same account that already exists
+                buy_id = make_id(WALLET_ROW, account, WALLET_END_POINTS.index('buys'), index)
+                document.update(type='buy', amount=money(amount, currency), network={'status': 'off_blockchain'},
+                                buy=reference('buy', buy_id, '/v2/accounts/{0}/buys/{1}'.format(account_id,
+                                                                                                  buy_id)))
+                del document['to']
+            return document
+        payment_method_id = make_id(PAYMENT_METHOD)
+        transaction_id = make_id(WALLET_ROW, account, WALLET_END_POINTS.index('transactions'), index)
+        return {'id': row_id, 'status': 'completed', 'resource': end_point[:-1], 'resource_path': path,
+                'payment_method': reference('payment_method', payment_method_id,
+                                            '/v2/payment-methods/' + payment_method_id),
+                'transaction': reference('transaction', transaction_id,
+                                         '/v2/accounts/{0}/transactions/{1}'.format(account_id, transaction_id)),
+                'amount': money(amount, currency), 'total': money(amount * 2500 + 1.49, 'USD'),
+                'subtotal': money(amount * 2500, 'USD'), 'created_at': timestamp(index),
+                'updated_at': timestamp(index), 'committed': True, 'instant': False,
+                'payout_at': timestamp(index)}
+
+    # Exchange documents
+
+    def exchange_account(self, account):
+        currency = ['BTC', 'ETH', 'LTC', 'USD'][account % 4]
+        return {'id': self.exchange_accounts[account], 'currency': currency, 'balance': '{0:.16f}'.format(account + 1),
+                'available': '{0:.16f}'.format(account + 0.5), 'hold': '0.5000000000000000',
+                'profile_id': make_id(USER, end_point=1)}
+
+    def exchange_row(self, account, end_point, index):
+        product_id = PRODUCTS[index % len(PRODUCTS)]
+        size = 0.001 + (index * 7919 % 100000) / 100000.0
+        price = 1000 + (index * 104729 % 300000) / 100.0
+        order_id = make_id(EXCHANGE_ROW, self.first_account, EXCHANGE_END_POINTS.index('orders'), index)
+        if end_point == 'ledger':
+            return {'id': str(self.first_account * self.rows + self.rows - index), 'created_at': timestamp(index, fractional=True),
+                    'amount': '{0:.16f}'.format(size), 'balance': '{0:.16f}'.format(size * (self.rows - index)),
+                    'type': 'match', 'details': {'order_id': order_id, 'trade_id': str(self.rows - index),
+                                                'product_id': product_id}}
+        if end_point == 'holds':
+            return {'id': make_id(EXCHANGE_ROW, self.first_account + account, EXCHANGE_END_POINTS.index('holds'),
+                                  index),
+                    'account_id': self.exchange_accounts[account], 'created_at': timestamp(index, fractional=True),
+                    'updated_at': timestamp(index, fractional=True), 'amount': '{0:.8f}'.format(size),
+                    'type': 'order', 'ref': order_id}
+        if end_point == 'orders':
+            return {'id': order_id, 'price': '{0:.8f}'.format(price), 'size': '{0:.8f}'.format(size),
+                    'product_id': product_id, 'side': 'buy' if index % 2 else 'sell', 'stp': 'dc',
+                    'type': 'limit', 'time_in_force': 'GTC', 'post_only': False,
+                    'created_at': timestamp(index, fractional=True), 'fill_fees': '0.0000000000000000',
+                    'filled_size': '{0:.8f}'.format(size), 'executed_value': '{0:.16f}'.format(size * price),
+                    'status': 'done', 'settled': True}
+        return {'trade_id': self.rows - index, 'product_id': product_id, 'price': '{0:.8f}'.format(price),
+                'size': '{0:.8f}'.format(size), 'order_id': order_id, 'created_at': timestamp(index, fractional=True),
+                'liquidity': 'T' if index % 3 else 'M', 'fee': '{0:.16f}'.format(size * price * 0.0025),
+                'settled': True, 'side': 'buy' if index % 2 else 'sell'}
+
+    # HTTP
+
+    def wallet_response(self, parts, params):
+        if parts == ['user']:
+            return 200, {'data': self.user()}, {}
+        if parts == ['accounts']:
+            data = [self.wallet_account(account) for account in range(len(self.wallet_accounts))]
+            return 200, {'pagination': self.pagination(None), 'data': data}, {}
+        if parts == ['payment-methods']:
+            return 200, {'pagination': self.pagination(None), 'data': [self.payment_method()]}, {}
+        if len(parts) == 3 and parts[0] == 'accounts' and parts[2] in WALLET_END_POINTS:
+            if parts[1] not in self.wallet_accounts:
+                return 404, {'errors': [{'id': 'not_found', 'message': 'Not found'}]}, {}
+            account = self.wallet_accounts.index(parts[1])
+            limit = page_size(params, WALLET_PAGE_SIZE)
+            first = id_index(params['starting_after'][0]) + 1 if 'starting_after' in params else 0
+            last = min(first + limit, self.rows)
+            data = [self.wallet_row(account, parts[2], index) for index in range(first, last)]
+            next_uri = None
+            if last < self.rows:
+                next_uri = '/v2/accounts/{0}/{1}?starting_after={2}'.format(parts[1], parts[2], data[-1]['id'])
+            return 200, {'pagination': self.pagination(next_uri, limit), 'data': data}, {}
+        return 404, {'errors': [{'id': 'not_found', 'message': 'Not found'}]}, {}
+
+    def pagination(self, next_uri, limit=WALLET_PAGE_SIZE):
+        return {'ending_before': None, 'starting_after': None, 'limit': limit, 'order': 'desc',
+                'previous_uri': None, 'next_uri': next_uri}
+
+    def exchange_response(self, parts, params):
+        if parts == ['accounts']:
+            return 200, [self.exchange_account(account) for account in range(len(self.exchange_accounts))], {}
+        if len(parts) == 3 and parts[0] == 'products' and parts[2] == 'ticker':
+            return 200, {'trade_id': self.rows, 'price': str(self.bid), 'size': '0.01000000', 'bid': str(self.bid),
+                         'ask': str(self.ask), 'volume': '1000.00000000', 'time': timestamp(0, fractional=True)}, {}
+        if parts == ['products']:
+            return 200, [{'id': product_id, 'base_currency': product_id.split('-')[0],
+                          'quote_currency': product_id.split('-')[1]} for product_id in PRODUCTS], {}
+        if len(parts) == 2 and parts[0] == 'orders':
+            # Only the orders placed here and still open are known by id
+            with self.lock:
+                order = self.open_orders.get(parts[1])
+            if order is None:
+                return 404, {'message': 'NotFound'}, {}
+            return 200, order, {}
+        if parts in (['orders'], ['fills']):
+            account, end_point = 0, parts[0]
+        elif len(parts) == 3 and parts[0] == 'accounts' and parts[2] in ('ledger', 'holds'):
+            if parts[1] not in self.exchange_accounts:
+                return 404, {'message': 'NotFound'}, {}
+            account, end_point = self.exchange_accounts.index(parts[1]), parts[2]
+        else:
+            return 404, {'message': 'NotFound'}, {}
+        indexes = self.exchange_indexes(end_point, params)
+        limit = page_size(params, EXCHANGE_PAGE_SIZE)
+        first = int(params['after'][0]) if 'after' in params else 0
+        last = min(first + limit, len(indexes))
+        headers = {'CB-BEFORE': str(first)}
+        if last < len(indexes):
+            headers['CB-AFTER'] = str(last)
+        return 200, [self.exchange_row(account, end_point, index) for index in indexes[first:last]], headers
+
+    def exchange_indexes(self, end_point, params):
+        # The rows between start_date and end_date, both inclusive, of one
+        # product when product_id is given, as a range whose positions are
+        # the cursors
+        first, last = 0, self.rows - 1
+        if 'end_date' in params:
+            end = parse_date(params['end_date'][0])
+            first = max(first, -int((end - START).total_seconds() // 60))
+            while first < self.rows and moment(first) > end:
+                first += 1
+        if 'start_date' in params:
+            start = parse_date(params['start_date'][0])
+            last = min(last, int((START - start).total_seconds() // 60))
+            # Down to the microseconds of the rows' timestamps, so a row on
+            # the edge of two windows is returned by both
+            while last + 1 < self.rows and moment(last + 1) >= start:
+                last += 1
+            while last >= 0 and moment(last) < start:
+                last -= 1
+        if 'product_id' in params and end_point in ('orders', 'fills'):
+            product = PRODUCTS.index(params['product_id'][0])
+            first += (product - first) % len(PRODUCTS)
+            return range(first, max(first, last + 1), len(PRODUCTS))
+        return range(first, max(first, last + 1))
+
+    def order_response(self, method, parts, params, body):
+        # Orders are accepted unless a post only order would take liquidity,
+        # and stay open until canceled
+        if method == 'POST' and parts == ['orders']:
+            order = dict(body)
+            crosses = (Decimal(order['price']) >= self.ask if order['side'] == 'buy'
+                       else Decimal(order['price']) <= self.bid)
+            order.update(id=str(uuid.uuid4()), created_at=timestamp(0, fractional=True), fill_fees='0',
+                         filled_size='0', executed_value='0', settled=False, type='limit',
+                         time_in_force='GTC', stp='dc')
+            if order.get('post_only') and crosses:
+                order.update(status='rejected', reject_reason='post only')
+            else:
+                order['status'] = 'pending'
+                with self.lock:
+                    self.open_orders[order['id']] = order
+            return 200, order, {}
+        if method == 'DELETE' and parts == ['orders']:
+            product_id = params.get('product_id', [None])[0]
+            with self.lock:
+                canceled = [order_id for order_id, order in self.open_orders.items()
+                            if product_id is None or order['product_id'] == product_id]
+                for order_id in canceled:
+                    del self.open_orders[order_id]
+            return 200, canceled, {}
+        if method == 'DELETE' and len(parts) == 2 and parts[0] == 'orders':
+            with self.lock:
+                if self.open_orders.pop(parts[1], None) is None:
+                    return 404, {'message': 'order not found'}, {}
+            return 200, [parts[1]], {}
+        return 404, {'message': 'NotFound'}, {}
+
+    def respond(self, handler):
+        if self.latency:
+            time.sleep(self.latency)
+        url = urlsplit(handler.path)
+        parts = [part for part in url.path.split('/') if part]
+        params = parse_qs(url.query)
+        # Read even when the request is turned away, or the body would be
+        # taken for the next request on the connection
+        length = int(handler.headers.get('Content-Length') or 0)
+        request_body = json.loads(handler.rfile.read(length).decode('utf-8')) if length else None
+        with self.lock:
+            self.requests += 1
+            self.request_times.append(time.time())
+            throttled = self.rate_limit and self.random.random() < self.rate_limit
+            if throttled:
+                self.rate_limited += 1
+        if parts[:1] == ['v2']:
+            if throttled:
+                status, body, headers = 429, {'errors': [{'id': 'rate_limit_exceeded',
+                                                          'message': 'Too many requests'}]}, {}
+            else:
+                status, body, headers = self.wallet_response(parts[1:], params)
+        elif throttled:
+            status, body, headers = 429, {'message': 'Rate limit exceeded'}, {}
+        elif handler.command == 'GET':
+            status, body, headers = self.exchange_response(parts, params)
+        else:
+            status, body, headers = self.order_response(handler.command, parts, params, request_body)
+        payload = json.dumps(body).encode('utf-8')
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(payload)))
+        for key, value in headers.items():
+            handler.send_header(key, value)
+        handler.end_headers()
+        handler.wfile.write(payload)
+
+    def start(self, host='127.0.0.1', port=0):
+        self.server = ThreadingHTTPServer((host, port), FakeCoinbaseHandler)
+        self.server.fake = self
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return 'http://{0}:{1}/'.format(*self.server.server_address)
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+
+class FakeCoinbaseHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in one write, otherwise delayed ACKs stall
+    # every keep-alive response
+    wbufsize = 64 * 1024
+
+    def do_GET(self):
+        self.server.fake.respond(self)
+
+    do_POST = do_GET
+    do_DELETE = do_GET
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == '__main__':
+    ARGS = argparse.ArgumentParser()
+    ARGS.add_argument('--port', type=int, default=8000)
+    ARGS.add_argument('--wallet-accounts', type=int, dest='wallet_accounts', default=2)
+    ARGS.add_argument('--exchange-accounts', type=int, dest='exchange_accounts', default=2)
+    ARGS.add_argument('--rows', type=int, default=1000, help='Rows per account and endpoint')
+    ARGS.add_argument('--latency', type=float, default=0.0, help='Seconds added to every response')
+    ARGS.add_argument('--rate-limit', type=float, dest='rate_limit', default=0.0,
+                      help='Fraction of requests answered with HTTP 429')
+    args = ARGS.parse_args()
+
+    fake = FakeCoinbase(args.wallet_accounts, args.exchange_accounts, args.rows, args.latency, args.rate_limit)
+    print('Serving on ' + fake.start(port=args.port))
+    try:
+        fake.thread.join()
+    except KeyboardInterrupt:
+        fake.stop()
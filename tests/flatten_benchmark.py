@@ -0,0 +1,170 @@
+import argparse
+import json
+import os
+import random
+import sys
+import timeit
+from pprint import pformat
+
+from coinbase.wallet.model import Money
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from cbtools.flatten import flatten_page
+
+
+# denest_json as it was before the flattening plans, kept as the reference
+# the plans have to reproduce
+def legacy_denest_json(json_document, account_id=None, resource=None):
+    if 'data' in json_document:
+        json_document = json_document['data']
+    if not isinstance(json_document, list):
+        json_documents = [json_document]
+    else:
+        json_documents = json_document
+    new_json_documents = []
+    for json_document in json_documents:
+        new_json_document = {}
+        for key, value in json_document.items():
+            if key == 'json_doc':
+                continue
+            elif isinstance(value, dict):
+                for nested_key, nested_value in value.items():
+                    if 'json_doc' in nested_key:
+                        continue
+                    elif isinstance(nested_value, list) and key == 'limits':
+                        for limit in nested_value:
+                            new_limit = {}
+                            for limit_key, limit_value in limit.items():
+                                if limit_key == 'json_doc':
+                                    continue
+                                elif isinstance(limit_value, dict):
+                                    for nested_limit_key, nested_limit_value in limit_value.items():
+                                        if nested_limit_key == 'json_doc':
+                                            continue
+                                        elif nested_limit_key == 'amount':
+                                            new_limit[limit_key] = nested_limit_value
+                                        else:
+                                            new_key = limit_key + '_' + nested_limit_key
+                                            new_limit[new_key] = nested_limit_value
+                                else:
+                                    new_limit[limit_key] = limit_value
+                                new_limit['resource'] = 'limit'
+                                new_limit['type'] = nested_key
+                                new_limit['payment_method_id'] = json_document['id']
+                            new_json_documents += [new_limit]
+                    elif isinstance(nested_value, str) or isinstance(nested_value, bool) or isinstance(nested_value, int) or nested_value is None:
+                        if nested_key == 'amount':
+                            new_json_document[key] = nested_value
+                        else:
+                            new_key = key + '_' + nested_key
+                            new_json_document[new_key] = nested_value
+                    elif isinstance(nested_value, Money):
+                        for subnested_key, subnested_value in nested_value.items():
+                            new_key = '_'.join([key, nested_key, subnested_key])
+                            new_json_document[new_key] = subnested_value
+                    else:
+                        print(type(nested_value))
+                        raise Exception()
+            elif isinstance(value, list) and json_document['resource'] in ['buy', 'sell', 'deposit', 'withdrawal']:
+                for fee in value:
+                    new_fee = {}
+                    for fee_key, fee_value in fee.items():
+                        if isinstance(fee_value, dict):
+                            for nested_fee_key, nested_fee_value in fee_value.items():
+                                if nested_fee_key == 'amount':
+                                    new_fee[fee_key] = nested_fee_value
+                                else:
+                                    new_key = fee_key + '_' + nested_fee_key
+                                    new_fee[new_key] = nested_fee_value
+                        elif isinstance(fee_value, str) or isinstance(fee_value, bool) or fee_value is None:
+                            new_fee[fee_key] = fee_value
+                        else:
+                            print(type(fee_value))
+                            raise Exception()
+                    new_fee['resource'] = 'fee'
+                    new_fee['source_id'] = json_document['id']
+                    new_json_documents += [new_fee]
+            elif isinstance(value, str) or isinstance(value, bool) or isinstance(value, int) or value is None:
+                new_json_document[key] = json_document[key]
+            else:
+                print(pformat(json_document))
+                print(type(value))
+                raise Exception()
+        if resource:
+            new_json_document['resource'] = resource
+        if account_id:
+            new_json_document['account_id'] = account_id
+        new_json_documents += [new_json_document]
+    if new_json_documents:
+        return new_json_documents
+    else:
+        return []
+
+
+def load_corpus(data_directory):
+    corpus = []
+    for json_file_name in sorted(os.listdir(data_directory)):
+        if json_file_name.endswith('.json'):
+            with open(os.path.join(data_directory, json_file_name), 'r') as json_file:
+                corpus.append(json.load(json_file))
+    return corpus
+
+
+def synthetic_corpus(pages, page_size):
+    corpus = []
+    for page_number in range(pages):
+        page = []
+        for document_number in range(page_size):
+            document_id = '{0}-{1}'.format(page_number, document_number)
+            resource = random.choice(['buy', 'transaction'])
+            document = {'id': document_id,
+                        'resource': resource,
+                        'resource_path': '/v2/accounts/a/{0}s/{1}'.format(resource, document_id),
+                        'status': 'completed',
+                        'created_at': '2017-01-01T00:00:00Z',
+                        'updated_at': '2017-01-01T00:00:00Z',
+                        'amount': {'amount': '1.00000000', 'currency': 'BTC'},
+                        'native_amount': {'amount': '1000.00', 'currency': 'USD'},
+                        'instant_exchange': False}
+            if resource == 'buy':
+                document['fees'] = [{'type': 'coinbase', 'amount': {'amount': '1.49', 'currency': 'USD'}}]
+                document['transaction'] = {'id': 't' + document_id, 'resource': 'transaction'}
+            else:
+                document['details'] = {'title': 'Bought bitcoin', 'subtitle': 'using Bank'}
+                document['to'] = {'resource': 'email', 'email': 'someone@example.com'}
+            page.append(document)
+        corpus.append({'data': page})
+    return corpus
+
+
+if __name__ == '__main__':
+    ARGS = argparse.ArgumentParser()
+    ARGS.add_argument('--pages', type=int, default=200, help='Pages of synthetic documents without fixtures')
+    ARGS.add_argument('--page-size', type=int, default=100, help='Documents per synthetic page')
+    ARGS.add_argument('--repeat', type=int, default=5, help='Timing repetitions')
+    args = ARGS.parse_args()
+
+    tests_directory = os.path.dirname(os.path.realpath(__file__))
+    data_directory = os.path.join(tests_directory, 'data')
+    if os.path.exists(data_directory) and os.listdir(data_directory):
+        corpus = load_corpus(data_directory)
+        print('Recorded corpus: {0} pages'.format(len(corpus)))
+    else:
+        corpus = synthetic_corpus(args.pages, args.page_size)
+        print('Synthetic corpus: {0} pages of {1} documents'.format(args.pages, args.page_size))
+
+    for page in corpus:
+        expected = json.dumps(legacy_denest_json(page))
+        actual = json.dumps(flatten_page(page))
+        if expected != actual:
+            print(pformat(page))
+            raise Exception('Flattened output differs from denest_json')
+    print('Output is identical')
+
+    legacy_time = min(timeit.repeat(lambda: [legacy_denest_json(page) for page in corpus],
+                                    number=1, repeat=args.repeat))
+    plan_time = min(timeit.repeat(lambda: [flatten_page(page) for page in corpus],
+                                  number=1, repeat=args.repeat))
+    print('denest_json: {0:.4f}s'.format(legacy_time))
+    print('flatten_page: {0:.4f}s'.format(plan_time))
+    print('Speedup: {0:.2f}x'.format(legacy_time / plan_time))
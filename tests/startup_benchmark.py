@@ -0,0 +1,83 @@
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+
+# Times the cbtools commands that do not need the database, each run in a
+# fresh interpreter with none of the credential or database variables set,
+# and fails when one takes longer than the budget
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+commands = [('python', ['-c', 'pass']),
+            ('import cbtools', ['-c', 'import cbtools']),
+            ('denest_json', ['-c', 'from cbtools.utilities import denest_json; denest_json({"data": [{"id": "1"}]})']),
+            ('cbtools --help', ['-m', 'cbtools', '--help'])]
+
+# Commands whose help is printed after their module, and its dependencies,
+# are imported, timed for reference only
+reference_commands = [('cbtools {0} --help'.format(name), ['-m', 'cbtools', name, '--help'])
+                      for name in ('init-db', 'sync', 'report', 'export', 'trade')]
+
+heavy_modules = ['sqlalchemy', 'psycopg2', 'requests', 'numpy', 'pyarrow']
+
+
+def clean_environment():
+    return {key: value for key, value in os.environ.items()
+            if not (key.startswith('PG') or key.startswith('COINBASE_') or key.startswith('GDAX_')
+                    or key.startswith('CBTOOLS_'))}
+
+
+def time_command(arguments, runs):
+    timings = []
+    for run in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + arguments, cwd=ROOT, env=clean_environment(), check=True,
+                       stdout=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - start)
+    return sorted(timings)[len(timings) // 2]
+
+
+def loaded_heavy_modules(statement):
+    output = subprocess.run([sys.executable, '-c', statement + '; import sys; print(" ".join(sys.modules))'],
+                            cwd=ROOT, env=clean_environment(), check=True, stdout=subprocess.PIPE)
+    modules = output.stdout.decode('utf-8').split()
+    return [name for name in heavy_modules if name in modules]
+
+
+if __name__ == '__main__':
+    ARGS = argparse.ArgumentParser()
+    ARGS.add_argument('--runs', type=int, default=9, help='Runs per command, the median is reported')
+    ARGS.add_argument('--budget-ms', type=float, dest='budget_ms', default=100.0,
+                      help='Allowed milliseconds on top of a bare interpreter start for the non-database commands')
+    ARGS.add_argument('--reference', action='store_true', default=False,
+                      help='Also time the help of every subcommand')
+    args = ARGS.parse_args()
+
+    failed = False
+    baseline = None
+    for name, arguments in commands:
+        median = time_command(arguments, args.runs)
+        if baseline is None:
+            baseline = median
+            print('{0}: {1:.1f}ms'.format(name, median * 1000))
+            continue
+        over = (median - baseline) * 1000
+        within = over <= args.budget_ms
+        failed = failed or not within
+        print('{0}: {1:.1f}ms, +{2:.1f}ms over python ({3})'.format(name, median * 1000, over,
+                                                                     'ok' if within else 'OVER BUDGET'))
+    if args.reference:
+        for name, arguments in reference_commands:
+            print('{0}: {1:.1f}ms'.format(name, time_command(arguments, args.runs) * 1000))
+
+    for statement in ('import cbtools', 'from cbtools.utilities import denest_json', 'import cbtools.models'):
+        modules = loaded_heavy_modules(statement)
+        expected = ['sqlalchemy'] if statement == 'import cbtools.models' else []
+        unexpected = [name for name in modules if name not in expected]
+        failed = failed or bool(unexpected)
+        print('{0}: loads {1}{2}'.format(statement, ', '.join(modules) or 'nothing heavy',
+                                         ' (unexpected: {0})'.format(', '.join(unexpected)) if unexpected else ''))
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,117 @@
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import warnings
+from datetime import timedelta
+
+from coinbase.wallet.client import Client
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from cbtools import main
+from cbtools.client import ExchangeClient
+from cbtools.flatten import flatten
+from cbtools.loader import resource_to_model, insert, bulk_insert
+from cbtools.ratelimit import TokenBucket
+from fake_server import FakeCoinbase, WALLET_END_POINTS, EXCHANGE_END_POINTS, START
+
+
+def report(stage, rows, elapsed, requests=None):
+    line = '{0}: {1} rows in {2:.2f}s ({3:.0f} rows/sec)'.format(stage, rows, elapsed, rows / max(elapsed, 1e-6))
+    if requests is not None:
+        line += ', {0} requests ({1:.0f} requests/sec)'.format(requests, requests / max(elapsed, 1e-6))
+    print(line)
+
+
+def fetch_pages(fake, wallet_client, wallet_limiter, exchange_client):
+    pages = []
+    for account_id in fake.wallet_accounts:
+        for end_point in WALLET_END_POINTS:
+            for page in main.get_wallet_pages(wallet_client, wallet_limiter, 'get_' + end_point, account_id):
+                pages.append((page, account_id, None))
+    for account_id in fake.exchange_accounts:
+        for end_point in EXCHANGE_END_POINTS:
+            if end_point in ('orders', 'fills'):
+                path = end_point
+            else:
+                path = 'accounts/{0}/{1}'.format(account_id, end_point)
+            resource = 'exchange_order' if end_point == 'orders' else end_point.rstrip('s')
+            for page in main.get_exchange_pages(exchange_client, path, {}):
+                pages.append((page, account_id, resource))
+    return pages
+
+
+def run(fake, url, workers, load, bulk, batch_size, backfill):
+    wallet_client = Client('key', 'secret', base_api_uri=url)
+    # The fake server stands in for the API's own limits, so the client side
+    # buckets are opened up and only the injected 429s slow the sync down
+    wallet_limiter = TokenBucket(10 ** 6)
+    exchange_client = ExchangeClient('key', 'c2VjcmV0', 'passphrase', url=url, pool_size=max(workers, 10),
+                                     limiter=TokenBucket(10 ** 6))
+
+    start = time.time()
+    requests = fake.requests
+    pages = fetch_pages(fake, wallet_client, wallet_limiter, exchange_client)
+    report('Fetch', sum(len(page) for page, account_id, resource in pages), time.time() - start,
+           fake.requests - requests)
+
+    start = time.time()
+    documents = [document for page, account_id, resource in pages
+                 for document in flatten(page, account_id=account_id, resource=resource)]
+    report('Denest', len(documents), time.time() - start)
+
+    main.tmp_directory = tempfile.mkdtemp()
+    try:
+        start = time.time()
+        requests = fake.requests
+        cursors = {}
+        documents = list(main.get_wallet_data(wallet_client, wallet_limiter, True, cursors, workers))
+        # The backfill windows cover the minutes the fake rows were created in
+        since = main.format_timestamp(START - timedelta(minutes=fake.rows + 1))
+        until = main.format_timestamp(START + timedelta(minutes=1))
+        documents += list(main.get_exchange_data(exchange_client, True, cursors, workers, backfill=backfill,
+                                                 backfill_since=since, backfill_until=until))
+        report('Fetch, denest and spool with {0} workers{1}'.format(
+            workers, ' and {0} backfill windows'.format(backfill) if backfill else ''),
+            len(documents), time.time() - start, fake.requests - requests)
+    finally:
+        shutil.rmtree(main.tmp_directory)
+
+    if load:
+        start = time.time()
+        if bulk:
+            bulk_insert(documents, batch_size=batch_size)
+        else:
+            order_of_documents = list(resource_to_model)
+            for document in sorted(documents, key=lambda document: order_of_documents.index(document['resource'])):
+                insert(document)
+        report('Load', len(documents), time.time() - start)
+
+
+if __name__ == '__main__':
+    ARGS = argparse.ArgumentParser()
+    ARGS.add_argument('--wallet-accounts', type=int, dest='wallet_accounts', default=2)
+    ARGS.add_argument('--exchange-accounts', type=int, dest='exchange_accounts', default=2)
+    ARGS.add_argument('--rows', type=int, default=1000, help='Rows per account and endpoint')
+    ARGS.add_argument('--latency', type=float, default=0.0, help='Seconds added to every response')
+    ARGS.add_argument('--rate-limit', type=float, dest='rate_limit', default=0.0,
+                      help='Fraction of requests answered with HTTP 429')
+    ARGS.add_argument('--workers', type=int, default=4)
+    ARGS.add_argument('--backfill', type=int, default=0,
+                      help='Fetch the ledger, fills and orders as this many windows, per product for fills and orders')
+    ARGS.add_argument('--load', action='store_true', default=False,
+                      help='Also load the documents into the configured database, which should be a scratch one')
+    ARGS.add_argument('--bulk', action='store_true', default=False)
+    ARGS.add_argument('--batch-size', type=int, dest='batch_size', default=1000)
+    args = ARGS.parse_args()
+
+    warnings.simplefilter('ignore')
+    fake = FakeCoinbase(args.wallet_accounts, args.exchange_accounts, args.rows, args.latency, args.rate_limit)
+    url = fake.start()
+    try:
+        run(fake, url, args.workers, args.load, args.bulk, args.batch_size, args.backfill)
+    finally:
+        fake.stop()
+    print('{0} requests served, {1} rate limited'.format(fake.requests, fake.rate_limited))
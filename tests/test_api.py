@@ -0,0 +1,49 @@
+from decimal import Decimal
+
+import pytest
+
+from cbtools import api
+from cbtools.loader import bulk_insert, insert, replace_holds, skip_unchanged
+
+ACCOUNT = 'exchange-account-1'
+
+
+def snapshot(balance, status, hold_ids):
+    documents = [{'resource': 'exchange_account', 'id': ACCOUNT, 'currency': 'BTC', 'balance': balance,
+                  'available': balance, 'hold': '0'},
+                 {'resource': 'exchange_order', 'id': 'order-1', 'account_id': ACCOUNT, 'product_id': 'BTC-USD',
+                  'side': 'buy', 'type': 'limit', 'price': '2500.00', 'size': '0.1', 'status': status,
+                  'created_at': '2017-06-01T00:00:00.000000Z'}]
+    documents += [{'resource': 'hold', 'id': hold_id, 'account_id': ACCOUNT, 'amount': '0.25',
+                   'created_at': '2017-06-01T00:00:00.000000Z', 'type': 'order', 'ref': 'order-1'}
+                  for hold_id in hold_ids]
+    return documents
+
+
+def sync(documents, bulk):
+    # As main.sync loads what it fetched
+    changed = skip_unchanged(list(documents))
+    if bulk:
+        bulk_insert(changed)
+    else:
+        for document in changed:
+            insert(document)
+    replace_holds(documents)
+    api.cache.invalidate()
+
+
+@pytest.mark.parametrize('bulk', [True, False])
+def test_reads_follow_the_latest_sync(database, bulk):
+    sync(snapshot('1.0', 'open', ['hold-1', 'hold-2']), bulk)
+    assert [balance.balance for balance in api.balances()] == [Decimal('1.0')]
+    assert [order.id for order in api.open_orders()] == ['order-1']
+    assert api.available(ACCOUNT).holds == Decimal('0.50')
+
+    sync(snapshot('2.5', 'done', ['hold-2']), bulk)
+    assert [balance.balance for balance in api.balances()] == [Decimal('2.5')]
+    assert api.open_orders() == ()
+    available = api.available(ACCOUNT)
+    assert (available.hold_count, available.holds, available.available) == (1, Decimal('0.25'), Decimal('2.25'))
+
+    sync(snapshot('2.5', 'done', []), bulk)
+    assert api.available(ACCOUNT).hold_count == 0
@@ -0,0 +1,63 @@
+import pytest
+import requests
+
+from cbtools import client as client_module
+from cbtools.client import ExchangeClient
+from cbtools.ratelimit import TokenBucket
+
+
+class StatusSession(requests.Session):
+    # Answers every request with the given status codes, in turn
+    def __init__(self, status_codes):
+        super(StatusSession, self).__init__()
+        self.status_codes = list(status_codes)
+
+    def request(self, method, url, **kwargs):
+        response = requests.Response()
+        response.status_code = self.status_codes.pop(0)
+        response.url = url
+        response._content = b'{}'
+        return response
+
+
+def make_client(status_codes, monkeypatch):
+    monkeypatch.setattr(client_module.time, 'sleep', lambda seconds: None)
+    return ExchangeClient('key', 'c2VjcmV0', 'passphrase', url='http://127.0.0.1/', retries=2,
+                          limiter=TokenBucket(10000), session=StatusSession(status_codes))
+
+
+def test_retries_until_success(monkeypatch):
+    assert make_client([429, 503, 200], monkeypatch).get('accounts').status_code == 200
+
+
+@pytest.mark.parametrize('status_code', [429, 503])
+def test_raises_once_retries_run_out(monkeypatch, status_code):
+    client = make_client([status_code] * 3, monkeypatch)
+    with pytest.raises(requests.HTTPError):
+        client.get('accounts')
+
+
+def test_orders_are_not_retried_on_server_errors(monkeypatch):
+    # Whether the order was placed is unknown, the response is left to the
+    # caller
+    assert make_client([503], monkeypatch).post('orders', json={}).status_code == 503
+
+
+class CountingBucket(TokenBucket):
+    def __init__(self, rate):
+        TokenBucket.__init__(self, rate)
+        self.acquired = 0
+
+    def acquire(self):
+        self.acquired += 1
+        TokenBucket.acquire(self)
+
+
+def test_market_data_draws_on_the_public_bucket():
+    private, public = CountingBucket(10000), CountingBucket(10000)
+    client = ExchangeClient('key', 'c2VjcmV0', 'passphrase', url='http://127.0.0.1/', limiter=private,
+                            public_limiter=public, session=StatusSession([200] * 3))
+    client.get('products')
+    client.get('products/BTC-USD/ticker')
+    client.get('fills', params={'product_id': 'BTC-USD'})
+    assert (private.acquired, public.acquired) == (1, 2)
@@ -0,0 +1,63 @@
+import os
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+
+import pytest
+
+from cbtools import columnar
+from cbtools.models import Fills
+
+pyarrow = pytest.importorskip('pyarrow')
+import pyarrow.parquet  # noqa: E402
+
+START = datetime(2017, 6, 1, 12, tzinfo=timezone.utc)
+
+
+def add_fills(session, fills):
+    # (trade id, days after the start, product)
+    for trade_id, day, product_id in fills:
+        session.add(Fills(trade_id=trade_id, account_id='exchange-account-1', product_id=product_id,
+                          created_at=START + timedelta(days=day, minutes=trade_id), price=Decimal('2500.5'),
+                          size=Decimal('0.01'), side='buy'))
+    session.commit()
+
+
+def partition_files(directory):
+    # {path below the table directory: inode}, a rewritten file is a new one
+    table_directory = os.path.join(directory, 'fills')
+    return {os.path.relpath(os.path.join(root, name), table_directory): os.stat(os.path.join(root, name)).st_ino
+            for root, directories, names in os.walk(table_directory) for name in names}
+
+
+def test_fills_are_exported_by_day_and_product(database, tmp_path):
+    directory = str(tmp_path)
+    add_fills(database, [(1, 0, 'BTC-USD'), (2, 0, 'ETH-USD'), (3, 1, 'BTC-USD')])
+    [(table_name, rows, partitions, elapsed)] = columnar.export(['fills'], directory)
+    assert (table_name, rows, partitions) == ('fills', 3, 3)
+
+    first = partition_files(directory)
+    assert sorted(first) == ['created_date=2017-06-01/product_id=BTC-USD/part-0.parquet',
+                             'created_date=2017-06-01/product_id=ETH-USD/part-0.parquet',
+                             'created_date=2017-06-02/product_id=BTC-USD/part-0.parquet']
+    exported = pyarrow.parquet.read_table(os.path.join(directory, 'fills', sorted(first)[0]))
+    # The product is in the path, not the file
+    assert 'product_id' not in exported.schema.names
+    assert exported.schema.field('price').type == pyarrow.decimal128(38, 18)
+    assert exported.schema.field('created_at').type == pyarrow.timestamp('us', tz='UTC')
+    assert exported.column('price').to_pylist() == [Decimal('2500.5')]
+    assert exported.column('created_at').to_pylist() == [START + timedelta(minutes=1)]
+    assert columnar.load_state(directory) == {'fills': '2017-06-02'}
+
+    # The next export starts from the last day exported, leaving the days
+    # before it as they are
+    add_fills(database, [(4, 1, 'BTC-USD'), (5, 2, 'LTC-USD')])
+    [(table_name, rows, partitions, elapsed)] = columnar.export(['fills'], directory)
+    assert (rows, partitions) == (3, 2)
+    second = partition_files(directory)
+    assert [path for path in sorted(second) if second[path] != first.get(path)] == [
+        'created_date=2017-06-02/product_id=BTC-USD/part-0.parquet',
+        'created_date=2017-06-03/product_id=LTC-USD/part-0.parquet']
+    rewritten = pyarrow.parquet.read_table(
+        os.path.join(directory, 'fills', 'created_date=2017-06-02/product_id=BTC-USD/part-0.parquet'))
+    assert rewritten.column('trade_id').to_pylist() == [3, 4]
+    assert columnar.load_state(directory) == {'fills': '2017-06-03'}
@@ -0,0 +1,17 @@
+import pytest
+import requests
+
+from fake_server import FakeCoinbase
+
+
+@pytest.mark.parametrize('wallet_accounts, exchange_accounts', [(0, 0), (0, 2), (2, 0)])
+def test_serves_any_number_of_accounts(wallet_accounts, exchange_accounts):
+    fake = FakeCoinbase(wallet_accounts=wallet_accounts, exchange_accounts=exchange_accounts, rows=10)
+    url = fake.start()
+    try:
+        for path in ['v2/user', 'v2/accounts', 'v2/payment-methods', 'accounts', 'orders', 'fills']:
+            assert requests.get(url + path).status_code == 200
+        assert len(requests.get(url + 'v2/accounts').json()['data']) == wallet_accounts
+        assert len(requests.get(url + 'accounts').json()) == exchange_accounts
+    finally:
+        fake.stop()
@@ -0,0 +1,144 @@
+from decimal import Decimal
+
+import pytest
+
+import cbtools
+from cbtools.client import ExchangeClient
+from cbtools.feed import FeedIngester
+from cbtools.models import ExchangeAccounts, ExchangeOrders, Fills
+from cbtools.ratelimit import TokenBucket
+from fake_feed import FakeFeed, synthetic_session
+from fake_server import FakeCoinbase
+
+PRODUCTS = ['BTC-USD']
+
+
+class RecordingIngester(FeedIngester):
+    # Keeps the size of every non-empty batch and the products resynced
+    def __init__(self, *args, **kwargs):
+        FeedIngester.__init__(self, *args, **kwargs)
+        self.batches = []
+        self.resynced = []
+
+    def flush(self):
+        if self.orders or self.fills:
+            self.batches.append((len(self.orders), len(self.fills)))
+        FeedIngester.flush(self)
+
+    def resync(self, product_id):
+        self.resynced.append(product_id)
+        FeedIngester.resync(self, product_id)
+
+
+@pytest.fixture
+def servers():
+    rest = FakeCoinbase(exchange_accounts=4, rows=10)
+    rest_url = rest.start()
+    feeds = []
+
+    def start(messages, speed=0.0, drop_every=0):
+        feed = FakeFeed(messages, speed, drop_every)
+        feeds.append(feed)
+        return feed.start()
+
+    yield rest, ExchangeClient('key', 'c2VjcmV0', 'passphrase', url=rest_url, limiter=TokenBucket(10 ** 6)), start
+    for feed in feeds:
+        feed.stop()
+    rest.stop()
+
+
+# Replayed at the recorded pace, 10ms between messages, a batch is written
+# every few messages; as fast as possible, all of them are written at the end
+@pytest.mark.parametrize('speed, flush_interval', [(1.0, 0.005), (0.0, 60.0)])
+def test_own_orders_and_matches_become_rows(database, servers, speed, flush_interval):
+    rest, client, start = servers
+    for account in range(len(rest.exchange_accounts)):
+        document = rest.exchange_account(account)
+        database.add(ExchangeAccounts(id=document['id'], currency=document['currency']))
+    database.commit()
+
+    messages = list(synthetic_session(PRODUCTS, 4))
+    ingester = RecordingIngester(client, PRODUCTS, url=start(messages, speed), flush_interval=flush_interval)
+    ingester.run()
+    # And the subscriptions message
+    assert ingester.messages == len(messages) + 1
+
+    usd_account = rest.exchange_accounts[3]
+    orders = database.query(ExchangeOrders).order_by(ExchangeOrders.created_at).all()
+    assert [(order.status, order.done_reason, order.type, order.account_id) for order in orders] == \
+        [('done', 'filled', 'limit', usd_account)] * 4
+    fills = database.query(Fills).order_by(Fills.trade_id).all()
+    assert [fill.trade_id for fill in fills] == [1, 2, 3, 4]
+    assert all(fill.liquidity == 'M' and fill.account_id == usd_account for fill in fills)
+    assert fills[0].size == Decimal('0.01') and fills[0].price == Decimal('2500')
+
+    if speed:
+        assert len(ingester.batches) > 4
+    else:
+        # Every message for an order is merged into one row of one batch
+        assert ingester.batches == [(4, 4)]
+
+
+def test_sequence_gaps_resync_without_the_database(servers, monkeypatch):
+    # A dry run keeps its log records out of the database logger, which
+    # would need the database settings
+    records = []
+    monkeypatch.setattr(cbtools.db_handler, 'emit', records.append)
+    rest, client, start = servers
+    messages = list(synthetic_session(PRODUCTS, 4))
+    ingester = RecordingIngester(client, PRODUCTS, url=start(messages, drop_every=5), flush_interval=60.0,
+                                 dry_run=True)
+    ingester.run()
+    assert ingester.messages == len(messages) - len(messages) // 5 + 1
+    assert ingester.resynced == ['BTC-USD'] * (len(messages) // 5)
+    # The orders still open on the exchange were read back and merged
+    assert sum(orders for orders, fills in ingester.batches) > 4
+    assert records == []
+
+
+def test_failed_flushes_keep_their_rows_for_the_next(database, servers):
+    rest, client, start = servers
+    ingester = FeedIngester(client, PRODUCTS, url=None, flush_interval=60.0)
+    ingester.load_accounts()
+    for message in synthetic_session(PRODUCTS, 2):
+        ingester.handle(message)
+
+    # The sync has not stored the exchange accounts the rows refer to yet
+    ingester.flush()
+    assert (len(ingester.orders), len(ingester.fills)) == (2, 2)
+    assert database.query(Fills).count() == 0
+
+    for account in range(len(rest.exchange_accounts)):
+        document = rest.exchange_account(account)
+        database.add(ExchangeAccounts(id=document['id'], currency=document['currency']))
+    database.commit()
+    ingester.flush()
+    assert (ingester.orders, ingester.fills) == ({}, {})
+    assert database.query(ExchangeOrders).count() == 2 and database.query(Fills).count() == 2
+
+
+def test_resync_closes_orders_no_longer_open(database, servers):
+    rest, client, start = servers
+    for account in range(len(rest.exchange_accounts)):
+        document = rest.exchange_account(account)
+        database.add(ExchangeAccounts(id=document['id'], currency=document['currency']))
+    database.commit()
+    ingester = FeedIngester(client, PRODUCTS, url=None, flush_interval=60.0)
+    ingester.load_accounts()
+    placed = [client.post('orders', json={'product_id': 'BTC-USD', 'side': 'buy', 'price': '100.00',
+                                          'size': '0.01'}).json()['id'] for order in range(2)]
+    message = {'type': 'open', 'product_id': 'BTC-USD', 'side': 'buy', 'price': '100.00',
+               'remaining_size': '0.01', 'profile_id': 'profile-1', 'time': '2017-06-01T00:00:00.000000Z'}
+    for sequence, order_id in enumerate(placed, 1):
+        ingester.handle(dict(message, order_id=order_id, sequence=sequence))
+    ingester.flush()
+
+    # One order is canceled and the other filled while messages are lost
+    client.delete('orders/' + placed[0])
+    rest.open_orders[placed[1]].update(status='done', done_reason='filled', filled_size='0.01')
+    ingester.handle({'type': 'received', 'product_id': 'BTC-USD', 'order_id': 'someone-else', 'sequence': 5})
+    ingester.flush()
+    orders = {order.id: order for order in database.query(ExchangeOrders).filter(ExchangeOrders.id.in_(placed))}
+    assert [(orders[order_id].status, orders[order_id].done_reason) for order_id in placed] == [
+        ('done', 'canceled'), ('done', 'filled')]
+    assert not ingester.own_orders.intersection(placed)
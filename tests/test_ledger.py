@@ -0,0 +1,67 @@
+from datetime import datetime, timezone
+from decimal import Decimal
+
+from cbtools import ledger
+from cbtools.models import Entries, ExchangeAccounts, LedgerCheckpoints, LedgerGaps
+from cbtools.pnl import from_units, to_units
+
+ACCOUNT = 'exchange-account-1'
+CREATED_AT = datetime(2017, 6, 1, tzinfo=timezone.utc)
+
+
+def add_entries(session, entries):
+    # (id, amount, balance), all at the same time, so only the ids order them
+    for entry_id, amount, balance in entries:
+        session.add(Entries(account_id=ACCOUNT, id=entry_id, created_at=CREATED_AT, entry_type='match',
+                            amount=Decimal(amount), balance=Decimal(balance)))
+    session.commit()
+
+
+def test_replay_orders_entries_by_numeric_id(database):
+    database.add(ExchangeAccounts(id=ACCOUNT, currency='BTC', balance=Decimal('4.5')))
+    database.commit()
+    add_entries(database, [(8, '1.0', '1.0'), (9, '1.0', '2.0')])
+    first, = ledger.run()
+    assert (first.entries, first.gaps) == (2, [])
+
+    # Ten and eleven come after nine, though not as text, and eleven's
+    # balance includes an entry that is missing
+    add_entries(database, [(10, '1.0', '3.0'), (11, '1.0', '4.5')])
+    second, = ledger.run()
+    assert second.entries == 2
+    assert [(gap['entry_id'], gap['difference']) for gap in second.gaps] == [(11, Decimal('0.5'))]
+    assert second.balance == Decimal('4.5')
+    assert second.account_difference == 0
+
+    checkpoint = database.query(LedgerCheckpoints).get(ACCOUNT)
+    assert (checkpoint.last_id, checkpoint.entries) == (11, 4)
+    assert [gap.entry_id for gap in database.query(LedgerGaps)] == [11]
+
+
+def test_entries_older_than_the_checkpoint_replay_the_account(database):
+    database.add(ExchangeAccounts(id=ACCOUNT, currency='BTC', balance=Decimal('3.0')))
+    database.commit()
+    add_entries(database, [(1, '1.0', '1.0'), (3, '1.0', '3.0')])
+    first, = ledger.run()
+    assert [gap['entry_id'] for gap in first.gaps] == [3]
+
+    # The missing entry arrives, older than the checkpoint
+    add_entries(database, [(2, '1.0', '2.0')])
+    second, = ledger.run()
+    assert (second.replayed, second.entries, second.gaps) == (True, 3, [])
+    assert database.query(LedgerGaps).count() == 0
+    assert database.query(LedgerCheckpoints).get(ACCOUNT).entries == 3
+
+    third, = ledger.run()
+    assert (third.replayed, third.entries) == (False, 0)
+
+
+def test_balances_past_int64_are_replayed_exactly():
+    # 10,000 coins is 1e20 units, past int64
+    amounts = [to_units(amount, ledger.BALANCE_SCALE) for amount in ('10000', '0.0000000000000001', '5')]
+    balances = [to_units(balance, ledger.BALANCE_SCALE) for balance in ('20000', '20000.0000000000000001',
+                                                                            '20006.0000000000000001')]
+    opening_balance = to_units('10000', ledger.BALANCE_SCALE)
+    indexes, computed, changes = ledger.find_gaps(opening_balance, amounts, balances)
+    assert list(indexes) == [2]
+    assert from_units(int(changes[2]), ledger.BALANCE_SCALE) == 1
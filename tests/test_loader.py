@@ -0,0 +1,71 @@
+from cbtools.loader import bulk_insert, insert, skip_unchanged
+from cbtools.metrics import registry
+from cbtools.models import ExchangeAccounts, ReconciliationExceptions
+
+STORED = {'resource': 'fill', 'trade_id': 1, 'created_at': '2017-06-01T00:00:00.000000Z',
+          'account_id': 'exchange-account-1', 'order_id': 'order-1', 'product_id': 'BTC-USD', 'price': '2500.00',
+          'size': '0.10000000', 'side': 'buy', 'liquidity': 'T'}
+
+# Later versions of the same fill: a string changed and one dropped, and
+# typed values, including a boolean, where none were stored
+INCOMING = [dict(STORED, liquidity='M', side=None, fee='0.6250000000000000', settled=True,
+                 usd_volume='250.0000000000000000'),
+            dict(STORED, trade_id=2, settled=False)]
+
+
+def recorded_exceptions(session):
+    exceptions = session.query(ReconciliationExceptions).order_by(ReconciliationExceptions.record_id,
+                                                                  ReconciliationExceptions.column_name)
+    return [(exception.table_name, exception.record_id, exception.column_name, exception.old_version,
+             exception.new_version, exception.old_version_type, exception.new_version_type)
+            for exception in exceptions]
+
+
+def test_both_paths_record_the_same_exceptions(database):
+    bulk_insert([STORED, dict(STORED, trade_id=2)])
+
+    for document in INCOMING:
+        insert(dict(document))
+    one_at_a_time = recorded_exceptions(database)
+    database.query(ReconciliationExceptions).delete()
+    database.commit()
+
+    bulk_insert([dict(document) for document in INCOMING])
+    batched = recorded_exceptions(database)
+
+    assert batched == one_at_a_time
+    assert [(column_name, old_version, new_version)
+            for table_name, record_id, column_name, old_version, new_version, old_type, new_type in batched] == [
+        ('fee', None, '0.6250000000000000'),
+        ('liquidity', 'T', 'M'),
+        ('settled', None, 'True'),
+        ('side', 'buy', None),
+        ('usd_volume', None, '250.0000000000000000'),
+        ('settled', None, 'False')]
+
+
+def test_documents_fetched_under_several_accounts_are_unchanged_on_the_next_sync(database):
+    # The exchange lists the same fills and orders for every account, and
+    # each is tagged with the account it was fetched under
+    for account_id in ('exchange-account-1', 'exchange-account-2'):
+        database.add(ExchangeAccounts(id=account_id, currency='USD'))
+    database.commit()
+    order = {'resource': 'exchange_order', 'id': 'order-1', 'product_id': 'BTC-USD', 'side': 'buy',
+             'status': 'done', 'created_at': '2017-06-01T00:00:00.000000Z'}
+
+    def fetched():
+        return [dict(document, account_id=account_id) for account_id in ('exchange-account-1', 'exchange-account-2')
+                for document in (STORED, dict(STORED, trade_id=2), order)]
+
+    registry.reset()
+    bulk_insert(skip_unchanged(fetched()))
+    assert registry.total('cbtools_documents_changed_total') == 6
+
+    registry.reset()
+    assert skip_unchanged(fetched()) == []
+    assert registry.total('cbtools_documents_unchanged_total') == 6
+
+    # A field of the document itself is a change, for that key only
+    changed = fetched()
+    changed[1]['liquidity'] = 'M'
+    assert skip_unchanged(changed) == [changed[1]]
@@ -0,0 +1,144 @@
+from datetime import timedelta
+
+import pytest
+from coinbase.wallet.client import Client
+
+from cbtools import main
+from cbtools.client import ExchangeClient
+from cbtools.metrics import registry
+from cbtools.models import Entries, ExchangeOrders, Fills, Holds
+from cbtools.ratelimit import TokenBucket
+from cbtools.spool import Spool
+from fake_server import FakeCoinbase, PRODUCTS, START
+
+ROWS = 40
+
+
+@pytest.fixture
+def fake():
+    fake = FakeCoinbase(wallet_accounts=0, exchange_accounts=4, rows=ROWS)
+    url = fake.start()
+    yield fake, ExchangeClient('key', 'c2VjcmV0', 'passphrase', url=url, limiter=TokenBucket(10 ** 6))
+    fake.stop()
+
+
+def stored(session):
+    # Orders are one row whichever account listed them last
+    return (sorted((fill.trade_id, fill.account_id) for fill in session.query(Fills)),
+            sorted(order.id for order in session.query(ExchangeOrders)),
+            sorted(int(entry.id) for entry in session.query(Entries)))
+
+
+def test_a_backfill_stores_the_rows_of_a_full_sync(database, fake, tmp_path):
+    fake, client = fake
+    main.sync(exchange_client=client, bulk=True, directory=str(tmp_path / 'backfill'), backfill=3,
+              backfill_since=main.format_timestamp(START - timedelta(minutes=ROWS)))
+    backfilled = stored(database)
+    for Model in (Fills, ExchangeOrders, Entries, Holds):
+        database.query(Model).delete()
+    database.commit()
+
+    main.sync(exchange_client=client, full=True, bulk=True, directory=str(tmp_path / 'full'))
+    assert stored(database) == backfilled
+    assert len(backfilled[0]) == ROWS * len(fake.exchange_accounts)
+
+    # Each product's shards were fetched once for all four accounts
+    shards = [name for name in Spool(str(tmp_path / 'backfill' / 'exchange')).manifest
+              if name.startswith('profile-')]
+    assert sorted(shards) == sorted(main.shard_name(None, end_point, product_id, window)
+                                    for end_point in main.backfill_by_product for product_id in PRODUCTS
+                                    for window in range(3))
+
+
+def test_a_row_on_a_window_edge_is_fetched_once(fake, tmp_path):
+    fake, client = fake
+    # The fourth row is on the edge between the two windows
+    edge = START - timedelta(minutes=4, microseconds=-4)
+    documents = list(main.get_exchange_data(client, False, {}, directory=str(tmp_path), backfill=2,
+                                            backfill_since=main.format_timestamp(edge - timedelta(minutes=5)),
+                                            backfill_until=main.format_timestamp(edge + timedelta(minutes=5))))
+    on_edge = [document['account_id'] for document in documents
+               if document['resource'] == 'fill' and document['trade_id'] == ROWS - 4]
+    assert sorted(on_edge) == sorted(fake.exchange_accounts)
+    assert len([document for document in documents if document['resource'] == 'fill']) == \
+        10 * len(fake.exchange_accounts)
+
+
+def test_an_interrupted_backfill_resumes_the_unfinished_shards(fake, tmp_path, monkeypatch):
+    fake, client = fake
+    fetched = []
+    get_exchange_shard = main.get_exchange_shard
+    failing = [main.shard_name(None, 'fills', 'ETH-USD', 1)]
+
+    def get_shard(client, spool, name, *args):
+        fetched.append(name)
+        if name in failing:
+            raise ConnectionError('connection reset')
+        get_exchange_shard(client, spool, name, *args)
+
+    monkeypatch.setattr(main, 'get_exchange_shard', get_shard)
+    since = main.format_timestamp(START - timedelta(minutes=ROWS))
+    until = main.format_timestamp(START + timedelta(minutes=1))
+    with pytest.raises(ConnectionError):
+        main.get_exchange_data(client, False, {}, directory=str(tmp_path), backfill=3, backfill_since=since,
+                               backfill_until=until)
+    first_run = len(fetched)
+
+    failing = []
+    documents = main.get_exchange_data(client, False, {}, directory=str(tmp_path), backfill=3,
+                                       backfill_since=since, backfill_until=until)
+    assert fetched[first_run:] == [main.shard_name(None, 'fills', 'ETH-USD', 1)]
+    fills = set((document['trade_id'], document['account_id']) for document in documents
+                if document['resource'] == 'fill')
+    assert len(fills) == ROWS * len(fake.exchange_accounts)
+
+
+@pytest.mark.filterwarnings('ignore::UserWarning')
+def test_a_refresh_stops_at_the_saved_cursors(database, tmp_path):
+    fake = FakeCoinbase(wallet_accounts=1, exchange_accounts=1, rows=250)
+    url = fake.start()
+    wallet_client = Client('key', 'secret', base_api_uri=url)
+    client = ExchangeClient('key', 'c2VjcmV0', 'passphrase', url=url, limiter=TokenBucket(10 ** 6))
+    pages = {}
+    try:
+        for run in range(2):
+            registry.reset()
+            main.sync(wallet_client, TokenBucket(10 ** 6), client, refresh=True, bulk=True, directory=str(tmp_path))
+            pages[run] = {end_point: registry.counters.get(('cbtools_pages_total', (('end_point', end_point),)))
+                          for end_point in ('get_transactions', 'accounts/ledger', 'fills', 'orders')}
+    finally:
+        fake.stop()
+    assert pages[0] == {'get_transactions': 10, 'accounts/ledger': 3, 'fills': 3, 'orders': 3}
+    # The first page holds the newest row of the first run, which ends each
+    # walk with a cursor; orders change state and are walked in full
+    assert pages[1] == {'get_transactions': 1, 'accounts/ledger': 1, 'fills': 1, 'orders': 3}
+    assert database.query(Fills).count() == 250
+
+
+def test_an_interrupted_refresh_resumes_the_unfinished_segments(fake, tmp_path, monkeypatch):
+    fake, client = fake
+    fetched = []
+    get_exchange_end_point = main.get_exchange_end_point
+    failing = [(fake.exchange_accounts[2], 'fills')]
+
+    def get_end_point(client, spool, end_point, account_id, cursor):
+        fetched.append((account_id, end_point))
+        if (account_id, end_point) in failing:
+            raise ConnectionError('connection reset')
+        get_exchange_end_point(client, spool, end_point, account_id, cursor)
+
+    monkeypatch.setattr(main, 'get_exchange_end_point', get_end_point)
+    with pytest.raises(ConnectionError):
+        main.get_exchange_data(client, True, {}, directory=str(tmp_path))
+    assert len(fetched) == 4 * len(fake.exchange_accounts)
+    requests = fake.requests
+
+    failing = []
+    documents = list(main.get_exchange_data(client, True, {}, directory=str(tmp_path)))
+    # Only the failed segment is fetched again, with one request for the
+    # accounts, and read back with all the others
+    assert fetched[4 * len(fake.exchange_accounts):] == [(fake.exchange_accounts[2], 'fills')]
+    assert fake.requests - requests == 2
+    fills = set((document['trade_id'], document['account_id']) for document in documents
+                if document['resource'] == 'fill')
+    assert len(fills) == ROWS * len(fake.exchange_accounts)
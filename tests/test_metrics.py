@@ -0,0 +1,87 @@
+import json
+import re
+import sys
+from decimal import Decimal
+
+import pytest
+
+from cbtools import client, ratelimit
+from cbtools.__main__ import main as cbtools_main
+from cbtools.metrics import registry
+from cbtools.models import ExchangeAccounts, Fills
+from fake_server import FakeCoinbase, timestamp
+
+ROWS = 20
+
+
+def prometheus_samples(text):
+    # {(name, labels): value}, histograms by their _count series
+    samples = {}
+    for line in text.splitlines():
+        if line.startswith('#'):
+            continue
+        match = re.match(r'^(\w+)(?:\{(.*)\})? (\S+)$', line)
+        labels = tuple(sorted(re.findall(r'(\w+)="((?:[^"\\]|\\.)*)"', match.group(2) or '')))
+        samples[(match.group(1), labels)] = float(match.group(3))
+    return samples
+
+
+def json_samples(text):
+    summary = json.loads(text)
+    samples = {(counter['name'], tuple(sorted(counter['labels'].items()))): counter['value']
+               for counter in summary['counters']}
+    samples.update(((histogram['name'] + '_count', tuple(sorted(histogram['labels'].items()))), histogram['count'])
+                   for histogram in summary['histograms'])
+    return samples
+
+
+def series(samples, name, **labels):
+    return sum(value for (sample_name, sample_labels), value in samples.items()
+               if sample_name == name and set(labels.items()) <= set(sample_labels))
+
+
+# The wallet client warns about the fake server's plain HTTP, and runpy
+# about running cbtools.main once other tests have imported it
+@pytest.mark.filterwarnings('ignore::UserWarning', 'ignore::RuntimeWarning')
+@pytest.mark.parametrize('metrics_format, parse', [('prometheus', prometheus_samples), ('json', json_samples)])
+def test_a_sync_writes_the_documented_series(database, tmp_path, monkeypatch, metrics_format, parse):
+    # Some requests are turned away, and retried without waiting
+    fake = FakeCoinbase(wallet_accounts=1, exchange_accounts=2, rows=ROWS, rate_limit=0.3)
+    url = fake.start()
+    for name in ('COINBASE_KEY', 'COINBASE_SECRET', 'GDAX_API_KEY', 'GDAX_API_PASSPHRASE'):
+        monkeypatch.setenv(name, 'key')
+    monkeypatch.setenv('GDAX_API_SECRET', 'c2VjcmV0')
+    monkeypatch.setattr(ratelimit, 'WALLET_RATE', 10 ** 6)
+    monkeypatch.setattr(client, 'EXCHANGE_PRIVATE_RATE', 10 ** 6)
+    monkeypatch.setattr(client, 'EXCHANGE_PRIVATE_BURST', 10 ** 6)
+    monkeypatch.setattr(ratelimit, 'backoff_delay', lambda attempt: 0)
+    monkeypatch.setattr(client, 'backoff_delay', lambda attempt: 0)
+    monkeypatch.setattr(sys, 'argv', sys.argv)
+    monkeypatch.chdir(tmp_path)
+
+    # A stored fill the sync's copy differs from
+    account_id = fake.exchange_accounts[0]
+    database.add(ExchangeAccounts(id=account_id, currency='BTC'))
+    database.commit()
+    database.add(Fills(trade_id=ROWS, created_at=timestamp(0, fractional=True), account_id=account_id,
+                       product_id='BTC-USD', price=Decimal(1), liquidity='X'))
+    database.commit()
+
+    registry.reset()
+    metrics_file = str(tmp_path / 'sync.metrics')
+    try:
+        cbtools_main(['sync', '--bulk', '--wallet-url', url, '--exchange-url', url, '--metrics-file', metrics_file,
+                      '--metrics-format', metrics_format])
+    finally:
+        fake.stop()
+    with open(metrics_file) as metrics:
+        samples = parse(metrics.read())
+
+    # HTTP latency per endpoint, of both APIs
+    for end_point in ('accounts', 'accounts/ledger', 'fills', 'orders', 'get_transactions'):
+        assert series(samples, 'cbtools_http_request_seconds_count', end_point=end_point) > 0
+    assert series(samples, 'cbtools_http_retries_total') > 0
+    assert series(samples, 'cbtools_http_retries_total', reason='429') == series(
+        samples, 'cbtools_http_request_seconds_count', status='429')
+    assert series(samples, 'cbtools_db_batch_seconds_count', table='fills') > 0
+    assert series(samples, 'cbtools_reconciliation_exceptions_total', table='fills') > 0
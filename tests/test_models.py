@@ -0,0 +1,37 @@
+import logging
+import os
+
+import pytest
+from sqlalchemy import inspect
+
+from cbtools import models
+from cbtools.models import SQLAlchemyLogHandler
+
+
+def record(message):
+    return logging.LogRecord('database_log', logging.ERROR, __file__, 1, message, None, None)
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='needs fork')
+def test_a_forked_child_starts_its_own_writer():
+    written = []
+    handler = SQLAlchemyLogHandler(flush_interval=0.01)
+    handler.write = written.extend
+    handler.emit(record('parent'))
+    pid = os.fork()
+    if pid == 0:
+        # The parent's writer thread did not survive the fork
+        handler.emit(record('child'))
+        handler.close()
+        os._exit(0 if [row['msg'] for row in written] in (['child'], ['parent', 'child']) else 1)
+    _, status = os.waitpid(pid, 0)
+    handler.close()
+    assert os.WEXITSTATUS(status) == 0
+    assert [row['msg'] for row in written] == ['parent']
+
+
+def test_brin_indexes_are_left_to_the_brin_option(database):
+    for index in models.brin_indexes:
+        assert index not in index.table.indexes
+        stored = inspect(models.get_engine()).get_indexes(index.table.name, schema=index.table.schema)
+        assert index.name not in [existing['name'] for existing in stored]
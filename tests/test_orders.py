@@ -0,0 +1,22 @@
+import requests
+
+from cbtools.orders import ladder, submit_orders
+
+
+class FlakyClient(object):
+    # Accepts every order but the second, whose connection drops
+    def post(self, path, json=None):
+        if json['price'] == '99.00':
+            raise requests.ConnectionError('Connection aborted')
+        response = requests.Response()
+        response.status_code = 200
+        response._content = b'{"id": "order-1", "status": "pending"}'
+        return response
+
+
+def test_a_dropped_connection_does_not_stop_the_ladder():
+    results = submit_orders(FlakyClient(), ladder('BTC-USD', 'buy', '100', '1', '0.01', 3), workers=1)
+    assert [(result.accepted, result.status) for result in results] == [(True, 'pending'), (False, 'unknown'),
+                                                                        (True, 'pending')]
+    assert results[1].reason == 'Connection aborted'
+    assert results[1].order_id is None
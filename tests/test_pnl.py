@@ -0,0 +1,77 @@
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+
+import pytest
+
+from cbtools import pnl
+from cbtools.models import Fills, PnlCheckpoints
+
+START = datetime(2017, 6, 1, tzinfo=timezone.utc)
+
+
+def add_fills(session, product_id, fills):
+    # (trade id, side, size, price), an hour apart in trade id order
+    for trade_id, side, size, price in fills:
+        session.add(Fills(account_id='exchange-account-1', product_id=product_id, trade_id=trade_id,
+                          created_at=START + timedelta(hours=trade_id), side=side, size=Decimal(size),
+                          price=Decimal(price), fee=Decimal(0)))
+    session.commit()
+
+
+@pytest.mark.parametrize('method', ['fifo', 'lifo'])
+def test_runs_continue_from_the_checkpoint(database, method):
+    add_fills(database, 'BTC-USD', [(1, 'buy', '1', '100'), (2, 'buy', '1', '200')])
+    first, = pnl.run(method)
+    assert (first.fills, first.realized, first.position, first.cost_basis) == (2, 0, 2, 300)
+
+    add_fills(database, 'BTC-USD', [(3, 'sell', '1', '300')])
+    second, = pnl.run(method)
+    cost = Decimal(100) if method == 'fifo' else Decimal(200)
+    assert (second.fills, second.realized, second.total_realized) == (1, 300 - cost, 300 - cost)
+    assert (second.position, second.cost_basis) == (1, 300 - cost)
+
+    # Nothing new, the totals carry over
+    third, = pnl.run(method)
+    assert (third.fills, third.realized, third.total_realized) == (0, 0, 300 - cost)
+
+    # A rebuild replays every fill to the same totals
+    rebuilt, = pnl.run(method, rebuild=True)
+    assert (rebuilt.fills, rebuilt.total_realized, rebuilt.position) == (3, 300 - cost, 1)
+
+
+def test_unmatched_sells_are_reported_per_product(database):
+    add_fills(database, 'BTC-USD', [(1, 'buy', '1', '100'), (2, 'sell', '2', '300')])
+    add_fills(database, 'ETH-USD', [(3, 'buy', '1', '10'), (4, 'sell', '1', '30')])
+    btc, eth = pnl.run()
+    assert btc.error and btc.realized is None
+    assert (eth.error, eth.realized) == (None, 20)
+
+    # The product that failed is matched again from where it was
+    assert database.query(PnlCheckpoints).get(('BTC-USD', 'fifo')).last_trade_id is None
+    btc, eth = pnl.run()
+    assert (btc.fills, eth.fills) == (2, 0)
+
+
+def test_fills_older_than_the_checkpoint_replay_the_product(database):
+    add_fills(database, 'BTC-USD', [(1, 'buy', '1', '100'), (3, 'sell', '1', '300')])
+    first, = pnl.run()
+    assert first.realized == 200
+
+    # A backfill stores an older buy, which the sell now matches first
+    add_fills(database, 'BTC-USD', [(2, 'buy', '1', '50')])
+    second, = pnl.run()
+    assert (second.replayed, second.fills, second.total_realized, second.cost_basis) == (True, 3, 200, 50)
+
+    third, = pnl.run()
+    assert (third.replayed, third.fills, third.total_realized) == (False, 0, 200)
+
+
+def test_fills_stored_for_several_accounts_are_matched_once(database):
+    add_fills(database, 'BTC-USD', [(1, 'buy', '1', '100'), (2, 'sell', '1', '300')])
+    for trade_id, side, price in [(1, 'buy', '100'), (2, 'sell', '300')]:
+        database.add(Fills(account_id='exchange-account-2', product_id='BTC-USD', trade_id=trade_id,
+                           created_at=START + timedelta(hours=trade_id), side=side, size=Decimal(1),
+                           price=Decimal(price), fee=Decimal(0)))
+    database.commit()
+    result, = pnl.run()
+    assert (result.error, result.fills, result.realized, result.position) == (None, 2, 200, 0)
@@ -0,0 +1,17 @@
+from decimal import Decimal
+
+from cbtools import reports
+from cbtools.models import Fills
+
+
+def test_fills_are_summed_per_order(database):
+    for index, (order_id, size, price, fee) in enumerate([('order-1', '0.1', '2500.01', '0.0000000000000001'),
+                                                          ('order-2', '1', '10', '0'),
+                                                          ('order-1', '0.2', '2500.02', '0.0000000000000002')]):
+        database.add(Fills(trade_id=index, account_id='exchange-account-1', order_id=order_id, size=Decimal(size),
+                           price=Decimal(price), fee=Decimal(fee), usd_volume=Decimal(size) * Decimal(price)))
+    database.commit()
+    rows = list(reports.fills_by_order(chunk_size=1))
+    assert [(order_id, fee, size, notional) for order_id, fee, size, usd_volume, notional in rows] == [
+        ('order-1', Decimal('0.0000000000000003'), Decimal('0.3'), Decimal('750.005')),
+        ('order-2', Decimal('0'), Decimal('1'), Decimal('10'))]
@@ -0,0 +1,34 @@
+from cbtools import scheduler
+from cbtools.models import ExchangeAccounts, Fills
+from fake_server import FakeCoinbase
+
+RATE = 20.0
+
+
+def test_profiles_sync_side_by_side_within_one_budget(database, tmp_path):
+    # Two profiles, each on a server of its own, in two processes
+    fakes = [FakeCoinbase(wallet_accounts=0, exchange_accounts=1, rows=250, first_account=first_account)
+             for first_account in (0, 1)]
+    profiles = [{'name': name, 'gdax_api_key': 'key', 'gdax_api_secret': 'c2VjcmV0', 'gdax_api_passphrase': 'passphrase',
+                 'exchange_url': fake.start()} for name, fake in zip(('first', 'second'), fakes)]
+    try:
+        results = list(scheduler.run(profiles, exchange_rate=RATE, exchange_burst=1, bulk=True,
+                                     directory=str(tmp_path)))
+    finally:
+        for fake in fakes:
+            fake.stop()
+    assert sorted((result.name, result.error) for result in results) == [('first', None), ('second', None)]
+
+    for profile, fake in zip(profiles, fakes):
+        account_id = fake.exchange_accounts[0]
+        assert database.query(ExchangeAccounts).get(account_id).sync_profile == profile['name']
+        fills = database.query(Fills).filter(Fills.account_id == account_id).all()
+        assert len(fills) == 250
+        assert set(fill.sync_profile for fill in fills) == {profile['name']}
+
+    # Both processes drew on one bucket, so the requests of both together
+    # were spread out at its rate, where two buckets would have let through
+    # twice as many
+    request_times = sorted(fakes[0].request_times + fakes[1].request_times)
+    assert len(request_times) > 20
+    assert request_times[-1] - request_times[0] >= (len(request_times) - 1) / RATE * 0.95